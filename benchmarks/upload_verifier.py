@@ -0,0 +1,76 @@
+"""
+Benchmark the columnar UploadVerifier against the previous per-cell loop.
+
+Usage:
+    python benchmarks/upload_verifier.py --rows 1000000 --bad-rate 0.001
+"""
+import argparse, csv, io, os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'secretsauce.settings')
+
+import django
+django.setup()
+
+import numpy as np
+from django.core.files.uploadedfile import SimpleUploadedFile
+from secretsauce.utils import UploadVerifier
+
+def make_csv(rows, bad_rate, seed=0):
+    rng = np.random.default_rng(seed)
+    columns = [
+        rng.integers(1, 53, rows).astype(str),
+        rng.integers(1, 4, rows).astype(str),
+        rng.integers(1, 10, rows).astype(str),
+        rng.integers(1, 200, rows).astype(str),
+        rng.integers(1000, 1500, rows).astype(str),
+        rng.integers(0, 100, rows).astype(str),
+        np.round(rng.uniform(1, 10, rows), 2).astype(str),
+    ]
+    bad = rng.random(rows) < bad_rate
+    columns[6] = np.where(bad, 'n/a', columns[6])
+    lines = [','.join(UploadVerifier.headers)]
+    lines.extend(','.join(row) for row in zip(*columns))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+def per_cell_loop(data):
+    """The verifier loop this benchmark replaces: csv.DictReader and float() on every cell"""
+    errors = dict()
+    for idx, row in enumerate(csv.DictReader(io.StringIO(data.decode('utf-8')))):
+        for header in row:
+            value = row[header]
+            try:
+                float(value)
+            except Exception:
+                error_key = "Col: " + header + ", Row: " + str(idx+2)
+                if value.isspace() or value == "":
+                    errors[error_key] = "Cell is empty"
+                else:
+                    errors[error_key] = "Cell value not allowed: " + value
+    return errors
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--bad-rate', type=float, default=0.001)
+    args = parser.parse_args()
+
+    data = make_csv(args.rows, args.bad_rate)
+    print(f'{args.rows} rows, {len(data) / 2 ** 20:.1f} MB')
+
+    loop_time, loop_errors = timed(lambda: per_cell_loop(data))
+    print(f'per-cell loop:  {loop_time:8.2f} s  ({len(loop_errors)} errors)')
+
+    upload = SimpleUploadedFile('bench.csv', data)
+    columnar_time, verifier = timed(lambda: UploadVerifier(upload, max_errors=len(loop_errors)))
+    print(f'columnar:       {columnar_time:8.2f} s  ({len(verifier.errors)} errors)')
+    print(f'speedup:        {loop_time / columnar_time:8.1f} x')
+    assert verifier.errors == loop_errors
+
+if __name__ == '__main__':
+    main()
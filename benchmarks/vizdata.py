@@ -0,0 +1,100 @@
+"""
+Benchmark the vizdata price/qty aggregations on a synthetic DataBlock, against the
+previous iterrows loops over the full file.
+
+Usage:
+    python benchmarks/vizdata.py --rows 10000000 --items 10
+"""
+import argparse, os, sys, tempfile, time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'secretsauce.settings')
+
+import django
+django.setup()
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from secretsauce.apps.portal.models import DataBlock
+from secretsauce.apps.portal.views import VizDataBlock
+from secretsauce.utils import UploadVerifier, sort_parquet
+
+def make_parquet(rows, n_items, sink, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'Wk': np.sort(rng.integers(1, 53, rows)),
+        'Tier': rng.integers(1, 4, rows),
+        'Groups': rng.integers(1, 10, rows),
+        'Store': rng.integers(1, 200, rows),
+        'Item_ID': rng.integers(1000, 1000 + n_items, rows),
+        'Qty_': rng.integers(0, 100, rows).astype(np.float64),
+        'Price_': np.round(rng.uniform(1, 10, rows), 2),
+    })
+    with tempfile.TemporaryFile() as unsorted_file:
+        pq.write_table(pa.Table.from_pandas(df, schema=UploadVerifier.parquet_schema, preserve_index=False), unsorted_file, row_group_size=2 ** 20)
+        unsorted_file.seek(0)
+        sort_parquet(unsorted_file, sink, 'Item_ID')
+    return df
+
+def iterrows_prices(df, items):
+    df = df[df['Item_ID'].isin(items)][['Item_ID', 'Price_']]
+    output = defaultdict(list)
+    for idx, row in df.iterrows():
+        output[int(row['Item_ID'])].append(row['Price_'])
+    items, datasets = zip(*sorted(output.items()))
+    return {'items': list(items), 'datasets': list(datasets)}
+
+def iterrows_quantities(df, items):
+    df = df[df['Item_ID'].isin(items)]
+    output = defaultdict(list)
+    max_week = 0
+    for idx, row in df.iterrows():
+        item_id = int(row['Item_ID'])
+        week = int(row['Wk'])
+        max_week = max(week, max_week)
+        while len(output[item_id]) < max_week:
+            output[item_id].append(0)
+        output[item_id][week - 1] += row['Qty_']
+    return {'weeks': list(range(1, max_week + 1)), 'datasets': output}
+
+def vectorized_read(parquet_file, columns, items):
+    row_groups = DataBlock.row_groups_for(parquet_file, items)
+    df = parquet_file.read_row_groups(row_groups, columns=columns).to_pandas()
+    return df[df['Item_ID'].isin(items)]
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=10000000)
+    parser.add_argument('--n-items', type=int, default=500)
+    parser.add_argument('--items', type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryFile() as parquet_sink:
+        df = make_parquet(args.rows, args.n_items, parquet_sink)
+        parquet_sink.seek(0)
+        parquet_file = pq.ParquetFile(parquet_sink)
+        items = list(range(1000, 1000 + args.items))
+        print(f'{args.rows} rows, {args.n_items} items, querying {len(items)} items')
+
+        loop_time, loop_prices = timed(lambda: iterrows_prices(df, items))
+        new_time, new_prices = timed(lambda: VizDataBlock.prices_by_item(
+            vectorized_read(parquet_file, ['Item_ID', 'Price_'], items)))
+        print(f'price  iterrows (in memory): {loop_time:8.2f} s   pruned read + vectorized: {new_time:8.3f} s')
+        assert loop_prices['items'] == new_prices['items']
+
+        loop_time, loop_qty = timed(lambda: iterrows_quantities(df, items))
+        new_time, new_qty = timed(lambda: VizDataBlock.weekly_quantities(
+            vectorized_read(parquet_file, ['Item_ID', 'Wk', 'Qty_'], items)))
+        print(f'qty    iterrows (in memory): {loop_time:8.2f} s   pruned read + vectorized: {new_time:8.3f} s')
+        assert loop_qty['weeks'] == new_qty['weeks']
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework.response import Response
+
+import hashlib
+
+def get_cache():
+    return caches['analytics']
+
+def canonical_items(value):
+    """The comma separated `items` of a query sorted and without duplicates, responses do not depend on their order"""
+    items = value.split(',')
+    try:
+        return ','.join(map(str, sorted(set(map(int, items)))))
+    except ValueError:
+        return ','.join(sorted(set(items)))
+
+def data_block_etag(request, data_block):
+    """ETag of an analytics response, from the DataBlock content and the request path and query"""
+    content = data_block.checksum or data_block.upload.name
+    query = '&'.join(
+        f'{key}={canonical_items(value) if key == "items" else value}'
+        for key, value in sorted(request.query_params.items())
+    )
+    digest = hashlib.sha1(f'{data_block.id}:{content}:{request.path}?{query}'.encode('utf-8')).hexdigest()
+    return f'"{digest}"'
+
+def cached_response(request, data_block, compute):
+    """
+    Returns the analytics response of `data_block` for `request`, computing its body with
+    `compute()` only when it is not cached yet.
+
+    DataBlocks cannot be modified once uploaded, so a response only depends on the
+    DataBlock content and the query. Responses carry an ETag and Last-Modified header
+    and conditional requests are answered with 304 Not Modified.
+    """
+    etag = data_block_etag(request, data_block)
+    last_modified = data_block.created.timestamp() if data_block.created else None
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        return not_modified
+
+    cache = get_cache()
+    key = f'datablock:{data_block.id}:{etag}'
+    body = cache.get(key)
+    if body is None:
+        body = compute()
+        cache.set(key, body)
+        keys_key = f'datablock:{data_block.id}:keys'
+        cache.set(keys_key, cache.get(keys_key, set()) | {key})
+
+    response = Response(body)
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+def invalidate_data_block(data_block_id):
+    """Drops every cached response of a DataBlock"""
+    cache = get_cache()
+    keys_key = f'datablock:{data_block_id}:keys'
+    cache.delete_many(list(cache.get(keys_key, set())) + [keys_key])
+
+def owned_projects_key(user_id):
+    return f'owned-projects:{user_id}'
+
+def owned_project_ids(request):
+    """
+    Returns the ids of the projects owned by request.user, read with one query and kept on
+    the request. They are also cached for settings.OWNED_PROJECTS_CACHE_TIMEOUT seconds,
+    until the owners of a project change.
+    """
+    project_ids = getattr(request, '_owned_project_ids', None)
+    if project_ids is not None:
+        return project_ids
+
+    cache = caches['default']
+    timeout = settings.OWNED_PROJECTS_CACHE_TIMEOUT
+    key = owned_projects_key(request.user.id)
+    project_ids = cache.get(key) if timeout else None
+    if project_ids is None:
+        project_ids = frozenset(request.user.project_set.values_list('id', flat=True))
+        if timeout:
+            cache.set(key, project_ids, timeout)
+    request._owned_project_ids = project_ids
+    return project_ids
+
+def invalidate_owned_projects(user_ids):
+    caches['default'].delete_many([owned_projects_key(user_id) for user_id in user_ids])
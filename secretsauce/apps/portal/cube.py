@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+
+class AggregateCube:
+    """
+    Aggregates of Price_ and Qty_ for a DataBlock, grouped by Item_ID alone and by
+    Item_ID together with each of `dimensions`.
+
+    Every grouping is a table with one row per combination that occurs in the data,
+    sorted by its keys and holding `rows` and the count, sum, min and max of each measure.
+    The tables are stored as flat arrays in an .npz file, named '<grouping>.<column>',
+    so reading one grouping does not load the others.
+    """
+
+    dimensions = ['Wk', 'Store', 'Tier']
+    measures = ['Price_', 'Qty_']
+    columns = ['Item_ID'] + dimensions + measures
+    groupings = ['Item_ID'] + dimensions
+
+    def __init__(self, arrays):
+        # Mapping of array name to array, either a dict or an opened .npz file
+        self.arrays = arrays
+
+    @classmethod
+    def keys(cls, grouping):
+        return ['Item_ID'] if grouping == 'Item_ID' else ['Item_ID', grouping]
+
+    @classmethod
+    def aggregate(cls, df, keys):
+        """Groups the rows of `df` by `keys`"""
+        named = {'rows': ('Item_ID', 'size')}
+        for measure in cls.measures:
+            named[f'{measure}.count'] = (measure, 'count')
+            named[f'{measure}.sum'] = (measure, 'sum')
+            named[f'{measure}.min'] = (measure, 'min')
+            named[f'{measure}.max'] = (measure, 'max')
+        return df.groupby(keys).agg(**named)
+
+    @classmethod
+    def combine(cls, partials):
+        """Merges tables aggregated from disjoint sets of rows"""
+        df = pd.concat(partials)
+        functions = {column: column.rsplit('.', 1)[-1] for column in df.columns}
+        functions = {column: 'sum' if f in ('rows', 'count') else f for column, f in functions.items()}
+        return df.groupby(level=list(range(df.index.nlevels))).agg(functions)
+
+    @classmethod
+    def from_tables(cls, tables):
+        arrays = dict()
+        for grouping, table in tables.items():
+            table = table.reset_index()
+            for column in table.columns:
+                arrays[f'{grouping}.{column}'] = table[column].values
+        return cls(arrays)
+
+    @classmethod
+    def from_frame(cls, df):
+        """Builds the cube from a DataFrame holding `columns`"""
+        return cls.from_tables({grouping: cls.aggregate(df, cls.keys(grouping)) for grouping in cls.groupings})
+
+    @classmethod
+    def build(cls, parquet_file):
+        """Builds the cube from a pyarrow ParquetFile one row group at a time"""
+        partials = {grouping: [] for grouping in cls.groupings}
+        for idx in range(parquet_file.num_row_groups):
+            df = parquet_file.read_row_group(idx, columns=cls.columns).to_pandas()
+            for grouping in cls.groupings:
+                partials[grouping].append(cls.aggregate(df, cls.keys(grouping)))
+        if parquet_file.num_row_groups == 0:
+            return cls.from_frame(pd.DataFrame(columns=cls.columns, dtype=np.float64))
+        return cls.from_tables({grouping: cls.combine(tables) for grouping, tables in partials.items()})
+
+    def save(self, f):
+        np.savez_compressed(f, **self.arrays)
+
+    @classmethod
+    def load(cls, f):
+        return cls(np.load(f))
+
+    def table(self, grouping, items=None):
+        """Returns the table of `grouping` as a DataFrame, only with the rows of `items` if given"""
+        prefix = grouping + '.'
+        names = [name for name in self.arrays.keys() if name.startswith(prefix)]
+        item_ids = self.arrays[prefix + 'Item_ID']
+        if items is None:
+            index = slice(None)
+        else:
+            # Tables are sorted by Item_ID, so each item is a contiguous range
+            items = np.asarray(sorted(items), dtype=item_ids.dtype)
+            starts = np.searchsorted(item_ids, items, side='left')
+            ends = np.searchsorted(item_ids, items, side='right')
+            index = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)] or [np.array([], dtype=np.int64)])
+        return pd.DataFrame({name[len(prefix):]: self.arrays[name][index] for name in names})
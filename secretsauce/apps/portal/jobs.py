@@ -0,0 +1,214 @@
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, connection
+
+from secretsauce.apps.portal.models import Job, TrainedPredictionModel, UploadSession
+from secretsauce.fillet import fillet, FilletError
+
+import pandas as pd
+import inspect, json, requests, threading
+
+# Keyword of the line terminator of DataFrame.to_csv, named line_terminator before pandas 1.5
+CSV_LINE_TERMINATOR = 'lineterminator' if 'lineterminator' in inspect.signature(pd.DataFrame.to_csv).parameters else 'line_terminator'
+
+class JobError(Exception):
+    def __init__(self, message, retry=True):
+        super().__init__(message)
+        self.retry = retry
+
+class OptimizationNotDone(JobError):
+    pass
+
+def check_response(r, path):
+    """Raises JobError unless Fillet answered 200, not to be retried when Fillet rejected the request"""
+    if r.status_code != 200:
+        raise JobError(f'Fillet answered {r.status_code} to {path}', retry=not 400 <= r.status_code < 500)
+
+def post(path, **kwargs):
+    """
+    Posts a job to Fillet. Fillet keeps working on it when the response takes longer
+    than the read timeout, so that counts as submitted.
+    """
+    try:
+        r = fillet.post(path, **kwargs)
+    except requests.exceptions.ReadTimeout:
+        return
+    check_response(r, path)
+
+def train(job):
+    trained_model = job.trained_model
+    payload = {'cv_acc': True, 'project_id': str(trained_model.id), 'modeltype': trained_model.prediction_model.name}
+    post('/train/', data=payload, files={'data': trained_model.data_block.read_parquet_bytes()})
+
+def optimize(job):
+    optimizer = job.optimizer
+    project = optimizer.constraint_block.project
+    constraints = [
+        optimizer.constraint_block.get_list(),
+        project.get_price_bounds(),
+        project.get_cost_list(),
+        not optimizer.cost,
+    ]
+    post('/optimize/', payload={
+        'project_id': str(optimizer.trained_model_id),
+        'optimisation_id': str(optimizer.id),
+        'constraints': constraints,
+        'population': optimizer.population,
+        'max_epoch': optimizer.max_epoch,
+    })
+
+def feature_importance_frame(data):
+    """Feature importances of every model Fillet trained, from /get_feature_importances/"""
+    frames = [
+        pd.DataFrame({
+            'model': model_id,
+            'feature_name': list(obj['feature_name'].values()),
+            'importance': [obj['importance'][idx] for idx in obj['feature_name']],
+        })
+        for model_id, obj in data.items()
+    ]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['model', 'feature_name', 'importance'])
+
+def elasticity_frame(data):
+    """
+    Elasticity estimates from /get_elasticity_estimates/, a mapping of the item whose price changes to
+    the change types to the change of the quantity of every item, as one row per pair of items
+    """
+    frames = {price_change_item: pd.DataFrame(ds) for price_change_item, ds in data.items()}
+    if not frames:
+        return pd.DataFrame(columns=['price_change_item', 'qty_change_item'])
+    df = pd.concat(frames, names=['price_change_item', 'qty_change_item'])
+    return df.reset_index()
+
+def cv_score_frame(data):
+    """Cross-validation results from /get_cv_results/, a JSON encoded mapping of column to values"""
+    return pd.DataFrame(json.loads(data))
+
+results = {
+    'feature_importance': ('/get_feature_importances/', feature_importance_frame),
+    'elasticity': ('/get_elasticity_estimates/', elasticity_frame),
+    'cv_score': ('/get_cv_results/', cv_score_frame),
+}
+
+def fetch_results(job):
+    """Fetches the result files Fillet has computed for a trained model and stores them as CSV"""
+    trained_model = job.trained_model
+    for name in trained_model.get_missing_results():
+        path, to_frame = results[name]
+        r = fillet.post(path, payload={'project_id': str(trained_model.id)})
+        check_response(r, path)
+        data = r.json()
+        if isinstance(data, dict) and 'error' in data:
+            raise JobError(data['error'])
+        csv_file = ContentFile(to_frame(data).to_csv(index=False, **{CSV_LINE_TERMINATOR: '\n'}))
+        field = getattr(trained_model, name)
+        field.save(f'{trained_model.name}_{name}.csv', csv_file, save=False)
+        # Only the file, progress may have been updated meanwhile
+        TrainedPredictionModel.objects.filter(id=trained_model.id).update(**{name: field.name})
+
+def store_optimizer_results(optimizer):
+    """
+    Fetches the prices Fillet found for `optimizer` and stores them as CSV, closing its job.
+    Raises OptimizationNotDone while Fillet is still optimizing.
+    """
+    path = '/get_opti_results/'
+    r = fillet.post(path, {'project_id': str(optimizer.trained_model_id), 'optimisation_id': str(optimizer.id)})
+    check_response(r, path)
+    r_json = r.json()
+    if 'error' in r_json:
+        raise JobError(r_json['error'], retry=False)
+    if 'status' in r_json:
+        raise OptimizationNotDone(r_json['status'])
+    if r_json['success'] == False and r_json['type'] == 2:
+        raise JobError(r_json['info'], retry=False)
+
+    optimizer.estimated_profit = r_json['report'][0]
+    optimizer.estimated_revenue = r_json['report'][1]
+    optimizer.hard_violations = r_json['report'][2]
+    optimizer.soft_violations = r_json['report'][3]
+
+    json_file = json.dumps({
+        'item': {idx: val for idx, val in enumerate(r_json['price_cols'])},
+        'price': {idx: val for idx, val in enumerate(r_json['result'])}
+    })
+    df = pd.read_json(json_file, orient='columns')
+    csv_file = df.to_csv(index=False, **{CSV_LINE_TERMINATOR: '\n'})
+    for i in range(4):
+        csv_file += f"{r_json['report_info'][i]},{r_json['report'][i]}\n"
+
+    cost = 'with-cost' if optimizer.cost else 'without-cost'
+    file_name = f'{optimizer.trained_model.name}_{optimizer.constraint_block.name}_{cost}_results.csv'
+    optimizer.results.save(file_name, ContentFile(csv_file))
+    Job.close_submitted(kind=Job.OPTIMIZE, optimizer=optimizer)
+
+def check_optimizations():
+    """Stores the results of the submitted optimizations Fillet has finished, returns how many"""
+    done = 0
+    for job in Job.objects.filter(kind=Job.OPTIMIZE, state=Job.SUBMITTED).select_related('optimizer__trained_model', 'optimizer__constraint_block'):
+        try:
+            store_optimizer_results(job.optimizer)
+        except (OptimizationNotDone, FilletError):
+            continue
+        except JobError as e:
+            job.fail(e, retry=False)
+        else:
+            done += 1
+    close_old_connections()
+    return done
+
+def ingest(job):
+    """Ingests the DataBlock from the chunked upload it was finalized from, or else verifies its uploaded CSV"""
+    data_block = job.data_block
+    session = UploadSession.objects.filter(data_block=data_block, completed=True).first()
+    if session is not None:
+        data_block.ingest_session(session)
+    else:
+        data_block.ingest_upload()
+
+handlers = {
+    Job.TRAIN: train,
+    Job.OPTIMIZE: optimize,
+    Job.RESULTS: fetch_results,
+    Job.INGEST: ingest,
+}
+
+class Heartbeat(threading.Thread):
+    """Beats for `job` every JOB_HEARTBEAT_INTERVAL seconds until stopped, e.g. through a long ingestion"""
+
+    def __init__(self, job):
+        super().__init__(daemon=True, name=f'heartbeat-{job.id}')
+        self.job = job
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(settings.JOB_HEARTBEAT_INTERVAL):
+                self.job.beat()
+        finally:
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def run_job(job):
+    """Runs a claimed job and records whether it succeeded"""
+    heartbeat = Heartbeat(job)
+    heartbeat.start()
+    try:
+        handlers[job.kind](job)
+    except JobError as e:
+        job.fail(e, retry=e.retry)
+    except FilletError as e:
+        job.fail(e)
+    except Exception as e:
+        job.fail(f'{type(e).__name__}: {e}')
+    else:
+        # Fillet works on trainings and optimizations after accepting them
+        if job.kind in Job.SUBMITTED_KINDS:
+            job.submit()
+        else:
+            job.succeed()
+    finally:
+        heartbeat.stop()
+        close_old_connections()
@@ -0,0 +1,74 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from secretsauce.apps.portal.models import *
+
+import re, uuid
+
+
+class Command(BaseCommand):
+    help = "Runs EXPLAIN on the hot portal queries and reports the ones that scan a whole table"
+
+    # SQLite: 'SCAN TABLE portal_item' or 'SCAN portal_item', index scans say 'USING ... INDEX'
+    sqlite_scan = re.compile(r'\bSCAN (?:TABLE )?(\w+)(?!.*\bINDEX\b)')
+    postgres_scan = re.compile(r'Seq Scan on (\w+)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--strict', action='store_true', help="Exit with an error if any query scans a whole table")
+        parser.add_argument('--verbose-plans', action='store_true', help="Print the full plan of every query")
+
+    def get_queries(self):
+        """Querysets of the portal's hot query shapes, with placeholder ids"""
+        project, data_block, constraint_block, trained_model = (uuid.uuid4() for _ in range(4))
+        constraint_block_list = ConstraintBlock(id=constraint_block)
+        return {
+            'DataBlocks of a project': DataBlock.objects.filter(project=project).order_by('-created', '-id'),
+            'ConstraintBlocks of a project': ConstraintBlock.objects.filter(project=project),
+            'Constraints of a block': Constraint.objects.filter(constraint_block=constraint_block).order_by('-created', '-id'),
+            'ConstraintBlock.get_list': constraint_block_list.constraints.order_by('created', 'id').values_list(
+                'id', 'constraint_relationships__constraint_parameter__item_id', 'constraint_relationships__coefficient'),
+            'Item of a project by item_id': Item.objects.filter(project=project, item_id=1),
+            'Items of a project': Item.objects.filter(project=project),
+            'Schema of a DataBlock': DataBlockHeader.objects.filter(data_block=data_block),
+            'DataBlockHeader by item_id': DataBlockHeader.objects.filter(data_block=data_block, item_id=1),
+            'TrainedPredictionModels of a DataBlock': TrainedPredictionModel.objects.filter(data_block=data_block).order_by('-created', '-id'),
+            'Optimizers of a project': Optimizer.objects.filter(trained_model__data_block__project=project).order_by('-created', '-id'),
+            'Optimizers of a trained model': Optimizer.objects.filter(trained_model=trained_model),
+            'Due jobs': Job.objects.filter(state=Job.QUEUED, run_after__lte='2020-01-01').order_by('run_after', 'created'),
+            'Jobs of a project': Job.objects.filter(project=project).order_by('-created', '-id'),
+            'Progress events of a project after a version': ProgressEvent.objects.filter(project=project, id__gt=1).order_by('id'),
+            'Projects owned by a user': Project.owners.through.objects.filter(user_id=1).values_list('project_id', flat=True),
+        }
+
+    def explain(self, queryset):
+        if connection.vendor == 'postgresql':
+            # Tables of a development database are small enough for the planner to prefer
+            # sequential scans, only report the ones it cannot avoid
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                return queryset.explain()
+        return queryset.explain()
+
+    def find_scans(self, plan):
+        pattern = self.postgres_scan if connection.vendor == 'postgresql' else self.sqlite_scan
+        return sorted({match.group(1) for line in plan.splitlines() for match in [pattern.search(line)] if match})
+
+    def handle(self, *args, **options):
+        if connection.vendor not in ('sqlite', 'postgresql'):
+            raise CommandError(f'EXPLAIN output of {connection.vendor} is not supported')
+
+        scanning = []
+        for name, queryset in self.get_queries().items():
+            plan = self.explain(queryset)
+            tables = self.find_scans(plan)
+            if tables:
+                scanning.append(name)
+                self.stdout.write(self.style.WARNING(f'{name}: sequential scan of {", ".join(tables)}'))
+            else:
+                self.stdout.write(f'{name}: OK')
+            if options['verbose_plans'] or tables:
+                self.stdout.write('    ' + plan.replace('\n', '\n    '))
+
+        if scanning and options['strict']:
+            raise CommandError(f'{len(scanning)} queries scan a whole table')
+        if not scanning:
+            self.stdout.write(self.style.SUCCESS('No sequential scans'))
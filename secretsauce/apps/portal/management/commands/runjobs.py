@@ -0,0 +1,46 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from secretsauce.apps.portal.jobs import check_optimizations, run_job
+from secretsauce.apps.portal.models import Job, ProgressEvent, UploadSession
+
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+
+class Command(BaseCommand):
+    help = "Runs queued Fillet jobs with a bounded pool of worker threads"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.JOB_WORKERS, help="Jobs run at the same time")
+        parser.add_argument('--interval', type=float, default=settings.JOB_POLL_INTERVAL, help="Seconds to wait when no job is due")
+        parser.add_argument('--once', action='store_true', help="Exit once no job is due or running")
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        running = set()
+        pruned = 0
+        checked = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                running = {future for future in running if not future.done()}
+                if time.monotonic() - pruned > 60:
+                    ProgressEvent.prune()
+                    UploadSession.expire()
+                    pruned = time.monotonic()
+                if time.monotonic() - checked > settings.JOB_CHECK_INTERVAL:
+                    check_optimizations()
+                    expired = Job.expire_submitted()
+                    if expired:
+                        self.stderr.write(f'Failed {expired} jobs Fillet did not report finished')
+                    checked = time.monotonic()
+                stale = Job.requeue_stale()
+                if stale:
+                    self.stderr.write(f'Requeued {stale} stale jobs')
+                jobs = Job.claim(workers - len(running))
+                for job in jobs:
+                    self.stdout.write(f'Running {job.kind} job {job.id}, attempt {job.attempts}')
+                    running.add(pool.submit(run_job, job))
+                if options['once'] and not jobs and not running:
+                    break
+                if not jobs:
+                    time.sleep(options['interval'])
@@ -0,0 +1,19 @@
+# Generated by Django 3.0.6 on 2026-10-18 14:19
+
+from django.db import migrations, models
+import secretsauce.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portal', '0019_auto_20200730_2135'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datablock',
+            name='parquet',
+            field=models.FileField(blank=True, upload_to=secretsauce.utils.obfuscate_upload_link),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.0.6 on 2026-10-18 14:23
+
+from django.db import migrations, models
+import secretsauce.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portal', '0020_datablock_parquet'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datablock',
+            name='cube',
+            field=models.FileField(blank=True, upload_to=secretsauce.utils.obfuscate_upload_link),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.0.6 on 2026-10-18 14:40
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portal', '0021_datablock_cube'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datablock',
+            name='checksum',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='datablock',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.0.6 on 2026-10-18 14:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+import secretsauce.utils
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portal', '0022_datablock_checksum_created'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('datablock', 'DataBlock'), ('costsheet', 'Cost sheet')], max_length=9)),
+                ('name', models.CharField(blank=True, max_length=200)),
+                ('upload', models.FileField(blank=True, upload_to=secretsauce.utils.obfuscate_upload_link)),
+                ('received', models.BigIntegerField(default=0)),
+                ('next_chunk', models.IntegerField(default=0)),
+                ('state', models.TextField(blank=True)),
+                ('completed', models.BooleanField(default=False)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('data_block', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='portal.DataBlock')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to='portal.Project')),
+            ],
+        ),
+    ]
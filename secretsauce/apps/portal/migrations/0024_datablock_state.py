@@ -0,0 +1,28 @@
+# Generated by Django 3.0.6 on 2026-10-18 14:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portal', '0023_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datablock',
+            name='errors',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='datablock',
+            name='pct_complete',
+            field=models.FloatField(default=100),
+        ),
+        migrations.AddField(
+            model_name='datablock',
+            name='state',
+            field=models.CharField(choices=[('ingesting', 'Ingesting'), ('ready', 'Ready'), ('failed', 'Failed')], default='ready', max_length=9),
+        ),
+    ]
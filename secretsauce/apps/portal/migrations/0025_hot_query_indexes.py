@@ -0,0 +1,33 @@
+# Generated by Django 3.0.6 on 2026-10-18 14:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portal', '0024_datablock_state'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='constraint',
+            index=models.Index(fields=['constraint_block', '-created', '-id'], name='constraint_block_created'),
+        ),
+        migrations.AddIndex(
+            model_name='constraintparameterrelationship',
+            index=models.Index(fields=['constraint', 'constraint_parameter', 'coefficient'], name='relationship_terms'),
+        ),
+        migrations.AddIndex(
+            model_name='datablock',
+            index=models.Index(fields=['project', '-created', '-id'], name='datablock_project_created'),
+        ),
+        migrations.AddIndex(
+            model_name='optimizer',
+            index=models.Index(fields=['trained_model', '-created', '-id'], name='optimizer_model_created'),
+        ),
+        migrations.AddIndex(
+            model_name='trainedpredictionmodel',
+            index=models.Index(fields=['data_block', '-created', '-id'], name='trainedmodel_block_created'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.0.6 on 2026-10-18 14:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portal', '0026_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProgressEvent',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('trained_model', 'TrainedPredictionModel'), ('optimizer', 'Optimizer')], max_length=13)),
+                ('object_id', models.UUIDField()),
+                ('fields', models.TextField()),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='progress_events', to='portal.Project')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='progressevent',
+            index=models.Index(fields=['project', 'id'], name='progressevent_project_id'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.6 on 2026-10-18 14:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portal', '0027_progressevent'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='job',
+            name='kind',
+            field=models.CharField(choices=[('train', 'Train'), ('optimize', 'Optimize'), ('results', 'Fetch results')], max_length=8),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.6 on 2026-10-18 15:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portal', '0028_job_results'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='job',
+            name='state',
+            field=models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('submitted', 'Submitted'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='queued', max_length=9),
+        ),
+    ]
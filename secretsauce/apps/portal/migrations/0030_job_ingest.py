@@ -0,0 +1,29 @@
+# Generated by Django 3.0.6 on 2026-10-18 15:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portal', '0029_job_submitted'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='data_block',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='portal.DataBlock'),
+        ),
+        migrations.AlterField(
+            model_name='job',
+            name='kind',
+            field=models.CharField(choices=[('train', 'Train'), ('optimize', 'Optimize'), ('results', 'Fetch results'), ('ingest', 'Ingest DataBlock')], max_length=8),
+        ),
+        migrations.AlterField(
+            model_name='progressevent',
+            name='kind',
+            field=models.CharField(choices=[('trained_model', 'TrainedPredictionModel'), ('optimizer', 'Optimizer'), ('data_block', 'DataBlock')], max_length=13),
+        ),
+    ]
@@ -1,10 +1,23 @@
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Count, F, Max, Min
 from django.core.validators import MinValueValidator
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import default_storage
+from django.db.models.signals import post_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework.exceptions import APIException
 
 from secretsauce.apps.account.models import User, Company
-from secretsauce.utils import obfuscate_upload_link, obfuscate_results_link
+from secretsauce.apps.portal.cache import invalidate_data_block, invalidate_owned_projects
+from secretsauce.apps.portal.cube import AggregateCube
+from secretsauce.utils import obfuscate_upload_link, obfuscate_results_link, file_checksum, sort_parquet, run_in_background, UploadVerifier, CostSheetVerifier
 
-import uuid
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import bisect, datetime, io, json, os, tempfile, uuid
 
 class Project(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -69,7 +82,28 @@ class ModelTag(models.Model):
     def __str__(self):
         return self.name
 
+@receiver(m2m_changed, sender=Project.owners.through)
+def invalidate_owned_projects_cache(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        # `instance` is the User whose projects changed
+        invalidate_owned_projects([instance.pk])
+    elif action == 'pre_clear':
+        invalidate_owned_projects(instance.owners.values_list('id', flat=True))
+    else:
+        invalidate_owned_projects(pk_set)
+
 class DataBlock(models.Model):
+    INGESTING = 'ingesting'
+    READY = 'ready'
+    FAILED = 'failed'
+    STATE_CHOICES = [
+        (INGESTING, 'Ingesting'),
+        (READY, 'Ready'),
+        (FAILED, 'Failed'),
+    ]
+
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     project = models.ForeignKey(
         Project, 
@@ -78,13 +112,184 @@ class DataBlock(models.Model):
     )
     name = models.CharField(max_length=200)
     upload = models.FileField(upload_to=obfuscate_upload_link)
+    parquet = models.FileField(upload_to=obfuscate_upload_link, blank=True)
+    cube = models.FileField(upload_to=obfuscate_upload_link, blank=True)
+    checksum = models.CharField(max_length=64, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    state = models.CharField(max_length=9, choices=STATE_CHOICES, default=READY)
+    pct_complete = models.FloatField(default=100)
+    # ErrorCollector.summary() of the cell errors, with the reason ingestion failed if it did, as JSON
+    errors = models.TextField(blank=True)
 
     class Meta:
         unique_together = ('project', 'name')
+        indexes = [
+            # DataBlockList, newest first
+            models.Index(fields=['project', '-created', '-id'], name='datablock_project_created'),
+        ]
 
     def __str__(self):
         return f'DataBlock: {self.name}' 
 
+    def read_frame(self, columns=None, items=None):
+        """
+        Returns the DataBlock as a DataFrame, only with `columns` and the rows of `items` if given.
+        Reads the typed Parquet copy written at upload, or the original CSV for DataBlocks without one.
+
+        The Parquet copy is sorted by Item_ID, so when `items` is given only the row groups
+        whose Item_ID range contains one of them are read.
+        """
+        if self.parquet:
+            with self.parquet.open('rb') as f:
+                parquet_file = pq.ParquetFile(f)
+                if items is None:
+                    return parquet_file.read(columns=columns).to_pandas()
+                read_columns = columns if columns is None or 'Item_ID' in columns else columns + ['Item_ID']
+                row_groups = self.row_groups_for(parquet_file, items)
+                df = parquet_file.read_row_groups(row_groups, columns=read_columns).to_pandas()
+        else:
+            with self.upload.open('rb') as f:
+                read_columns = columns if columns is None or items is None or 'Item_ID' in columns else columns + ['Item_ID']
+                df = pd.read_csv(f, encoding='utf-8', usecols=read_columns)
+            if items is None:
+                return df
+        df = df[df['Item_ID'].isin(items)]
+        return df if columns is None else df[columns]
+
+    def ingest(self, item_ids, parquet_sources, parquet_name):
+        """
+        Stores the verified rows written to the Parquet files `parquet_sources`
+        as the Parquet copy sorted by Item_ID, and the schema from `item_ids`.
+        """
+        with tempfile.TemporaryFile() as parquet_file:
+            sort_parquet(parquet_sources, parquet_file, 'Item_ID')
+            self.parquet.save(parquet_name, File(parquet_file), save=False)
+        DataBlock.objects.filter(pk=self.pk).update(parquet=self.parquet.name)
+        # Left by an attempt that was interrupted
+        DataBlockHeader.objects.filter(data_block=self).delete()
+        header_objects = [DataBlockHeader(data_block=self, item_id=item_id) for item_id in item_ids]
+        DataBlockHeader.objects.bulk_create(header_objects)
+
+    def ingest_upload(self):
+        """
+        Verifies the uploaded CSV and ingests it, reporting progress in `pct_complete`.
+        Ends in the READY state, or FAILED with the reason in `errors` if the file can not be read.
+        The aggregate cube is built in the background once READY. Other errors are raised for the INGEST job to retry, see Job.fail.
+        Only updates the fields it sets, so a DataBlock deleted meanwhile is not saved again.
+        """
+        data_blocks = DataBlock.objects.filter(pk=self.pk)
+        data_blocks.update(state=self.INGESTING, pct_complete=0)
+        verifier = UploadVerifier(max_error_rate=settings.UPLOAD_MAX_ERROR_RATE)
+        try:
+            with self.upload.open('rb') as upload, tempfile.TemporaryFile() as parquet_file:
+                verifier.parquet = parquet_file
+                size, done, pct_complete = max(upload.size, 1), 0, 0
+                for chunk in upload.chunks(verifier.chunk_size):
+                    verifier.feed(chunk)
+                    done += len(chunk)
+                    # The last percent is left for sorting the Parquet copy
+                    if int(99 * done / size) > pct_complete:
+                        pct_complete = int(99 * done / size)
+                        data_blocks.update(pct_complete=pct_complete)
+                verifier.close()
+                parquet_file.seek(0)
+                self.ingest(verifier.get_schema(), [parquet_file], self.parquet_name())
+        except APIException as e:
+            data_blocks.update(state=self.FAILED, errors=json.dumps({'detail': str(e.detail), **verifier.errors.summary()}))
+            return
+        data_blocks.update(state=self.READY, pct_complete=100, checksum=verifier.checksum, errors=json.dumps(verifier.errors.summary()))
+        run_in_background(self.build_cube)
+
+    def ingest_session(self, session):
+        """
+        Ingests the Parquet parts verified while the chunks of `session` were received,
+        then deletes them and ends in the READY state. The aggregate cube is built in the background.
+        The checksum is computed from the assembled upload, as the chunks were hashed in separate requests.
+        """
+        with self.upload.open('rb') as upload:
+            checksum = file_checksum(upload)
+        parts = [default_storage.open(name, 'rb') for name in session.parts]
+        try:
+            self.ingest(session.get_verifier().get_schema(), parts, self.parquet_name())
+        finally:
+            for part in parts:
+                part.close()
+        for name in session.parts:
+            default_storage.delete(name)
+        UploadSession.objects.filter(pk=session.pk).update(state='')
+        DataBlock.objects.filter(pk=self.pk).update(state=self.READY, pct_complete=100, checksum=checksum)
+        run_in_background(self.build_cube)
+
+    def parquet_name(self):
+        return os.path.splitext(os.path.basename(self.upload.name))[0] + '.parquet'
+
+    def get_errors(self):
+        return json.loads(self.errors) if self.errors else {}
+
+    def build_cube(self):
+        """
+        Aggregates the Parquet copy into an AggregateCube and saves it. A failure is recorded as
+        `cube` in `errors`, aggregates are then computed from the rows on every request.
+        """
+        try:
+            with self.parquet.open('rb') as f:
+                cube = AggregateCube.build(pq.ParquetFile(f))
+            buf = io.BytesIO()
+            cube.save(buf)
+            self.cube.save(f'{self.name}_cube.npz', ContentFile(buf.getvalue()), save=False)
+        except Exception:
+            errors = DataBlock.objects.filter(pk=self.pk).values_list('errors', flat=True).first()
+            if errors is not None:
+                errors = {**(json.loads(errors) if errors else {}), 'cube': 'Aggregating the DataBlock failed'}
+                DataBlock.objects.filter(pk=self.pk).update(errors=json.dumps(errors))
+            raise
+        DataBlock.objects.filter(pk=self.pk).update(cube=self.cube.name)
+
+    def aggregates(self, grouping, items=None):
+        """
+        Returns the AggregateCube table of `grouping`, only with the rows of `items` if given.
+        Answers from the saved cube, or aggregates the rows on the fly while it is not built yet.
+        """
+        if self.cube:
+            with self.cube.open('rb') as f:
+                return AggregateCube.load(f).table(grouping, items)
+        df = self.read_frame(columns=AggregateCube.columns, items=items)
+        return AggregateCube.from_frame(df).table(grouping)
+
+    @staticmethod
+    def row_groups_for(parquet_file, items):
+        """Returns the indices of the row groups whose Item_ID statistics may contain one of `items`"""
+        column = parquet_file.schema_arrow.get_field_index('Item_ID')
+        items = sorted(items)
+        row_groups = []
+        for idx in range(parquet_file.num_row_groups):
+            statistics = parquet_file.metadata.row_group(idx).column(column).statistics
+            if statistics is None or not statistics.has_min_max:
+                row_groups.append(idx)
+                continue
+            # First item not below the row group minimum, it must not exceed the maximum
+            position = bisect.bisect_left(items, statistics.min)
+            if position < len(items) and items[position] <= statistics.max:
+                row_groups.append(idx)
+        return row_groups
+
+    def read_parquet_bytes(self):
+        """
+        Returns the DataBlock serialized as Parquet. The Parquet copy is sorted by Item_ID,
+        the rows of every item keep the order of the upload, e.g. by week.
+        """
+        if self.parquet:
+            with self.parquet.open('rb') as f:
+                return f.read()
+        buf = pa.BufferOutputStream()
+        pq.write_table(pa.Table.from_pandas(self.read_frame()), buf)
+        return buf.getvalue()
+
+@receiver(post_delete, sender=DataBlock)
+def invalidate_data_block_cache(sender, instance, **kwargs):
+    invalidate_data_block(instance.id)
+
 class ConstraintBlock(models.Model):
     """A set of constraints"""
     EQUALITY_CODES = {
@@ -110,21 +315,33 @@ class ConstraintBlock(models.Model):
         return f'ConstraintBlock: {self.name}'
 
     def get_list(self):
-        constraint_list = list()
-        if len(self.constraints.all()) == 0:
-            return constraint_list
-        for constraint in self.constraints.all():
-            entry = dict()
-            entry['products'] = list()
-            entry['scales'] = list()
-            for relationship in constraint.constraint_relationships.all():
-                entry['products'].append(relationship.constraint_parameter.item_id)
-                entry['scales'].append(relationship.coefficient)
-            entry['penalty'] = constraint.penalty
-            entry['equality'] = self.EQUALITY_CODES[constraint.in_equality]
-            entry['shift'] = constraint.rhs_constant
-            constraint_list.append(entry)
-        return constraint_list
+        """
+        Returns the constraints in the format used by Fillet, read with a single query
+        joining each Constraint with its ConstraintParameterRelationships and ConstraintParameters
+        """
+        rows = self.constraints.order_by('created', 'id').values_list(
+            'id',
+            'penalty',
+            'in_equality',
+            'rhs_constant',
+            'constraint_relationships__constraint_parameter__item_id',
+            'constraint_relationships__coefficient',
+        )
+        entries = dict()
+        for constraint_id, penalty, in_equality, rhs_constant, item_id, coefficient in rows:
+            if constraint_id not in entries:
+                entries[constraint_id] = {
+                    'products': list(),
+                    'scales': list(),
+                    'penalty': penalty,
+                    'equality': self.EQUALITY_CODES[in_equality],
+                    'shift': rhs_constant,
+                }
+            # Constraints without relationships come with a single row of NULLs
+            if item_id is not None:
+                entries[constraint_id]['products'].append(item_id)
+                entries[constraint_id]['scales'].append(coefficient)
+        return list(entries.values())
 
 class ConstraintCategory(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -163,39 +380,44 @@ class Constraint(models.Model):
 
     class Meta:
         unique_together = ('constraint_block', 'name')
+        indexes = [
+            # ConstraintListAndCreate and ConstraintBlock.get_list, in creation order
+            models.Index(fields=['constraint_block', '-created', '-id'], name='constraint_block_created'),
+        ]
 
     @property
     def equation(self):
-        if len(self.constraint_relationships.all()) == 0:
-            return
-
-        eq = ""
-        for relation in self.constraint_relationships.all():
-            item_id = relation.constraint_parameter.item_id
-            coeff = relation.coefficient
-            if len(eq) > 0 and coeff > 0:
-                eq += "+"
-            eq += str(coeff) + "*" + "[" + str(item_id) + "]"
-
-        return eq + self.format_in_equality + str(self.rhs_constant)
+        return self.format_equation(self.get_terms())
     
     @property 
     def equation_name(self):
-        if len(self.constraint_relationships.all()) == 0:
+        terms = self.get_terms()
+        item_ids = [item_id for item_id, coeff in terms]
+        item_names = dict(self.constraint_block.project.items.filter(item_id__in=item_ids).values_list('item_id', 'name'))
+        return self.format_equation(terms, item_names)
+
+    def get_terms(self):
+        return list(self.constraint_relationships.values_list('constraint_parameter__item_id', 'coefficient'))
+
+    def format_equation(self, terms, item_names=None):
+        """
+        Returns the constraint as text from its (item_id, coefficient) terms, with the items
+        named from `item_names` if given. Returns None if there are no terms or an item has no name.
+        """
+        if len(terms) == 0:
             return
 
         eq = ""
-        for relation in self.constraint_relationships.all():
-            item_id = relation.constraint_parameter.item_id
-            try:
-                item_name = self.constraint_block.project.items.all().get(item_id=item_id).name
-            except Item.DoesNotExist:
-                return  
+        for item_id, coeff in terms:
+            label = item_id
+            if item_names is not None:
+                if item_id not in item_names:
+                    return
+                label = item_names[item_id]
 
-            coeff = relation.coefficient
             if len(eq) > 0 and coeff > 0:
                 eq += "+"
-            eq += str(coeff) + "*" + "[" + str(item_name) + "]"
+            eq += str(coeff) + "*" + "[" + str(label) + "]"
 
         return eq + self.format_in_equality + str(self.rhs_constant)
 
@@ -254,6 +476,12 @@ class ConstraintParameterRelationship(models.Model):
     )
     coefficient = models.FloatField()
 
+    class Meta:
+        indexes = [
+            # Covers the terms read by ConstraintBlock.get_list and the constraint list serializer
+            models.Index(fields=['constraint', 'constraint_parameter', 'coefficient'], name='relationship_terms'),
+        ]
+
 class DataBlockHeader(models.Model):
     data_block = models.ForeignKey(
         DataBlock,
@@ -316,9 +544,70 @@ class TrainedPredictionModel(models.Model):
     ee_done = models.BooleanField(default=False)
     elasticity = models.FileField(upload_to=obfuscate_results_link, blank=True)
 
+    class Meta:
+        indexes = [
+            # TrainModel lists, by data block of a project
+            models.Index(fields=['data_block', '-created', '-id'], name='trainedmodel_block_created'),
+        ]
+
     def __str__(self):
         return f'TrainedPredictionModel: {name}'
 
+    progress_fields = ['pct_complete', 'cv_progress', 'fi_done', 'ee_done']
+
+    def is_finished(self):
+        """Whether Fillet is done with the training, cross-validation, feature importance and elasticities"""
+        return self.pct_complete == 100 and self.cv_progress == 100 and self.fi_done and self.ee_done
+
+    def get_missing_results(self):
+        """Names of the result files Fillet has computed but that were not fetched yet"""
+        if self.pct_complete != 100:
+            return []
+        done = {'feature_importance': self.fi_done, 'elasticity': self.ee_done, 'cv_score': self.cv_progress == 100}
+        return [name for name, is_done in done.items() if is_done and not getattr(self, name)]
+
+    @classmethod
+    def apply_progress(cls, progress):
+        """
+        Saves the progress of the models in `progress`, a mapping of id to a dict of
+        `progress_fields`, with bulk UPDATEs. Returns the number of models that changed
+        and the ids that are not known.
+        """
+        ids = dict()
+        for key in progress:
+            try:
+                ids[key] = uuid.UUID(str(key))
+            except ValueError:
+                pass
+        trained_models = cls.objects.select_related('data_block__project').in_bulk(list(ids.values()))
+        changed, unknown, events = [], [], []
+        for key, values in progress.items():
+            trained_model = trained_models.get(ids.get(key))
+            if trained_model is None:
+                unknown.append(key)
+                continue
+            # Fillet reports models it has not started training as a string
+            if not isinstance(values, dict):
+                continue
+            values = {field: cls._meta.get_field(field).to_python(values[field]) for field in cls.progress_fields if values.get(field) is not None}
+            values = {field: value for field, value in values.items() if getattr(trained_model, field) != value}
+            if values:
+                for field, value in values.items():
+                    setattr(trained_model, field, value)
+                changed.append(trained_model)
+                events.append(ProgressEvent(project_id=trained_model.data_block.project_id, kind=ProgressEvent.TRAINED_MODEL, object_id=trained_model.id, fields=json.dumps(values)))
+        with transaction.atomic():
+            cls.objects.bulk_update(changed, cls.progress_fields, batch_size=500)
+            ProgressEvent.objects.bulk_create(events, batch_size=500)
+        finished = [trained_model for trained_model in changed if trained_model.is_finished()]
+        if finished:
+            Job.close_submitted(kind=Job.TRAIN, trained_model__in=finished)
+        # Fetch the results that became available before anyone asks for them
+        for trained_model in changed:
+            if trained_model.get_missing_results():
+                Job.enqueue_once(Job.RESULTS, trained_model.data_block.project, trained_model=trained_model)
+        return len(changed), unknown
+
 class Optimizer(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     created = models.DateTimeField(auto_now_add=True)
@@ -335,3 +624,378 @@ class Optimizer(models.Model):
     max_epoch = models.IntegerField(default=100, validators=[MinValueValidator(0)])
     cost = models.BooleanField(default=False) # if True, use costs
     results = models.FileField(upload_to=obfuscate_results_link, blank=True)
+
+    class Meta:
+        indexes = [
+            # OptimizerListCreate, joined from the project through trained_model and data_block
+            models.Index(fields=['trained_model', '-created', '-id'], name='optimizer_model_created'),
+        ]
+
+class Job(models.Model):
+    """
+    A call to Fillet, or the ingestion of an uploaded DataBlock, made by the `runjobs` worker
+    command instead of the request thread.
+
+    Jobs are claimed by flipping QUEUED to RUNNING with a conditional UPDATE, so several
+    workers can share the table. A failed attempt is queued again after an exponential
+    backoff until JOB_MAX_ATTEMPTS attempts were made, attempts Fillet rejected are not retried.
+
+    Trainings and optimizations go on in Fillet once it accepted them, so their jobs stay
+    SUBMITTED until Fillet reports them finished, and count towards JOBS_PER_TENANT until then.
+    """
+
+    TRAIN = 'train'
+    OPTIMIZE = 'optimize'
+    RESULTS = 'results'
+    INGEST = 'ingest'
+    KIND_CHOICES = [
+        (TRAIN, 'Train'),
+        (OPTIMIZE, 'Optimize'),
+        (RESULTS, 'Fetch results'),
+        (INGEST, 'Ingest DataBlock'),
+    ]
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUBMITTED = 'submitted'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATE_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUBMITTED, 'Submitted'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    ]
+
+    # Kinds of the jobs starting work in Fillet, and the states in which they count towards JOBS_PER_TENANT.
+    # Fetching results is quick and not held back by long trainings, ingestion does not call Fillet.
+    CAPPED_KINDS = [TRAIN, OPTIMIZE]
+    OUTSTANDING = [RUNNING, SUBMITTED]
+    # Kinds of the jobs whose work goes on in Fillet after it accepted them
+    SUBMITTED_KINDS = [TRAIN, OPTIMIZE]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kind = models.CharField(max_length=8, choices=KIND_CHOICES)
+    state = models.CharField(max_length=9, choices=STATE_CHOICES, default=QUEUED)
+    project = models.ForeignKey(
+        Project,
+        on_delete=models.CASCADE,
+        related_name='jobs',
+    )
+    # Tenant the JOBS_PER_TENANT cap applies to, the company of the project
+    company = models.ForeignKey(
+        Company,
+        on_delete=models.CASCADE,
+    )
+    trained_model = models.ForeignKey(
+        TrainedPredictionModel,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='jobs',
+    )
+    optimizer = models.ForeignKey(
+        Optimizer,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='jobs',
+    )
+    data_block = models.ForeignKey(
+        DataBlock,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='jobs',
+    )
+    attempts = models.IntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Job.claim, the queued jobs that are due
+            models.Index(fields=['state', 'run_after'], name='job_state_run_after'),
+            models.Index(fields=['project', '-created', '-id'], name='job_project_created'),
+        ]
+
+    def __str__(self):
+        return f'Job: {self.kind} ({self.state})'
+
+    @classmethod
+    def enqueue(cls, kind, project, **targets):
+        return cls.objects.create(kind=kind, project=project, company_id=project.company_id, **targets)
+
+    @classmethod
+    def enqueue_once(cls, kind, project, **targets):
+        """Enqueues a job unless the same job is already queued or running"""
+        job = cls.objects.filter(kind=kind, state__in=[cls.QUEUED, cls.RUNNING], **targets).first()
+        return job or cls.enqueue(kind, project, **targets)
+
+    @classmethod
+    def claim(cls, limit, per_tenant=None):
+        """
+        Marks up to `limit` due jobs RUNNING and returns them, leaving the trainings and optimizations
+        of companies that already have `per_tenant` outstanding ones queued
+        """
+        per_tenant = per_tenant or settings.JOBS_PER_TENANT
+        now = timezone.now()
+        outstanding = cls.objects.filter(kind__in=cls.CAPPED_KINDS, state__in=cls.OUTSTANDING).values('company')
+        full = outstanding.annotate(outstanding=Count('id')).filter(outstanding__gte=per_tenant).values('company')
+        counts = dict(outstanding.annotate(outstanding=Count('id')).values_list('company', 'outstanding'))
+        claimed = []
+        if limit <= 0:
+            return claimed
+        for job in cls.objects.filter(state=cls.QUEUED, run_after__lte=now).order_by('run_after', 'created').iterator():
+            if job.kind not in cls.CAPPED_KINDS:
+                updated = cls.objects.filter(id=job.id, state=cls.QUEUED).update(state=cls.RUNNING, started=now, attempts=F('attempts') + 1)
+            elif counts.get(job.company_id, 0) >= per_tenant:
+                continue
+            else:
+                with transaction.atomic():
+                    # Other workers may have claimed jobs since the counts were read. Their claims of
+                    # the company wait for its row lock where rows can be locked, SQLite runs the
+                    # UPDATE alone, so the cap is checked again in the UPDATE itself.
+                    list(Company.objects.select_for_update().filter(id=job.company_id).values_list('id'))
+                    updated = cls.objects.filter(id=job.id, state=cls.QUEUED).exclude(company__in=full).update(
+                        state=cls.RUNNING, started=now, attempts=F('attempts') + 1)
+                if updated:
+                    counts[job.company_id] = counts.get(job.company_id, 0) + 1
+            if updated:
+                job.state, job.started, job.attempts = cls.RUNNING, now, job.attempts + 1
+                claimed.append(job)
+                if len(claimed) == limit:
+                    break
+        ProgressEvent.objects.bulk_create([job.get_event() for job in claimed])
+        return claimed
+
+    @classmethod
+    def requeue_stale(cls, timeout=None):
+        """Retries the RUNNING jobs without a heartbeat for over `timeout` seconds, as their worker was stopped"""
+        timeout = timeout or settings.JOB_TIMEOUT
+        stale = cls.objects.filter(state=cls.RUNNING, started__lt=timezone.now() - datetime.timedelta(seconds=timeout))
+        for job in stale:
+            job.fail('Timed out')
+        return len(stale)
+
+    @classmethod
+    def close_submitted(cls, **targets):
+        """Marks the SUBMITTED jobs of `targets` SUCCEEDED, once Fillet reports their work finished"""
+        jobs = list(cls.objects.filter(state=cls.SUBMITTED, **targets))
+        for job in jobs:
+            job.succeed()
+        return len(jobs)
+
+    @classmethod
+    def expire_submitted(cls, timeout=None):
+        """Fails the jobs Fillet has not reported finished for over `timeout` seconds, so they stop counting"""
+        timeout = timeout or settings.JOB_SUBMITTED_TIMEOUT
+        expired = cls.objects.filter(state=cls.SUBMITTED, started__lt=timezone.now() - datetime.timedelta(seconds=timeout))
+        for job in expired:
+            job.fail('Fillet did not report the job finished', retry=False)
+        return len(expired)
+
+    def beat(self):
+        """Moves `started` of the running job to now, so requeue_stale leaves it to its worker"""
+        return Job.objects.filter(id=self.id, state=self.RUNNING).update(started=timezone.now())
+
+    def submit(self):
+        self.state = self.SUBMITTED
+        self.error = ''
+        Job.objects.filter(id=self.id).update(state=self.state, error=self.error)
+        self.get_event().save()
+
+    def succeed(self):
+        self.state = self.SUCCEEDED
+        self.finished = timezone.now()
+        self.error = ''
+        Job.objects.filter(id=self.id).update(state=self.state, finished=self.finished, error=self.error)
+        self.get_event().save()
+
+    def fail(self, error, retry=True):
+        """Queues the job again after a backoff, or marks it FAILED once it used up its attempts or if not `retry`"""
+        now = timezone.now()
+        self.error = str(error)
+        if not retry or self.attempts >= settings.JOB_MAX_ATTEMPTS:
+            self.state = self.FAILED
+            self.finished = now
+        else:
+            self.state = self.QUEUED
+            self.run_after = now + datetime.timedelta(seconds=settings.JOB_RETRY_BACKOFF * 2 ** (self.attempts - 1))
+        Job.objects.filter(id=self.id).update(state=self.state, finished=self.finished, run_after=self.run_after, error=self.error)
+        if self.state == self.FAILED and self.kind == self.INGEST:
+            # Unless another attempt has ingested it meanwhile
+            DataBlock.objects.filter(id=self.data_block_id, state=DataBlock.INGESTING).update(state=DataBlock.FAILED, errors=json.dumps({'detail': 'Ingestion failed'}))
+        self.get_event().save()
+
+    def get_event(self):
+        """
+        ProgressEvent of the current state of the job, as the `job` field of the model it trains, the
+        optimizer it runs or the DataBlock it ingests, or as the `results` field of the model whose
+        results it fetches
+        """
+        if self.kind == self.OPTIMIZE:
+            kind, object_id = ProgressEvent.OPTIMIZER, self.optimizer_id
+        elif self.kind == self.INGEST:
+            kind, object_id = ProgressEvent.DATA_BLOCK, self.data_block_id
+        else:
+            kind, object_id = ProgressEvent.TRAINED_MODEL, self.trained_model_id
+        field = 'results' if self.kind == self.RESULTS else 'job'
+        return ProgressEvent(project_id=self.project_id, kind=kind, object_id=object_id, fields=json.dumps({field: self.state}))
+
+class ProgressEvent(models.Model):
+    """
+    Fields of a TrainedPredictionModel, Optimizer or DataBlock that changed, for ProgressStream.
+    Ids increase with every change, so the id of the last event a client saw is the
+    version it asks for changes since.
+
+    Ids are assigned when an event is inserted, not when its transaction commits. An event
+    committed after one with a higher id was already read is missed by clients that moved
+    past it, until they ask for a snapshot again.
+    """
+
+    TRAINED_MODEL = 'trained_model'
+    OPTIMIZER = 'optimizer'
+    DATA_BLOCK = 'data_block'
+    KIND_CHOICES = [
+        (TRAINED_MODEL, 'TrainedPredictionModel'),
+        (OPTIMIZER, 'Optimizer'),
+        (DATA_BLOCK, 'DataBlock'),
+    ]
+
+    id = models.BigAutoField(primary_key=True)
+    project = models.ForeignKey(
+        Project,
+        on_delete=models.CASCADE,
+        related_name='progress_events',
+    )
+    kind = models.CharField(max_length=13, choices=KIND_CHOICES)
+    object_id = models.UUIDField()
+    # Changed fields and their new values, as JSON
+    fields = models.TextField()
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            # ProgressEvent.changes, the events of a project after a version
+            models.Index(fields=['project', 'id'], name='progressevent_project_id'),
+        ]
+
+    @classmethod
+    def get_version(cls):
+        return cls.objects.aggregate(version=Max('id'))['version'] or 0
+
+    @classmethod
+    def changes(cls, project, since):
+        """
+        Returns the latest version and the changes of the models of `project` after version `since`,
+        one per model with the last value of every field that changed. Returns None as changes
+        when events after `since` may have been pruned.
+        """
+        oldest = cls.objects.aggregate(oldest=Min('id'))['oldest']
+        if oldest is not None and since < oldest - 1:
+            return cls.get_version(), None
+        changes = dict()
+        version = since
+        for event_id, kind, object_id, fields in cls.objects.filter(project=project, id__gt=since).order_by('id').values_list('id', 'kind', 'object_id', 'fields'):
+            change = changes.setdefault((kind, object_id), {'kind': kind, 'id': str(object_id), 'fields': dict()})
+            change['fields'].update(json.loads(fields))
+            version = event_id
+        return version, list(changes.values())
+
+    @classmethod
+    def snapshot(cls, project):
+        """Returns the latest version and the progress of the unfinished models and the open jobs of `project`"""
+        # Read first, so changes made while the snapshot is taken are sent again rather than missed
+        version = cls.get_version()
+        changes = dict()
+        unfinished = TrainedPredictionModel.objects.filter(data_block__project=project).exclude(pct_complete=100, cv_progress=100, fi_done=True, ee_done=True)
+        for values in unfinished.values('id', *TrainedPredictionModel.progress_fields):
+            object_id = values.pop('id')
+            changes[(cls.TRAINED_MODEL, object_id)] = {'kind': cls.TRAINED_MODEL, 'id': str(object_id), 'fields': values}
+        for job in Job.objects.filter(project=project, state__in=[Job.QUEUED, Job.RUNNING, Job.SUBMITTED]).order_by('created'):
+            event = job.get_event()
+            change = changes.setdefault((event.kind, event.object_id), {'kind': event.kind, 'id': str(event.object_id), 'fields': dict()})
+            change['fields'].update(json.loads(event.fields))
+        return version, list(changes.values())
+
+    @classmethod
+    def prune(cls, max_age=None):
+        """Deletes the events older than `max_age` seconds"""
+        max_age = max_age or settings.PROGRESS_EVENT_MAX_AGE
+        return cls.objects.filter(created__lt=timezone.now() - datetime.timedelta(seconds=max_age)).delete()[0]
+
+class UploadSession(models.Model):
+    """A DataBlock or cost sheet uploaded as numbered chunks, verified as they arrive"""
+
+    DATA_BLOCK = 'datablock'
+    COST_SHEET = 'costsheet'
+    KIND_CHOICES = [
+        (DATA_BLOCK, 'DataBlock'),
+        (COST_SHEET, 'Cost sheet'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    project = models.ForeignKey(
+        Project,
+        on_delete=models.CASCADE,
+        related_name='upload_sessions',
+    )
+    kind = models.CharField(max_length=9, choices=KIND_CHOICES)
+    name = models.CharField(max_length=200, blank=True)
+    upload = models.FileField(upload_to=obfuscate_upload_link, blank=True)
+    received = models.BigIntegerField(default=0)
+    next_chunk = models.IntegerField(default=0)
+    # UploadVerifier.get_state() and the Parquet parts written so far, as JSON
+    state = models.TextField(blank=True)
+    completed = models.BooleanField(default=False)
+    data_block = models.ForeignKey(
+        DataBlock,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+    )
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'UploadSession: {self.name or self.kind} ({self.project})'
+
+    @classmethod
+    def expire(cls, max_age=None):
+        """Aborts the uploads that received no chunk for over `max_age` seconds"""
+        max_age = max_age or settings.UPLOAD_SESSION_MAX_AGE
+        abandoned = list(cls.objects.filter(completed=False, updated__lt=timezone.now() - datetime.timedelta(seconds=max_age)))
+        for session in abandoned:
+            session.abort()
+        return len(abandoned)
+
+    def abort(self):
+        """Deletes the session, with the chunks and Parquet parts it stored unless it was finalized"""
+        if not self.completed:
+            for name in self.parts:
+                default_storage.delete(name)
+            self.upload.delete(save=False)
+        self.delete()
+
+    @property
+    def parts(self):
+        """Storage names of the Parquet files holding the rows verified so far"""
+        return json.loads(self.state)['parts'] if self.state else []
+
+    def get_verifier(self):
+        """Returns the verifier of the upload, resumed after the chunks received so far"""
+        if self.kind == self.DATA_BLOCK:
+            verifier = UploadVerifier(max_error_rate=settings.UPLOAD_MAX_ERROR_RATE)
+        else:
+            verifier = CostSheetVerifier()
+        if self.state:
+            verifier.set_state(json.loads(self.state)['verifier'])
+        return verifier
+
+    def set_state(self, verifier, parts):
+        self.state = json.dumps({'verifier': verifier.get_state(), 'parts': parts})
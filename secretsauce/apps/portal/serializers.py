@@ -1,32 +1,79 @@
 from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.db import models
 from rest_framework import serializers
 
 from secretsauce.apps.portal.models import *
 
-class DataBlockHeaderSerializer(serializers.ModelSerializer):
+from collections import defaultdict
+import os
+
+class ItemNameListSerializer(serializers.ListSerializer):
+    """
+    Resolves the item_name of all the rows with a single query for the Items of their projects.
+    The child serializer names the foreign key of the rows and the lookup from Item to it in `item_owner`.
+    """
+
+    def to_representation(self, data):
+        rows = list(data.all() if isinstance(data, models.Manager) else data)
+        owner_field, owner_lookup = self.child.item_owner
+        owner_ids = {getattr(row, owner_field + '_id') for row in rows}
+
+        self.item_names = defaultdict(dict)
+        if owner_ids:
+            names = Item.objects.filter(project__cost_sheet=True, **{owner_lookup + '__in': owner_ids})
+            for owner_id, item_id, name in names.values_list(owner_lookup, 'item_id', 'name'):
+                self.item_names[owner_id][item_id] = name
+        return super().to_representation(rows)
+
+class ItemNameSerializer(serializers.ModelSerializer):
+    item_name = serializers.SerializerMethodField()
+
+    def get_item_name(self, obj):
+        item_names = getattr(self.parent, 'item_names', None)
+        if item_names is None:
+            return obj.item_name
+        return item_names[getattr(obj, self.item_owner[0] + '_id')].get(obj.item_id)
+
+class DataBlockHeaderSerializer(ItemNameSerializer):
+    item_owner = ('data_block', 'project__data_blocks')
 
     class Meta:
         model = DataBlockHeader
         fields = ['item_id', 'item_name']
+        list_serializer_class = ItemNameListSerializer
 
 class DataBlockListSerializer(serializers.ModelSerializer):
+    errors = serializers.JSONField(source='get_errors', read_only=True)
 
     class Meta:
         model = DataBlock
         fields = '__all__'
+        read_only_fields = ['parquet', 'cube', 'checksum', 'state', 'pct_complete']
 
 class DataBlockSingleSerializer(serializers.ModelSerializer):
     schema = DataBlockHeaderSerializer(many=True, required=False, read_only=True)
+    errors = serializers.JSONField(source='get_errors', read_only=True)
 
     class Meta:
         model = DataBlock
         fields = '__all__'
+        read_only_fields = ['parquet', 'cube', 'checksum', 'state', 'pct_complete']
 
-class ConstraintParameterSerializer(serializers.ModelSerializer):
+class DataBlockProgressSerializer(serializers.ModelSerializer):
+    errors = serializers.JSONField(source='get_errors', read_only=True)
+
+    class Meta:
+        model = DataBlock
+        fields = ['id', 'state', 'pct_complete', 'errors']
+
+class ConstraintParameterSerializer(ItemNameSerializer):
+    item_owner = ('constraint_block', 'project__constraint_blocks')
 
     class Meta:
         model = ConstraintParameter
         fields = ['id', 'item_id', 'item_name']
+        list_serializer_class = ItemNameListSerializer
 
 class ConstraintBlockListDisplaySerializer(serializers.ModelSerializer):
 
@@ -81,13 +128,54 @@ class ConstraintCreateSerializer(serializers.ModelSerializer):
         ConstraintParameterRelationship.objects.bulk_create(relationships)
         return instance
 
+class ConstraintDisplayListSerializer(serializers.ListSerializer):
+    """
+    Renders the equations of all the constraints from memory, after reading their terms
+    with one query and the item names of their projects with another
+    """
+
+    def to_representation(self, data):
+        constraints = list(data.all() if isinstance(data, models.Manager) else data)
+
+        terms = defaultdict(list)
+        projects = dict()
+        rows = ConstraintParameterRelationship.objects.filter(constraint__in=constraints).values_list(
+            'constraint_id', 'constraint__constraint_block__project_id', 'constraint_parameter__item_id', 'coefficient')
+        for constraint_id, project_id, item_id, coefficient in rows:
+            terms[constraint_id].append((item_id, coefficient))
+            projects[constraint_id] = project_id
+
+        item_names = defaultdict(dict)
+        if projects:
+            rows = Item.objects.filter(project__in=set(projects.values())).values_list('project_id', 'item_id', 'name')
+            for project_id, item_id, name in rows:
+                item_names[project_id][item_id] = name
+
+        self.equations = dict()
+        for constraint in constraints:
+            constraint_terms = terms[constraint.id]
+            self.equations[constraint.id] = (
+                constraint.format_equation(constraint_terms),
+                constraint.format_equation(constraint_terms, item_names[projects.get(constraint.id)]),
+            )
+        return super().to_representation(constraints)
+
 class ConstraintDisplaySerializer(serializers.ModelSerializer):
-    equation = serializers.CharField(read_only=True)
-    equation_name = serializers.CharField(read_only=True)
+    equation = serializers.SerializerMethodField()
+    equation_name = serializers.SerializerMethodField()
 
     class Meta:
         model = Constraint
         fields = ['id', 'name', 'created', 'penalty', 'equation', 'equation_name', 'category']
+        list_serializer_class = ConstraintDisplayListSerializer
+
+    def get_equation(self, obj):
+        equations = getattr(self.parent, 'equations', None)
+        return equations[obj.id][0] if equations is not None else obj.equation
+
+    def get_equation_name(self, obj):
+        equations = getattr(self.parent, 'equations', None)
+        return equations[obj.id][1] if equations is not None else obj.equation_name
 
 class ConstraintBlockDetailSerializer(serializers.ModelSerializer):
     constraints = ConstraintDisplaySerializer(many=True, read_only=True)
@@ -173,4 +261,35 @@ class OptimizerCreateSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Optimizer
-        fields = '__all__'
\ No newline at end of file
+        fields = '__all__'
+
+class JobSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = Job
+        fields = ['id', 'kind', 'state', 'project', 'trained_model', 'optimizer', 'attempts', 'error', 'run_after', 'started', 'finished', 'created']
+        read_only_fields = fields
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    filename = serializers.CharField(write_only=True, max_length=200)
+
+    class Meta:
+        model = UploadSession
+        fields = ['id', 'project', 'kind', 'name', 'filename', 'received', 'next_chunk', 'completed', 'data_block', 'created']
+        read_only_fields = ['received', 'next_chunk', 'completed', 'data_block']
+
+    def validate(self, data):
+        if data['kind'] == UploadSession.DATA_BLOCK:
+            if not data.get('name'):
+                raise serializers.ValidationError({'name': 'This field is required.'})
+            if DataBlock.objects.filter(project=data['project'], name=data['name']).exists():
+                raise serializers.ValidationError({'name': 'DataBlock with this name already exists in project.'})
+        elif data['project'].cost_sheet:
+            raise serializers.ValidationError('Cost sheet already uploaded')
+        return data
+
+    def create(self, validated_data):
+        filename = os.path.basename(validated_data.pop('filename'))
+        instance = super().create(validated_data)
+        instance.upload.save(filename, ContentFile(b''))
+        return instance
@@ -1,17 +1,32 @@
-import json
+import datetime, hashlib, io, json, tempfile
+from unittest import mock
 
-from django.test import TestCase, Client
+import pandas as pd
+import pyarrow.parquet as pq
+
+from django.core.cache import caches
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, Client, override_settings
+from django.utils import timezone
 from django.urls import reverse
 
 from rest_framework import status
 from rest_framework.test import APITestCase
 
-from secretsauce.utils import reverse_args
+from secretsauce.utils import reverse_args, UploadVerifier, CostSheetVerifier
 from secretsauce.apps.account.models import *
 from secretsauce.apps.account.serializers import *
+from secretsauce.apps.portal.cube import AggregateCube
+from secretsauce.apps.portal.jobs import run_job
 from secretsauce.apps.portal.models import *
 from secretsauce.apps.portal.views import *
 
+def run_jobs():
+    """Runs the due jobs in the test thread, as the runjobs worker would"""
+    for job in Job.claim(100):
+        run_job(job)
+
 class ProjectCRUDTest(APITestCase):
     def setUp(self):
         self.admin = User.objects.create_superuser("admin@rms.com", "pw123123")
@@ -350,27 +365,446 @@ class ModelTagCRUDTest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
         self.assertEqual(len(ModelTag.objects.all()), 0)
 
-# class DataBlockCRUDTest(APITestCase):
-#     def setUp(self):
-#         pass
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), BACKGROUND_TASKS_INLINE=True)
+class DataBlockCRUDTest(APITestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser("admin@rms.com", "pw123123")
+        self.company = Company.objects.create(
+            name="McDonald's"
+        )
+        self.user = User.objects.create_user(
+            "user1@mcdonald.com",
+            "pw123123",
+            company=self.company,
+        )
 
-#     def test_list(self):
-#         pass
+        self.project = Project.objects.create(title="First project", company=self.company)
+        self.project.owners.add(self.user)
 
-#     def test_create(self):
-#         pass
+        self.rows = [
+            [1, 1, 1, 1, 100, 10, 2.0],
+            [1, 1, 1, 2, 100, 5, 3.0],
+            [1, 1, 1, 1, 200, 4, 1.5],
+            [2, 1, 1, 1, 100, 8, 2.5],
+            [2, 1, 1, 1, 200, 6, 1.5],
+        ]
+
+        self.list_url = reverse('data-block-list')
+        self.detail_url = reverse_args('data-block-detail')
+        self.average_prices_url = reverse_args('datablocks-average-prices')
+        self.viz_price_url = reverse_args('datablocks-viz-price')
+        self.viz_qty_url = reverse_args('datablocks-viz-qty')
+        self.viz_store_url = reverse_args('datablocks-viz-store')
+        self.progress_url = reverse_args('data-block-progress')
+
+    def upload(self, name="Block 1", rows=None):
+        lines = [','.join(UploadVerifier.headers)] + [','.join(map(str, row)) for row in (rows or self.rows)]
+        upload = SimpleUploadedFile('sales.csv', ('\n'.join(lines) + '\n').encode('utf-8'))
+        response = self.client.post(self.list_url, data={
+            'name': name,
+            'project': self.project.id,
+            'upload': upload,
+        }, format='multipart')
+        run_jobs()
+        return response
 
-#     def test_retrieve(self):
-#         pass
+    def test_create(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.upload()
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data.get('state'), DataBlock.INGESTING)
 
-#     def test_update(self):
-#         pass
+        response = self.client.get(self.progress_url(response.data.get('id')))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data.get('state'), DataBlock.READY)
+        self.assertEqual(response.data.get('pct_complete'), 100)
+        self.assertEqual(response.data.get('errors').get('total'), 0)
+
+        data_block = DataBlock.objects.get(id=response.data.get('id'))
+        self.assertTrue(data_block.parquet)
+        self.assertTrue(data_block.cube)
+        self.assertEqual(set(data_block.schema.values_list('item_id', flat=True)), {100, 200})
+        df = data_block.read_frame()
+        self.assertEqual(list(df.columns), UploadVerifier.headers)
+        self.assertEqual(len(df), len(self.rows))
+
+    def test_parquet_order(self):
+        self.client.force_authenticate(user=self.user)
+        data_block = DataBlock.objects.get(id=self.upload().data.get('id'))
+        # Trained on rows grouped by Item_ID, the rows of every item in the order they were uploaded
+        df = pq.read_table(io.BytesIO(data_block.read_parquet_bytes())).to_pandas()
+        expected = pd.DataFrame(self.rows, columns=UploadVerifier.headers).sort_values('Item_ID', kind='mergesort')
+        self.assertEqual(df.values.tolist(), expected.values.tolist())
 
-#     def test_partial_update(self):
-#         pass
+    def test_create_with_errors(self):
+        self.client.force_authenticate(user=self.user)
+        data_block_id = self.upload(rows=self.rows + [[3, 1, 1, 1, 100, 'x', 2.0]]).data.get('id')
+        response = self.client.get(self.progress_url(data_block_id))
+        self.assertEqual(response.data.get('state'), DataBlock.READY)
+        self.assertEqual(response.data.get('errors'), {
+            'total': 1,
+            'rows': 1,
+            'columns': {'Qty_': 1},
+            'examples': {'Col: Qty_, Row: 7': 'Cell value not allowed: x'},
+        })
 
-#     def test_destroy(self):
-#         pass
+    @override_settings(UPLOAD_MAX_ERROR_RATE=0.1)
+    def test_create_too_many_errors(self):
+        self.client.force_authenticate(user=self.user)
+        UploadVerifier.abort_min_rows, abort_min_rows = 2, UploadVerifier.abort_min_rows
+        try:
+            data_block_id = self.upload(rows=[[wk, 1, 1, 1, 100, 'x', 2.0] for wk in range(1, 5)]).data.get('id')
+        finally:
+            UploadVerifier.abort_min_rows = abort_min_rows
+        response = self.client.get(self.progress_url(data_block_id))
+        self.assertEqual(response.data.get('state'), DataBlock.FAILED)
+        self.assertEqual(response.data.get('errors').get('columns'), {'Qty_': 4})
+
+    def test_cube_failed(self):
+        self.client.force_authenticate(user=self.user)
+        data_block = DataBlock.objects.get(id=self.upload().data.get('id'))
+        DataBlock.objects.filter(id=data_block.id).update(cube='')
+        with mock.patch.object(AggregateCube, 'build', side_effect=ValueError()), self.assertRaises(ValueError):
+            data_block.build_cube()
+        data_block.refresh_from_db()
+        self.assertEqual(data_block.get_errors().get('cube'), 'Aggregating the DataBlock failed')
+        self.assertEqual(data_block.get_errors().get('total'), 0)
+
+    def test_create_failed(self):
+        self.client.force_authenticate(user=self.user)
+        upload = SimpleUploadedFile('sales.csv', b'Week,Store\n1,1\n')
+        response = self.client.post(self.list_url, data={
+            'name': "Block 1",
+            'project': self.project.id,
+            'upload': upload,
+        }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        data_block_id = response.data.get('id')
+        run_jobs()
+
+        response = self.client.get(self.progress_url(data_block_id))
+        self.assertEqual(response.data.get('state'), DataBlock.FAILED)
+        self.assertIn('detail', response.data.get('errors'))
+
+        response = self.client.get(self.viz_qty_url(data_block_id), data={'items': '100'})
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_list(self):
+        self.client.force_authenticate(user=self.user)
+        self.upload()
+        response = self.client.get(self.list_url, data={'project': self.project.id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+
+    def test_retrieve(self):
+        self.client.force_authenticate(user=self.user)
+        data_block_id = self.upload().data.get('id')
+        response = self.client.get(self.detail_url(data_block_id))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data.get('schema')), 2)
+
+    def test_destroy(self):
+        self.client.force_authenticate(user=self.user)
+        data_block_id = self.upload().data.get('id')
+        response = self.client.delete(self.detail_url(data_block_id))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(len(DataBlock.objects.all()), 0)
+
+    def test_average_prices(self):
+        self.client.force_authenticate(user=self.user)
+        data_block_id = self.upload().data.get('id')
+        response = self.client.get(self.average_prices_url(data_block_id))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {100: 2.5, 200: 1.5})
+
+    def test_vizdata(self):
+        self.client.force_authenticate(user=self.user)
+        data_block_id = self.upload().data.get('id')
+        response = self.client.get(self.viz_price_url(data_block_id), data={'items': '200,100'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(response.data['items']), [100, 200])
+        self.assertEqual([list(prices) for prices in response.data['datasets']], [[2.0, 3.0, 2.5], [1.5, 1.5]])
+
+        response = self.client.get(self.viz_qty_url(data_block_id), data={'items': '100,200'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(response.data['weeks']), [1, 2])
+        self.assertEqual({k: list(v) for k, v in response.data['datasets'].items()}, {100: [15, 8], 200: [4, 6]})
+
+        response = self.client.get(self.viz_store_url(data_block_id), data={'items': '100,200'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['store'], [1, 2])
+        self.assertEqual(response.data['datasets'], {
+            100: {'qty': [18, 5], 'price': [2.25, 3.0]},
+            200: {'qty': [10, 0], 'price': [1.5, None]},
+        })
+
+    def test_analytics_cache(self):
+        self.client.force_authenticate(user=self.user)
+        data_block_id = self.upload().data.get('id')
+        response = self.client.get(self.average_prices_url(data_block_id))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+        self.assertIn('Last-Modified', response)
+
+        response = self.client.get(self.average_prices_url(data_block_id), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Different query parameters are cached separately
+        response = self.client.get(self.viz_qty_url(data_block_id), data={'items': '100'})
+        self.assertNotEqual(response['ETag'], etag)
+
+        # The same items in another order or repeated are the same query
+        qty_etag = response['ETag']
+        response = self.client.get(self.viz_qty_url(data_block_id), data={'items': '200,100'})
+        self.assertEqual(self.client.get(self.viz_qty_url(data_block_id), data={'items': '100,200,100'})['ETag'], response['ETag'])
+        self.assertNotEqual(response['ETag'], qty_etag)
+
+        cache = caches['analytics']
+        self.assertEqual(len(cache.get(f'datablock:{data_block_id}:keys')), 3)
+        self.client.delete(self.detail_url(data_block_id))
+        self.assertIsNone(cache.get(f'datablock:{data_block_id}:keys'))
+
+    def test_aggregates_without_cube(self):
+        self.client.force_authenticate(user=self.user)
+        data_block = DataBlock.objects.get(id=self.upload().data.get('id'))
+        expected = data_block.aggregates('Wk', [100])
+        data_block.cube = ''
+        self.assertTrue(data_block.aggregates('Wk', [100]).equals(expected))
+
+class ProjectItemsTest(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(
+            name="McDonald's"
+        )
+        self.user = User.objects.create_user(
+            "user1@mcdonald.com",
+            "pw123123",
+            company=self.company,
+        )
+
+        self.project = Project.objects.create(title="First project", company=self.company)
+        self.project.owners.add(self.user)
+        self.items_url = reverse('item-directory-list', args=(self.project.id, ))
+
+    def upload(self, rows):
+        lines = [','.join(CostSheetVerifier.headers)] + [','.join(map(str, row)) for row in rows]
+        upload = SimpleUploadedFile('costs.csv', ('\n'.join(lines) + '\n').encode('utf-8'))
+        return self.client.post(self.items_url, data={'file': upload}, format='multipart')
+
+    def test_create(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.upload([
+            [1, 1, 1, 100, 'Burger', 1, 2.0, 5.0, 4.0, 6.0],
+            [2, 1, 1, 100, 'Burger', 1, 2.0, 5.0, 3.5, 5.5],
+            [1, 1, 1, 200, 'Fries', 1, 0.5, 2.0, 1.5, 2.5],
+        ])
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            sorted(self.project.items.values_list('item_id', 'price_floor', 'price_cap')),
+            [(100, 3.5, 6.0), (200, 1.5, 2.5)],
+        )
+
+        response = self.client.delete(self.items_url)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.project.items.count(), 0)
+
+    def test_upsert(self):
+        self.client.force_authenticate(user=self.user)
+        self.upload([
+            [1, 1, 1, 100, 'Burger', 1, 2.0, 5.0, 4.0, 6.0],
+            [1, 1, 1, 200, 'Fries', 1, 0.5, 2.0, 1.5, 2.5],
+            [1, 1, 1, 300, 'Shake', 1, 1.0, 3.0, 2.0, 4.0],
+        ])
+        rows = [
+            [1, 1, 1, 100, 'Burger', 1, 2.0, 5.0, 4.0, 6.0],
+            [1, 1, 1, 200, 'Fries', 1, 0.6, 2.0, 1.5, 2.5],
+            [1, 1, 1, 400, 'Nuggets', 1, 1.5, 4.0, 3.0, 5.0],
+        ]
+        lines = [','.join(CostSheetVerifier.headers)] + [','.join(map(str, row)) for row in rows]
+        upload = SimpleUploadedFile('costs.csv', ('\n'.join(lines) + '\n').encode('utf-8'))
+        response = self.client.put(self.items_url, data={'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'created': [400], 'updated': [200], 'removed': [], 'unchanged': 1})
+        self.assertEqual(self.project.items.get(item_id=200).cost, 0.6)
+        self.assertEqual(self.project.items.count(), 4)
+
+        upload = SimpleUploadedFile('costs.csv', ('\n'.join(lines) + '\n').encode('utf-8'))
+        response = self.client.put(self.items_url, data={'file': upload, 'remove_missing': 'true'}, format='multipart')
+        self.assertEqual(response.data, {'created': [], 'updated': [], 'removed': [300], 'unchanged': 3})
+        self.assertEqual(sorted(self.project.items.values_list('item_id', flat=True)), [100, 200, 400])
+
+    def test_floor_cap_mismatch(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.upload([
+            [1, 1, 1, 100, 'Burger', 1, 2.0, 5.0, 4.0, 6.0],
+            [1, 1, 1, 200, 'Fries', 1, 0.5, 2.0, 3.0, 2.5],
+        ])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data.get('floor/ceil mismatch'), ['item_id: 200, floor: 3.0, cap: 2.5'])
+        self.assertEqual(self.project.items.count(), 0)
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), BACKGROUND_TASKS_INLINE=True)
+class UploadSessionTest(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(
+            name="McDonald's"
+        )
+        self.user = User.objects.create_user(
+            "user1@mcdonald.com",
+            "pw123123",
+            company=self.company,
+        )
+        self.other_user = User.objects.create_user(
+            "user2@mcdonald.com",
+            "pw123123",
+            company=self.company,
+        )
+
+        self.project = Project.objects.create(title="First project", company=self.company)
+        self.project.owners.add(self.user)
+
+        rows = [[week, 1, 1, store, item_id, 2, 1.5] for week in range(1, 11) for store in range(1, 4) for item_id in (100, 200)]
+        lines = [','.join(UploadVerifier.headers)] + [','.join(map(str, row)) for row in rows]
+        self.content = ('\n'.join(lines) + '\n').encode('utf-8')
+        self.row_count = len(rows)
+
+        self.create_url = reverse('upload-session-create')
+        self.detail_url = reverse_args('upload-session-detail')
+        self.chunk_url = reverse_args('upload-session-chunk')
+        self.finalize_url = reverse_args('upload-session-finalize')
+
+    def start(self, kind=UploadSession.DATA_BLOCK, name="Block 1"):
+        return self.client.post(self.create_url, data={
+            'project': self.project.id,
+            'kind': kind,
+            'name': name,
+            'filename': 'sales.csv',
+        }, format='json')
+
+    def put_chunk(self, session_id, index, data):
+        return self.client.put(self.chunk_url(session_id, index), data=data, content_type='application/octet-stream')
+
+    def finalize(self, session_id):
+        response = self.client.post(self.finalize_url(session_id))
+        run_jobs()
+        return response
+
+    def chunks(self, size=100):
+        return [self.content[i:i + size] for i in range(0, len(self.content), size)]
+
+    def test_chunked_upload(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.start()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        session_id = response.data.get('id')
+
+        for index, chunk in enumerate(self.chunks()):
+            response = self.put_chunk(session_id, index, chunk)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data.get('received'), len(self.content))
+
+        response = self.finalize(session_id)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data.get('state'), DataBlock.INGESTING)
+        self.assertEqual(response.data.get('errors').get('total'), 0)
+
+        data_block = DataBlock.objects.get(id=response.data.get('id'))
+        self.assertEqual(data_block.state, DataBlock.READY)
+        self.assertEqual(set(data_block.schema.values_list('item_id', flat=True)), {100, 200})
+        self.assertEqual(len(data_block.read_frame()), self.row_count)
+        with data_block.upload.open('rb') as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertEqual(data_block.checksum, hashlib.sha256(self.content).hexdigest())
+        session = UploadSession.objects.get(id=session_id)
+        self.assertTrue(session.completed)
+        # The Parquet parts are deleted once ingested
+        self.assertEqual(session.parts, [])
+
+    def test_resume(self):
+        self.client.force_authenticate(user=self.user)
+        session_id = self.start().data.get('id')
+        chunks = self.chunks()
+
+        self.put_chunk(session_id, 0, chunks[0])
+        response = self.put_chunk(session_id, 2, chunks[2])
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data.get('next_chunk'), 1)
+
+        # A resent chunk is acknowledged without being appended twice
+        response = self.put_chunk(session_id, 0, chunks[0])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get(self.detail_url(session_id))
+        self.assertEqual(response.data.get('next_chunk'), 1)
+        self.assertEqual(response.data.get('received'), len(chunks[0]))
+
+        for index in range(response.data.get('next_chunk'), len(chunks)):
+            self.put_chunk(session_id, index, chunks[index])
+        response = self.finalize(session_id)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(len(DataBlock.objects.get(id=response.data.get('id')).read_frame()), self.row_count)
+
+        response = self.put_chunk(session_id, len(chunks), b'1,1,1,1,1,1,1\n')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_expire(self):
+        self.client.force_authenticate(user=self.user)
+        session_id = self.start().data.get('id')
+        chunks = self.chunks()
+        for index in range(3):
+            self.put_chunk(session_id, index, chunks[index])
+        session = UploadSession.objects.get(id=session_id)
+        self.assertEqual(UploadSession.expire(max_age=60), 0)
+
+        UploadSession.objects.filter(id=session_id).update(updated=timezone.now() - datetime.timedelta(seconds=120))
+        self.assertEqual(UploadSession.expire(max_age=60), 1)
+        self.assertFalse(UploadSession.objects.filter(id=session_id).exists())
+        for name in session.parts + [session.upload.name]:
+            self.assertFalse(default_storage.exists(name))
+
+    def test_wrong_headers(self):
+        self.client.force_authenticate(user=self.user)
+        session_id = self.start().data.get('id')
+        response = self.put_chunk(session_id, 0, b'Week,Store\n1,1\n')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(UploadSession.objects.get(id=session_id).received, 0)
+
+    def test_cost_sheet(self):
+        self.client.force_authenticate(user=self.user)
+        lines = [','.join(CostSheetVerifier.headers), '1,1,1,100,Burger,1,1.0,2.0,1.5,2.5', '1,1,1,200,Fries,1,0.5,1.0,0.8,1.2']
+        session_id = self.start(kind=UploadSession.COST_SHEET, name='').data.get('id')
+        self.put_chunk(session_id, 0, ('\n'.join(lines) + '\n').encode('utf-8'))
+        response = self.client.post(self.finalize_url(session_id))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.project.refresh_from_db()
+        self.assertTrue(self.project.cost_sheet)
+        self.assertEqual(set(self.project.items.values_list('item_id', flat=True)), {100, 200})
+
+        response = self.start(kind=UploadSession.COST_SHEET, name='')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_concurrent_cost_sheets(self):
+        self.client.force_authenticate(user=self.user)
+        lines = [','.join(CostSheetVerifier.headers), '1,1,1,100,Burger,1,1.0,2.0,1.5,2.5']
+        session_ids = [self.start(kind=UploadSession.COST_SHEET, name='').data.get('id') for _ in range(2)]
+        for session_id in session_ids:
+            self.put_chunk(session_id, 0, ('\n'.join(lines) + '\n').encode('utf-8'))
+        self.assertEqual(self.client.post(self.finalize_url(session_ids[0])).status_code, status.HTTP_201_CREATED)
+        # Only checked when the second session was started, before the first one was finalized
+        response = self.client.post(self.finalize_url(session_ids[1]))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.project.items.count(), 1)
+
+    def test_permissions(self):
+        self.client.force_authenticate(user=self.other_user)
+        response = self.start()
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_authenticate(user=self.user)
+        session_id = self.start().data.get('id')
+        self.client.force_authenticate(user=self.other_user)
+        response = self.put_chunk(session_id, 0, self.content)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
 class ConstraintBlockCRUDTest(APITestCase):
     def setUp(self):
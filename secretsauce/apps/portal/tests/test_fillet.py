@@ -0,0 +1,180 @@
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+from secretsauce.apps.account.models import *
+from secretsauce.apps.portal.models import *
+from secretsauce.fillet import FilletClient, FilletError
+
+import gzip, hashlib, hmac, json, socket
+
+class StubFilletHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        self.server.calls.append({
+            'path': self.path,
+            'client_port': self.client_address[1],
+            'headers': dict(self.headers),
+            'body': body,
+        })
+        if self.path == '/unavailable/' and self.server.unavailable > 0:
+            self.server.unavailable -= 1
+            return self.respond(503, b'{}')
+        if self.path in getattr(self.server, 'rejected', ()):
+            return self.respond(400, b'{}')
+        if self.path in getattr(self.server, 'responses', {}):
+            return self.respond(200, json.dumps(self.server.responses[self.path]).encode('utf-8'))
+        response = json.dumps({'path': self.path, 'received': len(body), 'filler': 'x' * 2048}).encode('utf-8')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            return self.respond(200, gzip.compress(response), {'Content-Encoding': 'gzip'})
+        self.respond(200, response)
+
+    def respond(self, code, body, headers={}):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class FilletClientTest(SimpleTestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubFilletHandler)
+        self.server.calls = []
+        self.server.unavailable = 0
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.client = FilletClient(base_url=self.url, timeout=(1, 2), backoff=0)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        for path in ['/batch_query_progress/', '/get_cv_results/', '/predict/']:
+            r = self.client.post(path, {'project_id': 'abc'})
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.json()['path'], path)
+        # All calls went over the same connection
+        self.assertEqual(len({call['client_port'] for call in self.server.calls}), 1)
+        self.assertEqual(json.loads(self.server.calls[0]['body']), {'project_id': 'abc'})
+        self.assertEqual(self.server.calls[0]['headers']['Content-Type'], 'application/json')
+
+    def test_gzip(self):
+        r = self.client.post('/detect_conflict/', {'constraints': [0] * 1000})
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(r.json()['filler']), 2048)
+        self.assertNotIn('Content-Encoding', self.server.calls[0]['headers'])
+
+        client = FilletClient(base_url=self.url, compress=True, compress_min_size=100)
+        client.post('/detect_conflict/', {'constraints': [0] * 1000})
+        client.post('/detect_conflict/', {'constraints': [0]})
+        client.close()
+        self.assertEqual(self.server.calls[1]['headers']['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(self.server.calls[1]['body']), {'constraints': [0] * 1000})
+        self.assertNotIn('Content-Encoding', self.server.calls[2]['headers'])
+
+    def test_form(self):
+        r = self.client.post('/train/', data={'modeltype': 'xgb'}, files={'data': b'parquet'})
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(self.server.calls[0]['headers']['Content-Type'].startswith('multipart/form-data'))
+        self.assertIn(b'parquet', self.server.calls[0]['body'])
+
+    def test_retries(self):
+        self.server.unavailable = 2
+        r = self.client.post('/unavailable/', {})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(self.server.calls), 3)
+
+        # The last answer is returned once the retries are used up
+        self.server.unavailable = 5
+        r = self.client.post('/unavailable/', {})
+        self.assertEqual(r.status_code, 503)
+        self.assertEqual(len(self.server.calls), 6)
+
+    def test_unreachable(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        client = FilletClient(base_url='http://127.0.0.1:%d' % port, retries=1, backoff=0)
+        with self.assertRaises(FilletError):
+            client.post('/train/', {})
+
+@override_settings(FILLET_WEBHOOK_SECRET='secret')
+class FilletProgressTest(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(
+            name="McDonald's"
+        )
+        self.project = Project.objects.create(title="First project", company=self.company)
+        self.data_block = DataBlock.objects.create(project=self.project, name="First DataBlock", upload='uploads/test.csv')
+        self.prediction_model = PredictionModel.objects.create(name="First PredictionModel")
+        self.trained_models = [
+            TrainedPredictionModel.objects.create(prediction_model=self.prediction_model, data_block=self.data_block, name=f"Model {idx}")
+            for idx in range(3)
+        ]
+
+    def push(self, progress, secret='secret'):
+        body = json.dumps(progress).encode('utf-8')
+        signature = 'sha256=' + hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+        return self.client.post(reverse('fillet-progress'), data=body, content_type='application/json', HTTP_X_FILLET_SIGNATURE=signature)
+
+    def test_push(self):
+        first, second, third = self.trained_models
+        response = self.push({
+            str(first.id): {'pct_complete': 100, 'cv_progress': 40.5, 'fi_done': True, 'ee_done': False},
+            str(second.id): {'pct_complete': 20},
+            str(third.id): 'training not started',
+            'not an id': {'pct_complete': 100},
+        })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'updated': 2, 'unknown': ['not an id']})
+        first.refresh_from_db()
+        self.assertEqual((first.pct_complete, first.cv_progress, first.fi_done, first.ee_done), (100, 40.5, True, False))
+        second.refresh_from_db()
+        self.assertEqual((second.pct_complete, second.cv_progress), (20, 0))
+
+        # Pushing the same progress again changes nothing
+        response = self.push({str(first.id): {'pct_complete': 100}})
+        self.assertEqual(response.data['updated'], 0)
+
+    def test_invalid(self):
+        response = self.push({str(self.trained_models[0].id): {'pct_complete': 'done'}})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.push([1, 2])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_signature(self):
+        progress = {str(self.trained_models[0].id): {'pct_complete': 100}}
+        response = self.push(progress, secret='wrong')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.post(reverse('fillet-progress'), data=progress, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        with self.settings(FILLET_WEBHOOK_SECRET=''):
+            response = self.push(progress, secret='')
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.trained_models[0].refresh_from_db()
+        self.assertEqual(self.trained_models[0].pct_complete, 0)
+
+    def test_list_without_fillet(self):
+        user = User.objects.create_user("user1@mcdonald.com", "pw123123", company=self.company)
+        self.project.owners.add(user)
+        self.client.force_authenticate(user=user)
+        # Unfinished models are listed from the database only, Fillet is not reachable from tests
+        response = self.client.get(reverse('trained-model-list'), data={'project': self.project.id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 3)
@@ -0,0 +1,418 @@
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from http.server import ThreadingHTTPServer
+from threading import Thread
+from unittest import mock
+
+from secretsauce.apps.account.models import *
+from secretsauce.apps.portal.jobs import handlers, run_job, feature_importance_frame, elasticity_frame, cv_score_frame
+from secretsauce.apps.portal.models import *
+from secretsauce.apps.portal.tests.test_fillet import StubFilletHandler
+from secretsauce.fillet import FilletClient
+
+import datetime, io, json, tempfile, time
+
+class JobTestMixin:
+    def create_project(self, name):
+        company = Company.objects.create(name=name)
+        project = Project.objects.create(title=f"{name} project", company=company)
+        data_block = DataBlock.objects.create(project=project, name="First DataBlock", upload='uploads/test.csv')
+        prediction_model, _ = PredictionModel.objects.get_or_create(name="First PredictionModel")
+        trained_model = TrainedPredictionModel.objects.create(prediction_model=prediction_model, data_block=data_block, name="Model")
+        return project, trained_model
+
+    def enqueue(self, project, trained_model, count):
+        return [Job.enqueue(Job.TRAIN, project, trained_model=trained_model) for _ in range(count)]
+
+@override_settings(JOBS_PER_TENANT=2, JOB_MAX_ATTEMPTS=3, JOB_RETRY_BACKOFF=10)
+class JobQueueTest(JobTestMixin, TestCase):
+    def setUp(self):
+        self.project, self.trained_model = self.create_project("McDonald's")
+        self.other_project, self.other_trained_model = self.create_project("Burger King")
+
+    def test_claim(self):
+        self.enqueue(self.project, self.trained_model, 3)
+        jobs = Job.claim(10)
+        self.assertEqual(len(jobs), 2)
+        self.assertTrue(all(job.state == Job.RUNNING and job.attempts == 1 for job in jobs))
+        self.assertEqual(Job.objects.filter(state=Job.RUNNING).count(), 2)
+        # Claimed jobs are not claimed again
+        self.assertEqual(Job.claim(10), [])
+
+    def test_claim_per_tenant(self):
+        self.enqueue(self.project, self.trained_model, 5)
+        self.enqueue(self.other_project, self.other_trained_model, 1)
+        jobs = Job.claim(10)
+        self.assertEqual(sorted(job.project_id == self.project.id for job in jobs), [False, True, True])
+        self.assertEqual(Job.objects.filter(state=Job.QUEUED).count(), 3)
+
+        # A job Fillet accepted keeps its slot until Fillet reports it finished
+        jobs = [job for job in jobs if job.project_id == self.project.id]
+        jobs[0].submit()
+        self.assertEqual(Job.claim(10), [])
+        jobs[0].succeed()
+        self.assertEqual(len(Job.claim(10)), 1)
+
+    def test_claim_uncapped(self):
+        # Neither ingestion nor fetching results are held back by trainings
+        self.enqueue(self.project, self.trained_model, 2)
+        Job.claim(2)[0].submit()
+        Job.enqueue(Job.INGEST, self.project, data_block=self.trained_model.data_block)
+        Job.enqueue(Job.RESULTS, self.project, trained_model=self.trained_model)
+        jobs = Job.claim(10)
+        self.assertEqual(sorted(job.kind for job in jobs), [Job.INGEST, Job.RESULTS])
+
+    def test_claim_stale_counts(self):
+        self.enqueue(self.project, self.trained_model, 4)
+        self.assertEqual(len(Job.claim(2)), 2)
+        # Counts read before another worker claimed its jobs do not let the company exceed the cap
+        with mock.patch('secretsauce.apps.portal.models.dict', create=True, return_value={}):
+            self.assertEqual(Job.claim(10), [])
+        self.assertEqual(Job.objects.filter(state=Job.RUNNING).count(), 2)
+
+    def test_submitted(self):
+        job = self.enqueue(self.project, self.trained_model, 1)[0]
+        Job.claim(1)[0].submit()
+        job.refresh_from_db()
+        self.assertEqual(job.state, Job.SUBMITTED)
+
+        # Closed once Fillet reports everything done
+        TrainedPredictionModel.apply_progress({str(self.trained_model.id): {'pct_complete': 100, 'cv_progress': 100}})
+        job.refresh_from_db()
+        self.assertEqual(job.state, Job.SUBMITTED)
+        TrainedPredictionModel.apply_progress({str(self.trained_model.id): {'fi_done': True, 'ee_done': True}})
+        job.refresh_from_db()
+        self.assertEqual(job.state, Job.SUCCEEDED)
+
+    def test_expire_submitted(self):
+        job = self.enqueue(self.project, self.trained_model, 1)[0]
+        Job.claim(1)[0].submit()
+        self.assertEqual(Job.expire_submitted(timeout=60), 0)
+        Job.objects.filter(id=job.id).update(started=timezone.now() - datetime.timedelta(seconds=120))
+        self.assertEqual(Job.expire_submitted(timeout=60), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.attempts), (Job.FAILED, 1))
+
+    def test_claim_limit(self):
+        self.enqueue(self.project, self.trained_model, 2)
+        self.enqueue(self.other_project, self.other_trained_model, 2)
+        self.assertEqual(len(Job.claim(3)), 3)
+        self.assertEqual(Job.claim(0), [])
+
+    def test_retry_backoff(self):
+        job = self.enqueue(self.project, self.trained_model, 1)[0]
+        for attempt in range(1, 3):
+            job = Job.claim(1)[0]
+            before = timezone.now()
+            job.fail('Fillet is down')
+            job.refresh_from_db()
+            self.assertEqual((job.state, job.attempts, job.error), (Job.QUEUED, attempt, 'Fillet is down'))
+            self.assertGreaterEqual(job.run_after, before + datetime.timedelta(seconds=10 * 2 ** (attempt - 1)))
+            # Not due before the backoff is over
+            self.assertEqual(Job.claim(1), [])
+            Job.objects.filter(id=job.id).update(run_after=timezone.now())
+
+        job = Job.claim(1)[0]
+        job.fail('Fillet is down')
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.attempts), (Job.FAILED, 3))
+        self.assertIsNotNone(job.finished)
+
+    def test_requeue_stale(self):
+        job = self.enqueue(self.project, self.trained_model, 1)[0]
+        Job.claim(1)
+        self.assertEqual(Job.requeue_stale(timeout=60), 0)
+        Job.objects.filter(id=job.id).update(started=timezone.now() - datetime.timedelta(seconds=120))
+        self.assertEqual(Job.requeue_stale(timeout=60), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.error), (Job.QUEUED, 'Timed out'))
+
+    def test_heartbeat(self):
+        job = self.enqueue(self.project, self.trained_model, 1)[0]
+        job = Job.claim(1)[0]
+        Job.objects.filter(id=job.id).update(started=timezone.now() - datetime.timedelta(seconds=120))
+        # A job that is still beating is left to its worker
+        self.assertEqual(job.beat(), 1)
+        self.assertEqual(Job.requeue_stale(timeout=60), 0)
+
+    @override_settings(JOB_HEARTBEAT_INTERVAL=0.01)
+    def test_run_job_beats(self):
+        self.enqueue(self.project, self.trained_model, 1)
+        job = Job.claim(1)[0]
+        with mock.patch.dict(handlers, {Job.TRAIN: lambda job: time.sleep(0.2)}), mock.patch.object(Job, 'beat') as beat:
+            run_job(job)
+        self.assertGreater(beat.call_count, 1)
+        calls = beat.call_count
+        time.sleep(0.05)
+        # Stopped with the job
+        self.assertEqual(beat.call_count, calls)
+
+    def test_runjobs_once(self):
+        # Only jobs that are due are run
+        job = self.enqueue(self.project, self.trained_model, 1)[0]
+        Job.objects.filter(id=job.id).update(run_after=timezone.now() + datetime.timedelta(hours=1))
+        out = io.StringIO()
+        call_command('runjobs', once=True, interval=0, stdout=out)
+        self.assertEqual(out.getvalue(), '')
+        job.refresh_from_db()
+        self.assertEqual(job.state, Job.QUEUED)
+
+class RunJobTest(JobTestMixin, TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubFilletHandler)
+        self.server.calls = []
+        self.server.unavailable = 0
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        client = FilletClient(base_url='http://127.0.0.1:%d' % self.server.server_address[1], retries=0)
+        patcher = mock.patch('secretsauce.apps.portal.jobs.fillet', client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(client.close)
+        self.project, self.trained_model = self.create_project("McDonald's")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_optimize(self):
+        constraint_block = ConstraintBlock.objects.create(project=self.project, name="First ConstraintBlock")
+        optimizer = Optimizer.objects.create(trained_model=self.trained_model, constraint_block=constraint_block, population=10)
+        Job.enqueue(Job.OPTIMIZE, self.project, optimizer=optimizer)
+        job = Job.claim(1)[0]
+        run_job(job)
+        job.refresh_from_db()
+        self.assertEqual(job.state, Job.SUBMITTED)
+        call = self.server.calls[0]
+        self.assertEqual(call['path'], '/optimize/')
+        payload = json.loads(call['body'])
+        self.assertEqual((payload['optimisation_id'], payload['population']), (str(optimizer.id), 10))
+        self.assertEqual(payload['constraints'], [[], [], [], True])
+
+    def test_failure(self):
+        # The DataBlock has no Parquet file to send
+        job = self.enqueue(self.project, self.trained_model, 1)[0]
+        run_job(Job.claim(1)[0])
+        job.refresh_from_db()
+        self.assertEqual(job.state, Job.QUEUED)
+        self.assertTrue(job.error)
+        self.assertEqual(self.server.calls, [])
+
+    def test_ingest_failure(self):
+        data_block = self.trained_model.data_block
+        DataBlock.objects.filter(id=data_block.id).update(state=DataBlock.INGESTING, pct_complete=0)
+        job = Job.enqueue(Job.INGEST, self.project, data_block=data_block)
+        # The upload does not exist, the DataBlock is FAILED once the retries are used up
+        with self.settings(JOB_MAX_ATTEMPTS=2):
+            for attempt in range(2):
+                Job.objects.filter(id=job.id).update(run_after=timezone.now())
+                run_job(Job.claim(1)[0])
+                data_block.refresh_from_db()
+                self.assertEqual(data_block.state, [DataBlock.INGESTING, DataBlock.FAILED][attempt])
+        job.refresh_from_db()
+        self.assertEqual(job.state, Job.FAILED)
+        self.assertEqual(data_block.get_errors(), {'detail': 'Ingestion failed'})
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_fetch_results(self):
+        TrainedPredictionModel.objects.filter(id=self.trained_model.id).update(pct_complete=100, cv_progress=100, fi_done=True, ee_done=True)
+        self.server.responses = {
+            '/get_feature_importances/': {'a': {'feature_name': {'0': 'Price_1'}, 'importance': {'0': 1.0}}},
+            '/get_elasticity_estimates/': {'1': {'pct': {'1': -1.5}, 'abs': {'1': -3}}},
+            '/get_cv_results/': json.dumps({'fold': {'0': 1}, 'score': {'0': 0.5}}),
+        }
+        job = Job.enqueue(Job.RESULTS, self.project, trained_model=self.trained_model)
+        run_job(Job.claim(1)[0])
+        job.refresh_from_db()
+        self.assertEqual(job.state, Job.SUCCEEDED)
+        self.trained_model.refresh_from_db()
+        self.assertEqual(self.trained_model.get_missing_results(), [])
+        with self.trained_model.feature_importance.open('rb') as f:
+            self.assertEqual(f.read(), b'model,feature_name,importance\na,Price_1,1.0\n')
+        with self.trained_model.cv_score.open('rb') as f:
+            self.assertEqual(f.read(), b'fold,score\n1,0.5\n')
+        self.assertEqual(json.loads(self.server.calls[0]['body']), {'project_id': str(self.trained_model.id)})
+
+    def test_rejected(self):
+        constraint_block = ConstraintBlock.objects.create(project=self.project, name="First ConstraintBlock")
+        optimizer = Optimizer.objects.create(trained_model=self.trained_model, constraint_block=constraint_block, population=10)
+        job = Job.enqueue(Job.OPTIMIZE, self.project, optimizer=optimizer)
+        # Fillet rejecting the request is not retried
+        self.server.rejected = {'/optimize/'}
+        run_job(Job.claim(1)[0])
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.attempts, job.error), (Job.FAILED, 1, 'Fillet answered 400 to /optimize/'))
+
+class JobAPITest(JobTestMixin, APITestCase):
+    def setUp(self):
+        self.project, self.trained_model = self.create_project("McDonald's")
+        self.user = User.objects.create_user(
+            "user1@mcdonald.com",
+            "pw123123",
+            company=self.project.company,
+        )
+        self.project.owners.add(self.user)
+        self.client.force_authenticate(user=self.user)
+
+    def test_train(self):
+        data = {
+            'prediction_model': self.trained_model.prediction_model_id,
+            'data_block': self.trained_model.data_block_id,
+            'name': "Second model",
+        }
+        response = self.client.post(reverse('trained-model-list'), data=data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((response.data['job']['kind'], response.data['job']['state']), (Job.TRAIN, Job.QUEUED))
+        job = Job.objects.get(id=response.data['job']['id'])
+        self.assertEqual((str(job.trained_model_id), job.company_id), (response.data['id'], self.project.company_id))
+
+        response = self.client.get(reverse('job-detail', args=[job.id]))
+        self.assertEqual(response.data['state'], Job.QUEUED)
+        response = self.client.get(reverse('job-list'), data={'project': self.project.id})
+        self.assertEqual([entry['id'] for entry in response.data], [str(job.id)])
+
+    def test_not_owner(self):
+        job = self.enqueue(self.project, self.trained_model, 1)[0]
+        self.project.owners.remove(self.user)
+        response = self.client.get(reverse('job-detail', args=[job.id]))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.get(reverse('job-list'), data={'project': self.project.id})
+        self.assertEqual(response.data, [])
+
+@override_settings(PROGRESS_POLL_INTERVAL=0)
+class ProgressStreamTest(JobTestMixin, APITestCase):
+    def setUp(self):
+        self.project, self.trained_model = self.create_project("McDonald's")
+        self.other_project, self.other_trained_model = self.create_project("Burger King")
+        self.user = User.objects.create_user(
+            "user1@mcdonald.com",
+            "pw123123",
+            company=self.project.company,
+        )
+        self.project.owners.add(self.user)
+        self.client.force_authenticate(user=self.user)
+
+    def get(self, **params):
+        response = self.client.get(reverse('progress-stream'), data=dict(project=self.project.id, **params))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_snapshot(self):
+        job = self.enqueue(self.project, self.trained_model, 1)[0]
+        data = self.get()
+        self.assertTrue(data['reset'])
+        self.assertEqual(data['changes'], [{
+            'kind': ProgressEvent.TRAINED_MODEL,
+            'id': str(self.trained_model.id),
+            'fields': {'pct_complete': 0, 'cv_progress': 0, 'fi_done': False, 'ee_done': False, 'job': Job.QUEUED},
+        }])
+
+    def test_changes(self):
+        version = self.get()['version']
+        data = self.get(since=version, wait=0)
+        self.assertEqual((data['version'], data['reset'], data['changes']), (version, False, []))
+
+        self.enqueue(self.project, self.trained_model, 1)
+        Job.claim(1)
+        TrainedPredictionModel.apply_progress({str(self.trained_model.id): {'pct_complete': 50, 'cv_progress': 0}})
+        TrainedPredictionModel.apply_progress({str(self.trained_model.id): {'pct_complete': 60}})
+        TrainedPredictionModel.apply_progress({str(self.other_trained_model.id): {'pct_complete': 10}})
+        # Only the fields that changed, with their last values
+        data = self.get(since=version, wait=0)
+        self.assertEqual(data['changes'], [{
+            'kind': ProgressEvent.TRAINED_MODEL,
+            'id': str(self.trained_model.id),
+            'fields': {'job': Job.RUNNING, 'pct_complete': 60},
+        }])
+        self.assertGreater(data['version'], version)
+
+        data = self.get(since=data['version'], wait=0)
+        self.assertEqual(data['changes'], [])
+
+    @override_settings(PROGRESS_LONG_POLL_TIMEOUT=0, PROGRESS_CLIENT_POLL_INTERVAL=2)
+    def test_short_poll(self):
+        version = self.get()['version']
+        # Answers at once, also when asked to wait longer than PROGRESS_LONG_POLL_TIMEOUT allows
+        started = time.monotonic()
+        data = self.get(since=version, wait=30)
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual((data['changes'], data['poll_after']), ([], 2))
+
+        for wait in ['nan', 'inf', 'soon']:
+            response = self.client.get(reverse('progress-stream'), data={'project': self.project.id, 'since': version, 'wait': wait})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_pruned(self):
+        version = self.get()['version']
+        TrainedPredictionModel.apply_progress({str(self.trained_model.id): {'pct_complete': 50}})
+        TrainedPredictionModel.apply_progress({str(self.trained_model.id): {'pct_complete': 60}})
+        ProgressEvent.objects.filter(id=ProgressEvent.objects.aggregate(Min('id'))['id__min']).delete()
+        data = self.get(since=version, wait=0)
+        self.assertTrue(data['reset'])
+        self.assertEqual(data['changes'][0]['fields']['pct_complete'], 60)
+
+    def test_not_owner(self):
+        self.project.owners.remove(self.user)
+        response = self.client.get(reverse('progress-stream'), data={'project': self.project.id})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.get(reverse('progress-stream'), data={'project': self.project.id, 'since': 'latest'})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+class ResultsTest(JobTestMixin, APITestCase):
+    def setUp(self):
+        self.project, self.trained_model = self.create_project("McDonald's")
+        self.user = User.objects.create_user(
+            "user1@mcdonald.com",
+            "pw123123",
+            company=self.project.company,
+        )
+        self.project.owners.add(self.user)
+        self.client.force_authenticate(user=self.user)
+
+    def test_enqueue_when_done(self):
+        TrainedPredictionModel.apply_progress({str(self.trained_model.id): {'pct_complete': 100, 'cv_progress': 50}})
+        self.assertFalse(Job.objects.filter(kind=Job.RESULTS).exists())
+        TrainedPredictionModel.apply_progress({str(self.trained_model.id): {'fi_done': True}})
+        TrainedPredictionModel.apply_progress({str(self.trained_model.id): {'cv_progress': 100}})
+        # One job fetches all the missing results
+        job = Job.objects.get(kind=Job.RESULTS)
+        self.assertEqual(job.trained_model_id, self.trained_model.id)
+        self.trained_model.refresh_from_db()
+        self.assertEqual(self.trained_model.get_missing_results(), ['feature_importance', 'cv_score'])
+
+    def test_redirect(self):
+        TrainedPredictionModel.objects.filter(id=self.trained_model.id).update(pct_complete=100, fi_done=True)
+        url = reverse('trainedmodels-feature-importance', args=[self.trained_model.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(Job.objects.filter(kind=Job.RESULTS).count(), 1)
+        self.client.get(url)
+        self.assertEqual(Job.objects.filter(kind=Job.RESULTS).count(), 1)
+
+        TrainedPredictionModel.objects.filter(id=self.trained_model.id).update(feature_importance='results/model_feature_importance.csv')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertTrue(response.url.endswith('results/model_feature_importance.csv'))
+
+    def test_frames(self):
+        df = feature_importance_frame({
+            'a': {'feature_name': {'0': 'Price_1', '1': 'Price_2'}, 'importance': {'1': 0.25, '0': 0.75}},
+            'b': {'feature_name': {'0': 'Price_1'}, 'importance': {'0': 1.0}},
+        })
+        self.assertEqual(df.values.tolist(), [['a', 'Price_1', 0.75], ['a', 'Price_2', 0.25], ['b', 'Price_1', 1.0]])
+
+        df = elasticity_frame({
+            '1': {'pct': {'1': -1.5, '2': 0.5}, 'abs': {'1': -3, '2': 1}},
+            '2': {'pct': {'1': 0.25, '2': -2.0}, 'abs': {'1': 0.5, '2': -4}},
+        })
+        self.assertEqual(list(df.columns), ['price_change_item', 'qty_change_item', 'pct', 'abs'])
+        self.assertEqual(df.values.tolist()[1], ['1', '2', 0.5, 1])
+        self.assertEqual(len(df), 4)
+
+        df = cv_score_frame(json.dumps({'fold': {'0': 1, '1': 2}, 'score': {'0': 0.5, '1': 0.75}}))
+        self.assertEqual(df.values.tolist(), [[1, 0.5], [2, 0.75]])
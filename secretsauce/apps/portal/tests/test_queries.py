@@ -0,0 +1,291 @@
+from django.core.cache import caches
+from django.core.management import call_command
+from django.test import TestCase, RequestFactory, override_settings
+from django.urls import reverse
+
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from secretsauce.apps.account.models import *
+from secretsauce.apps.portal.models import *
+from secretsauce.apps.portal.serializers import *
+from secretsauce.permissions import IsOwnerOrAdmin
+
+import io
+
+class ConstraintBlockQueryTest(TestCase):
+    def setUp(self):
+        self.company = Company.objects.create(
+            name="McDonald's"
+        )
+        self.project = Project.objects.create(title="First project", company=self.company)
+        self.constraint_block = ConstraintBlock.objects.create(project=self.project, name="First ConstraintBlock")
+
+    def create_constraints(self, count, terms):
+        params = [ConstraintParameter.objects.create(constraint_block=self.constraint_block, item_id=item_id) for item_id in range(terms)]
+        for idx in range(count):
+            constraint = Constraint.objects.create(
+                constraint_block=self.constraint_block,
+                name=f"Constraint {idx}",
+                in_equality="LEQ",
+                rhs_constant=idx,
+            )
+            ConstraintParameterRelationship.objects.bulk_create([
+                ConstraintParameterRelationship(constraint=constraint, constraint_parameter=param, coefficient=coefficient + 1)
+                for coefficient, param in enumerate(params)
+            ])
+
+    def test_get_list(self):
+        self.create_constraints(2, 3)
+        Constraint.objects.create(constraint_block=self.constraint_block, name="Empty", in_equality="EQ", rhs_constant=5)
+        constraint_list = {entry['shift']: entry for entry in self.constraint_block.get_list()}
+        self.assertEqual(len(constraint_list), 3)
+        entry = constraint_list[1]
+        self.assertEqual(sorted(zip(entry['products'], entry['scales'])), [(0, 1.0), (1, 2.0), (2, 3.0)])
+        self.assertEqual((entry['penalty'], entry['equality']), (0, 3))
+        self.assertEqual(constraint_list[5], {'products': [], 'scales': [], 'penalty': 0, 'equality': 0, 'shift': 5})
+
+    def test_get_list_query_count(self):
+        self.create_constraints(50, 20)
+        with self.assertNumQueries(1):
+            constraint_list = self.constraint_block.get_list()
+        self.assertEqual(len(constraint_list), 50)
+        self.assertTrue(all(len(entry['products']) == 20 for entry in constraint_list))
+
+    def test_get_list_empty(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.constraint_block.get_list(), [])
+
+    def test_constraint_display_query_count(self):
+        self.create_constraints(20, 5)
+        Item.objects.bulk_create([
+            Item(project=self.project, name=f"Item {item_id}", item_id=item_id, cost=1, price_floor=1, price_cap=2)
+            for item_id in range(5)
+        ])
+        constraints = Constraint.objects.filter(constraint_block=self.constraint_block)
+        with self.assertNumQueries(3):
+            data = ConstraintDisplaySerializer(constraints, many=True).data
+        self.assertEqual(len(data), 20)
+
+        constraint = Constraint.objects.get(id=data[0]['id'])
+        self.assertEqual(data[0]['equation'], constraint.equation)
+        self.assertEqual(data[0]['equation_name'], constraint.equation_name)
+        self.assertIn("[Item 0]", data[0]['equation_name'])
+
+        # Without names for all the items there is no equation_name
+        Item.objects.filter(item_id=4).delete()
+        data = ConstraintDisplaySerializer(constraints, many=True).data
+        self.assertIsNone(data[0]['equation_name'])
+        self.assertIsNotNone(data[0]['equation'])
+
+    def test_constraint_parameter_names(self):
+        params = [ConstraintParameter(constraint_block=self.constraint_block, item_id=item_id) for item_id in range(100)]
+        ConstraintParameter.objects.bulk_create(params)
+        Item.objects.create(project=self.project, name="Burger", item_id=1, cost=1, price_floor=1, price_cap=2)
+        self.project.cost_sheet = True
+        self.project.save()
+
+        with self.assertNumQueries(2):
+            data = ConstraintBlockCreateSerializer(self.constraint_block).data
+        names = {param['item_id']: param['item_name'] for param in data['params']}
+        self.assertEqual(names[1], "Burger")
+        self.assertIsNone(names[2])
+
+class DataBlockQueryTest(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(
+            name="McDonald's"
+        )
+        self.user = User.objects.create_user(
+            "user1@mcdonald.com",
+            "pw123123",
+            company=self.company,
+        )
+        self.other_user = User.objects.create_user(
+            "user2@mcdonald.com",
+            "pw123123",
+            company=self.company,
+        )
+        self.project = Project.objects.create(title="First project", company=self.company, cost_sheet=True)
+        self.project.owners.add(self.user)
+
+    def create_data_block(self, name, size):
+        data_block = DataBlock.objects.create(project=self.project, name=name, upload='uploads/test.csv')
+        DataBlockHeader.objects.bulk_create([DataBlockHeader(data_block=data_block, item_id=item_id) for item_id in range(size)])
+        return data_block
+
+    def test_schema_query_count(self):
+        Item.objects.bulk_create([
+            Item(project=self.project, name=f"Item {item_id}", item_id=item_id, cost=1, price_floor=1, price_cap=2)
+            for item_id in range(0, 1000, 2)
+        ])
+        for size in (10, 1000):
+            data_block = self.create_data_block(f"Block {size}", size)
+            with self.assertNumQueries(2):
+                data = DataBlockSingleSerializer(data_block).data
+            self.assertEqual(len(data['schema']), size)
+            names = {header['item_id']: header['item_name'] for header in data['schema']}
+            self.assertEqual(names[4], "Item 4")
+            self.assertIsNone(names[5])
+
+    def test_list_query_count(self):
+        for idx in range(20):
+            self.create_data_block(f"Block {idx}", 5)
+        self.client.force_authenticate(user=self.user)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('data-block-list'), data={'project': self.project.id})
+        self.assertEqual(len(response.data), 20)
+
+        # Objects of projects the user does not own are filtered out
+        self.client.force_authenticate(user=self.other_user)
+        response = self.client.get(reverse('data-block-list'), data={'project': self.project.id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 0)
+
+    def test_list_pagination(self):
+        data_blocks = [self.create_data_block(f"Block {idx}", 1) for idx in range(5)]
+        self.client.force_authenticate(user=self.user)
+        url = reverse('data-block-list')
+
+        response = self.client.get(url, data={'project': self.project.id})
+        self.assertEqual(len(response.data), 5)
+
+        response = self.client.get(url, data={'project': self.project.id, 'page_size': 2})
+        names = [data_block['name'] for data_block in response.data['results']]
+        while response.data['next']:
+            with self.assertNumQueries(1):
+                response = self.client.get(response.data['next'])
+            names += [data_block['name'] for data_block in response.data['results']]
+        # Newest first
+        self.assertEqual(names, [data_block.name for data_block in reversed(data_blocks)])
+
+class ListQueryCountMixin:
+    """Checks that the number of queries of a list endpoint does not grow with its rows"""
+
+    row_counts = (10, 100, 1000)
+
+    def assertListQueries(self, num, url, data, create_rows, existing=0):
+        """
+        Lists `url` once `create_rows(indices)` has added rows up to each of `row_counts`
+        and asserts that every request takes `num` queries, `existing` rows being listed as well
+        """
+        created = 0
+        for count in self.row_counts:
+            create_rows(range(created, count))
+            created = count
+            with self.assertNumQueries(num):
+                response = self.client.get(url, data=data)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(len(response.data), count + existing)
+
+@override_settings(OWNED_PROJECTS_CACHE_TIMEOUT=0)
+class ListQueryTest(ListQueryCountMixin, APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(
+            name="McDonald's"
+        )
+        self.user = User.objects.create_user(
+            "user1@mcdonald.com",
+            "pw123123",
+            company=self.company,
+        )
+        self.project = Project.objects.create(title="First project", company=self.company)
+        self.project.owners.add(self.user)
+        self.data_block = DataBlock.objects.create(project=self.project, name="First DataBlock", upload='uploads/test.csv')
+        self.constraint_block = ConstraintBlock.objects.create(project=self.project, name="First ConstraintBlock")
+        self.prediction_model = PredictionModel.objects.create(name="First PredictionModel")
+        self.client.force_authenticate(user=self.user)
+
+    def create_trained_models(self, indices):
+        return TrainedPredictionModel.objects.bulk_create([
+            TrainedPredictionModel(
+                prediction_model=self.prediction_model,
+                data_block=self.data_block,
+                name=f"Model {idx}",
+                pct_complete=100,
+                cv_progress=100,
+                fi_done=True,
+                ee_done=True,
+            )
+            for idx in indices
+        ])
+
+    def test_projects(self):
+        def create_projects(indices):
+            projects = Project.objects.bulk_create([Project(title=f"Project {idx}", company=self.company) for idx in indices])
+            self.user.project_set.add(*projects)
+            for project in projects:
+                DataBlock.objects.create(project=project, name="DataBlock", upload='uploads/test.csv')
+        self.assertListQueries(4, reverse('project-list'), {}, create_projects, existing=1)
+
+    def test_prediction_models(self):
+        tag = ModelTag.objects.create(name="First tag")
+        def create_prediction_models(indices):
+            prediction_models = PredictionModel.objects.bulk_create([PredictionModel(name=f"Model {idx}") for idx in indices])
+            tag.models.add(*prediction_models)
+        self.assertListQueries(2, reverse('prediction-model-list'), {}, create_prediction_models, existing=1)
+
+    def test_trained_models(self):
+        self.assertListQueries(3, reverse('trained-model-list'), {'project': self.project.id}, self.create_trained_models)
+
+    def test_optimizers(self):
+        trained_model = self.create_trained_models([0])[0]
+        def create_optimizers(indices):
+            Optimizer.objects.bulk_create([Optimizer(trained_model=trained_model, constraint_block=self.constraint_block) for idx in indices])
+        self.assertListQueries(1, reverse('optimizer-list'), {'project': self.project.id}, create_optimizers)
+
+class IsOwnerOrAdminTest(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.company = Company.objects.create(
+            name="McDonald's"
+        )
+        self.user = User.objects.create_user(
+            "user1@mcdonald.com",
+            "pw123123",
+            company=self.company,
+        )
+        self.project = Project.objects.create(title="First project", company=self.company)
+        self.project.owners.add(self.user)
+        self.data_blocks = [DataBlock.objects.create(project=self.project, name=f"Block {idx}", upload='uploads/test.csv') for idx in range(3)]
+        self.constraint_block = ConstraintBlock.objects.create(project=self.project, name="First ConstraintBlock")
+
+    def make_request(self):
+        request = RequestFactory().get('/')
+        request.user = self.user
+        return request
+
+    def test_per_request(self):
+        permission = IsOwnerOrAdmin()
+        request = self.make_request()
+        with self.assertNumQueries(1):
+            for obj in [self.project, self.constraint_block] + self.data_blocks:
+                self.assertTrue(permission.has_object_permission(request, None, obj))
+
+        # Later requests answer from the cache
+        with self.assertNumQueries(0):
+            self.assertTrue(permission.has_object_permission(self.make_request(), None, self.project))
+
+    def test_invalidation(self):
+        permission = IsOwnerOrAdmin()
+        self.assertTrue(permission.has_object_permission(self.make_request(), None, self.project))
+        self.project.owners.remove(self.user)
+        self.assertFalse(permission.has_object_permission(self.make_request(), None, self.project))
+        self.user.project_set.add(self.project)
+        self.assertTrue(permission.has_object_permission(self.make_request(), None, self.project))
+        self.project.owners.clear()
+        self.assertFalse(permission.has_object_permission(self.make_request(), None, self.project))
+
+    @override_settings(OWNED_PROJECTS_CACHE_TIMEOUT=0)
+    def test_without_cache(self):
+        permission = IsOwnerOrAdmin()
+        permission.has_object_permission(self.make_request(), None, self.project)
+        with self.assertNumQueries(1):
+            permission.has_object_permission(self.make_request(), None, self.project)
+
+class ExplainQueriesTest(TestCase):
+
+    def test_no_sequential_scans(self):
+        out = io.StringIO()
+        call_command('explainqueries', strict=True, stdout=out)
+        self.assertIn('No sequential scans', out.getvalue())
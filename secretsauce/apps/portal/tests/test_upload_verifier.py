@@ -0,0 +1,190 @@
+import hashlib, tempfile
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase
+
+from secretsauce.utils import *
+from secretsauce.apps.portal.models import DataBlock
+
+def make_upload(rows, headers=UploadVerifier.headers, name='test.csv'):
+    lines = [','.join(headers)] + [','.join(map(str, row)) for row in rows]
+    return SimpleUploadedFile(name, ('\n'.join(lines) + '\n').encode('utf-8'))
+
+class UploadVerifierTest(SimpleTestCase):
+
+    def test_valid_file(self):
+        upload = make_upload([[1, 1, 1, 1, 100, 5, 1.5], [2, 1, 1, 1, 200, 3, 2.5]])
+        verifier = UploadVerifier(upload)
+        self.assertEqual(verifier.errors, {})
+        self.assertEqual(verifier.get_schema(), {100, 200})
+
+    def test_wrong_headers(self):
+        upload = make_upload([[1, 1, 1, 1, 100, 5]], headers=UploadVerifier.headers[:-1])
+        with self.assertRaises(WrongHeaderCSVFile):
+            UploadVerifier(upload)
+
+    def test_empty_file(self):
+        with self.assertRaises(WrongHeaderCSVFile):
+            UploadVerifier(SimpleUploadedFile('test.csv', b''))
+
+    def test_unreadable_file(self):
+        with self.assertRaises(UnreadableCSVFile):
+            UploadVerifier(SimpleUploadedFile('test.csv', b'\xff\xfe\x00'))
+
+    def test_cell_errors(self):
+        upload = make_upload([[1, 1, 1, 1, 100, 5, 1.5], [2, 1, 1, 1, 200, '', 'abc']])
+        verifier = UploadVerifier(upload)
+        self.assertEqual(verifier.errors, {
+            'Col: Qty_, Row: 3': "Cell is empty",
+            'Col: Price_, Row: 3': "Cell value not allowed: abc",
+        })
+
+    def test_bool_cells(self):
+        upload = make_upload([[1, 1, 1, 1, 100, 'true', 1.5], [2, 1, 1, 1, 200, 'FALSE', 2.5]])
+        with tempfile.TemporaryFile() as parquet_file:
+            verifier = UploadVerifier(upload, parquet=parquet_file)
+            self.assertEqual(set(verifier.errors), {'Col: Qty_, Row: 2', 'Col: Qty_, Row: 3'})
+            parquet_file.seek(0)
+            self.assertEqual(pq.read_table(parquet_file).column('Qty_').to_pylist(), [None, None])
+
+    def test_whole_numbers(self):
+        upload = make_upload([[1.5, 1, 1, 1, 100, 5, 1.5], [2.0, 1, 1, 1, 1e30, 3.5, 2.5]])
+        with tempfile.TemporaryFile() as parquet_file:
+            verifier = UploadVerifier(upload, parquet=parquet_file)
+            self.assertEqual(verifier.errors, {
+                'Col: Wk, Row: 2': "Cell value not allowed: 1.5",
+                'Col: Item_ID, Row: 3': "Cell value not allowed: 1e+30",
+            })
+            parquet_file.seek(0)
+            table = pq.read_table(parquet_file)
+            # Not truncated
+            self.assertEqual(table.column('Wk').to_pylist(), [None, 2])
+            self.assertEqual(table.column('Item_ID').to_pylist(), [100, None])
+            self.assertEqual(table.column('Qty_').to_pylist(), [5, 3.5])
+        self.assertEqual(verifier.get_schema(), {100})
+
+    def test_float_semantics(self):
+        upload = make_upload([[1, 1, 1, 1, 100, ' 5 ', 'nan'], [2, 1, 1, 1, 200, '1e3', '-2.5']])
+        verifier = UploadVerifier(upload)
+        self.assertEqual(verifier.errors, {})
+        self.assertEqual(verifier.get_schema(), {100, 200})
+
+    def test_ragged_rows(self):
+        upload = SimpleUploadedFile('test.csv', b'Wk,Tier,Groups,Store,Item_ID,Qty_,Price_\n1,1,1,1,100,5\n2,1,1,1,200,3,2.5,9\n')
+        verifier = UploadVerifier(upload)
+        self.assertEqual(verifier.errors, {
+            'Col: Price_, Row: 2': "Cell is empty",
+            'Col: Price_, Row: 3': "Cell value not allowed: 2.5,9",
+        })
+        self.assertEqual(verifier.get_schema(), {100, 200})
+
+    def test_trailing_commas(self):
+        upload = SimpleUploadedFile('test.csv', b'Wk,Tier,Groups,Store,Item_ID,Qty_,Price_\n1,1,1,7,100,2,3.5,\n2,1,1,7,200,5,3.5,\n')
+        with tempfile.TemporaryFile() as parquet_file:
+            verifier = UploadVerifier(upload, parquet=parquet_file)
+            self.assertEqual(verifier.errors, {})
+            self.assertEqual(verifier.get_schema(), {100, 200})
+            parquet_file.seek(0)
+            table = pq.read_table(parquet_file)
+            self.assertEqual(table.column('Store').to_pylist(), [7, 7])
+            self.assertEqual(table.column('Price_').to_pylist(), [3.5, 3.5])
+
+    def test_long_first_row(self):
+        upload = SimpleUploadedFile('test.csv', b'Wk,Tier,Groups,Store,Item_ID,Qty_,Price_\n1,1,1,7,100,2,3.5,9\n2,1,1,7,200,5,3.5\n')
+        verifier = UploadVerifier(upload)
+        self.assertEqual(verifier.errors, {'Col: Price_, Row: 2': "Cell value not allowed: 3.5,9"})
+        self.assertEqual(verifier.get_schema(), {100, 200})
+
+    def test_max_errors(self):
+        upload = make_upload([[wk, 1, 1, 1, 100, 'x', 'y'] for wk in range(1, 11)])
+        verifier = UploadVerifier(upload, max_errors=5)
+        self.assertEqual(list(verifier.errors), [
+            'Col: Qty_, Row: 2', 'Col: Price_, Row: 2',
+            'Col: Qty_, Row: 3', 'Col: Price_, Row: 3',
+            'Col: Qty_, Row: 4',
+        ])
+
+    def test_error_counts(self):
+        upload = make_upload([[wk, 1, 1, 1, 100, 'x', 'y' if wk % 2 else 1.5] for wk in range(1, 11)])
+        verifier = UploadVerifier(upload, max_errors=3)
+        self.assertEqual(len(verifier.errors), 3)
+        self.assertEqual(verifier.errors.columns, {'Qty_': 10, 'Price_': 5})
+        self.assertEqual(verifier.errors.rows, 10)
+        self.assertEqual(verifier.errors.summary()['total'], 15)
+
+    def test_error_rate(self):
+        rows = [[wk, 1, 1, 1, 100, 5, 1.5] for wk in range(1, 101)] + [[wk, 1, 1, 1, 100, 'x', 1.5] for wk in range(101, 201)]
+        verifier = UploadVerifier(make_upload(rows), max_error_rate=0.6)
+        self.assertEqual(verifier.errors.rows, 100)
+
+        verifier = UploadVerifier(max_error_rate=0.4)
+        verifier.abort_min_rows = 100
+        content = make_upload(rows).read()
+        with self.assertRaises(TooManyErrorsCSVFile):
+            for start in range(0, len(content), 64):
+                verifier.feed(content[start:start + 64])
+            verifier.close()
+        self.assertLess(verifier.row_count, len(rows))
+
+    def test_small_chunks(self):
+        rows = [[wk, 1, 1, 1, 100 + wk % 7, wk, 1.5] for wk in range(1, 200)]
+        upload = make_upload(rows)
+        verifier = UploadVerifier()
+        for chunk in upload.chunks(7):
+            verifier.feed(chunk)
+        verifier.close()
+        self.assertEqual(verifier.row_count, len(rows))
+        self.assertEqual(verifier.errors, {})
+        self.assertEqual(verifier.get_schema(), set(range(100, 107)))
+        # The checksum does not depend on where the chunks were split
+        upload.seek(0)
+        self.assertEqual(verifier.checksum, hashlib.sha256(upload.read()).hexdigest())
+
+class CostSheetVerifierTest(SimpleTestCase):
+
+    def test_get_items(self):
+        upload = make_upload([
+            [1, 1, 1, 100, '"Big Mac, Large"', 1, 2.0, 5.0, 4.0, 6.0],
+            [2, 1, 1, 100, '"Big Mac, Large"', 1, 2.0, 5.0, 3.5, 5.5],
+            [1, 1, 1, 200, 'Fries', 1, 0.5, 2.0, 1.5, 2.5],
+        ], headers=CostSheetVerifier.headers)
+        items = CostSheetVerifier(upload).get_items()
+        self.assertEqual(items.index.tolist(), [100, 200])
+        self.assertEqual(items.loc[100].tolist(), ['Big Mac, Large', 2.0, 3.5, 6.0])
+        self.assertEqual(items.loc[200].tolist(), ['Fries', 0.5, 1.5, 2.5])
+
+    def test_state(self):
+        content = make_upload([
+            [1, 1, 1, 100, 'Burger', 1, 2.0, 5.0, 4.0, 6.0],
+            [1, 1, 1, 200, 'Fries', 1, 0.5, 2.0, 1.5, 2.5],
+            [2, 1, 1, 100, 'Burger', 1, 2.5, 5.0, 3.5, 5.5],
+        ], headers=CostSheetVerifier.headers).read()
+        end = content.index(b'Fries')
+        verifier = CostSheetVerifier()
+        verifier.feed(content[:end])
+        resumed = CostSheetVerifier()
+        resumed.set_state(verifier.get_state())
+        resumed.feed(content[end:])
+        resumed.close()
+        self.assertEqual(resumed.get_items().loc[100].tolist(), ['Burger', 2.5, 3.5, 6.0])
+        self.assertEqual(resumed.get_items().index.tolist(), [100, 200])
+
+class SortParquetTest(SimpleTestCase):
+
+    def test_sort_and_prune(self):
+        rows = [[wk, 1, 1, store, item, wk, 1.0] for wk in range(1, 11) for store in (1, 2) for item in range(100, 150)]
+        with tempfile.TemporaryFile() as unsorted_file, tempfile.TemporaryFile() as sorted_file:
+            UploadVerifier(make_upload(rows), parquet=unsorted_file)
+            unsorted_file.seek(0)
+            sort_parquet(unsorted_file, sorted_file, 'Item_ID', bucket_rows=100, row_group_size=40)
+            sorted_file.seek(0)
+            parquet_file = pq.ParquetFile(sorted_file)
+            df = parquet_file.read().to_pandas()
+            self.assertEqual(len(df), len(rows))
+            self.assertTrue(df['Item_ID'].is_monotonic_increasing)
+            # Rows of the same item keep their original order
+            self.assertEqual(list(df[df['Item_ID'] == 120]['Wk']), [wk for wk in range(1, 11) for store in (1, 2)])
+
+            row_groups = DataBlock.row_groups_for(parquet_file, [120])
+            self.assertEqual(len(row_groups), 1)
+            self.assertIn(120, parquet_file.read_row_groups(row_groups).column('Item_ID').to_pylist())
@@ -22,11 +22,17 @@ router.register(r'trainedmodels', views.TrainedModelInfo, basename='trainedmodel
 urlpatterns = [
     path('datablocks/', views.DataBlockList.as_view(), name='data-block-list'),
     path('datablocks/<uuid:pk>', views.DataBlockDetail.as_view(), name='data-block-detail'),
+    path('datablocks/<uuid:pk>/progress/', views.DataBlockProgress.as_view(), name='data-block-progress'),
 
     path('projects/', views.ProjectList.as_view(), name='project-list'),
     path('projects/<uuid:pk>', views.ProjectDetail.as_view(), name='project-detail'),
     path('projects/<uuid:pk>/items/', views.ProjectItems.as_view(), name='item-directory-list'),
 
+    path('uploads/', views.UploadSessionCreate.as_view(), name='upload-session-create'),
+    path('uploads/<uuid:pk>', views.UploadSessionDetail.as_view(), name='upload-session-detail'),
+    path('uploads/<uuid:pk>/chunks/<int:index>', views.UploadSessionChunk.as_view(), name='upload-session-chunk'),
+    path('uploads/<uuid:pk>/finalize/', views.UploadSessionFinalize.as_view(), name='upload-session-finalize'),
+
     path('constraintsets/', views.ConstraintBlockListCreate.as_view()),
     path('constraintsets/<uuid:pk>', views.ConstraintBlockDetail.as_view()),
     path('constraintsets/<uuid:pk>/parameters/', views.ConstraintBlockItems.as_view()),
@@ -40,9 +46,14 @@ urlpatterns = [
     path('modeltags/', views.ModelTagList.as_view(), name='model-tag-list'),
     path('modeltags/<int:pk>', views.ModelTagDetail.as_view(), name='model-tag-detail'),
 
-    path('trainedmodels/', views.TrainModel.as_view()), 
+    path('trainedmodels/', views.TrainModel.as_view(), name='trained-model-list'),
     path('trainedmodels/<uuid:pk>', views.TrainedModelDetail.as_view()),
+    path('trainedmodels/progress/', views.FilletProgress.as_view(), name='fillet-progress'),
 
-    path('optimizers/', views.OptimizerListCreate.as_view()),
+    path('optimizers/', views.OptimizerListCreate.as_view(), name='optimizer-list'),
     path('optimizers/<uuid:pk>', views.OptimizerDetail.as_view()),
+
+    path('jobs/', views.JobList.as_view(), name='job-list'),
+    path('progress/', views.ProgressStream.as_view(), name='progress-stream'),
+    path('jobs/<uuid:pk>', views.JobDetail.as_view(), name='job-detail'),
 ] + router.urls
\ No newline at end of file
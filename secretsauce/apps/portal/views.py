@@ -4,24 +4,27 @@ from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from rest_framework.decorators import permission_classes, action
 from rest_framework.exceptions import ParseError, ValidationError
 
+from django.conf import settings
 from django.db.models.query import QuerySet
 from django.http import FileResponse, Http404, HttpResponseRedirect
 from django.shortcuts import get_object_or_404, redirect
-from django.core.files.base import ContentFile
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.core.exceptions import ValidationError as DjangoValidationError
 
 from secretsauce.apps.portal.models import *
 from secretsauce.apps.portal.serializers import *
-from secretsauce.permissions import IsOwnerOrAdmin, AdminOrReadOnly
-from secretsauce.utils import UploadVerifier, CostSheetVerifier
-
+from secretsauce.apps.portal.cache import cached_response
+from secretsauce.apps.portal.jobs import store_optimizer_results
+from secretsauce.fillet import fillet, FilletError
+from secretsauce.pagination import KeysetPagination
+from secretsauce.permissions import IsOwnerOrAdmin, IsOwnerOrAdminFilter, AdminOrReadOnly, FilletSignature
+from secretsauce.utils import UploadVerifier, CostSheetVerifier, DataBlockNotReady, ResultsNotReady, obfuscate_upload_link
+
+import numpy as np
 import pandas as pd
-import pyarrow as pa
-import pyarrow.parquet as pq
-from collections import defaultdict
-from threading import Thread
-import os, requests, json, re
-
-FILLET = 'https://fillet.azurewebsites.net'
+import math, os, json, re, tempfile, time
 
 class DataBlockList(generics.ListCreateAPIView):
     """
@@ -33,25 +36,24 @@ class DataBlockList(generics.ListCreateAPIView):
     """
     queryset = DataBlock.objects.all()
     serializer_class = DataBlockListSerializer
+    pagination_class = KeysetPagination
     parser_classes = [MultiPartParser, FormParser]
     permission_classes = [IsOwnerOrAdmin]
+    filter_backends = [IsOwnerOrAdminFilter]
 
     def create(self, request, *args, **kwargs):
+        """
+        Stores the upload and returns 202 with the DataBlock in the 'ingesting' state.
+        Verification and ingestion run in the runjobs worker, their progress is at datablocks/<uuid>/progress/
+        """
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid():
-            verifier = UploadVerifier(request.FILES['upload'])
-            item_ids = verifier.get_schema()
-            self.perform_create(serializer, item_ids)
+            data_block = serializer.save(state=DataBlock.INGESTING, pct_complete=0)
             return_data = serializer.data
-            return_data['errors'] = verifier.errors
-            return Response(return_data, status=status.HTTP_201_CREATED)
+            Job.enqueue(Job.INGEST, data_block.project, data_block=data_block)
+            return Response(return_data, status=status.HTTP_202_ACCEPTED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-    def perform_create(self, serializer, item_ids):
-        data_block = serializer.save()
-        header_objects = [DataBlockHeader(data_block=data_block, item_id=item_id) for item_id in item_ids]
-        DataBlockHeader.objects.bulk_create(header_objects)
-
     def get_queryset(self):
         assert self.queryset is not None, (
         "'%s' should either include a `queryset` attribute, "
@@ -64,10 +66,7 @@ class DataBlockList(generics.ListCreateAPIView):
             # Ensure queryset is re-evaluated on each request.
             queryset = queryset.all()
         project = self.request.query_params.get('project')
-        projects = queryset.filter(project=project)
-        for p in projects:
-            self.check_object_permissions(self.request, p)
-        return projects
+        return queryset.filter(project=project)
         
 class DataBlockDetail(generics.RetrieveDestroyAPIView):
     """
@@ -78,49 +77,75 @@ class DataBlockDetail(generics.RetrieveDestroyAPIView):
     queryset = DataBlock.objects.all()
     serializer_class = DataBlockSingleSerializer
 
+class DataBlockProgress(generics.RetrieveAPIView):
+    """
+    Retrieve the ingestion state of a datablock, the percentage processed and the validation errors found
+    """
+
+    permission_classes = [IsOwnerOrAdmin]
+    queryset = DataBlock.objects.all()
+    serializer_class = DataBlockProgressSerializer
+
+def check_ready(data_block):
+    if data_block.state != DataBlock.READY:
+        raise DataBlockNotReady(detail=f'DataBlock is {data_block.state}')
+
+def check_results(trained_model, name):
+    """Raises ResultsNotReady until the runjobs worker has fetched the result file `name` from Fillet"""
+    if not getattr(trained_model, name):
+        # Normally enqueued when Fillet reports the results are done, again in case that job failed
+        Job.enqueue_once(Job.RESULTS, trained_model.data_block.project, trained_model=trained_model)
+        raise ResultsNotReady()
+
 class DataBlockPrice(viewsets.ViewSet):
 
     @action(methods=['get'], detail=True, permission_classes=[IsOwnerOrAdmin])
     def average_prices(self, request, pk):
         data_block = get_object_or_404(DataBlock.objects.all(), id=pk)
         self.check_object_permissions(request, data_block)
-        df = pd.read_csv(data_block.upload).drop(['Wk', 'Tier', 'Groups', 'Store', 'Qty_'], axis=1)
-        df = df.groupby(['Item_ID']).mean()
-        output = df.to_dict()['Price_']
-        return Response(output)
+        check_ready(data_block)
+        return cached_response(request, data_block, lambda: self.obtain_average_prices(data_block))
+
+    def obtain_average_prices(self, data_block):
+        table = data_block.aggregates('Item_ID')
+        means = table['Price_.sum'] / table['Price_.count']
+        return dict(zip(table['Item_ID'].astype(np.int64).tolist(), means.tolist()))
 
 class VizDataBlock(viewsets.ViewSet):
 
     permission_classes=[IsOwnerOrAdmin]
     parser_classes = [MultiPartParser]
-    max_query_size = 10
+    max_query_size = 100
 
     @action(methods=['get'], detail=True, url_path='vizdata/price', url_name='viz-price', )
     def price(self, request, pk, *args, **kwargs):
         data_block = self.get_object(pk)
         self.check_object_permissions(request, data_block)
-
-        if 'items' not in request.query_params:
-            raise ParseError(detail="'items' required in query_params", code='invalid_data')
-
-        items = request.query_params.get('items').split(',')
-        try:
-            items = list(map(int, items))
-        except ValueError as e:
-            raise ParseError(e)
-
-        if len(items) > self.max_query_size:
-            raise ParseError(detail=f'Query is too large, maximum of {self.max_query_size} items only', code='query_size_exceeded')
-
-        body = self.obtain_prices(data_block.upload, items)
-
-        return Response(body, status=status.HTTP_200_OK)
+        items = self.get_items(request)
+        return cached_response(request, data_block, lambda: self.obtain_prices(data_block, items))
 
     @action(methods=['get'], detail=True, url_path='vizdata/qty', url_name='viz-qty')
     def qty(self, request, pk, *args, **kwargs):
         data_block = self.get_object(pk)
         self.check_object_permissions(request, data_block)
+        items = self.get_items(request)
+        return cached_response(request, data_block, lambda: self.obtain_quantities(data_block, items))
 
+    @action(methods=['get'], detail=True, url_path='vizdata/store', url_name='viz-store')
+    def store(self, request, pk, *args, **kwargs):
+        data_block = self.get_object(pk)
+        self.check_object_permissions(request, data_block)
+        items = self.get_items(request)
+        return cached_response(request, data_block, lambda: self.obtain_breakdown(data_block, items, 'Store'))
+
+    @action(methods=['get'], detail=True, url_path='vizdata/tier', url_name='viz-tier')
+    def tier(self, request, pk, *args, **kwargs):
+        data_block = self.get_object(pk)
+        self.check_object_permissions(request, data_block)
+        items = self.get_items(request)
+        return cached_response(request, data_block, lambda: self.obtain_breakdown(data_block, items, 'Tier'))
+
+    def get_items(self, request):
         if 'items' not in request.query_params:
             raise ParseError(detail="'items' required in query_params", code='invalid_data')
 
@@ -132,59 +157,75 @@ class VizDataBlock(viewsets.ViewSet):
 
         if len(items) > self.max_query_size:
             raise ParseError(detail=f'Query is too large, maximum of {self.max_query_size} items only', code='query_size_exceeded')
-
-        body = self.obtain_quantities(data_block.upload, items)
-
-        return Response(body, status=status.HTTP_200_OK)
+        return items
 
     def get_object(self, pk):
         try:
-            return DataBlock.objects.get(id=pk)
+            data_block = DataBlock.objects.get(id=pk)
         except DataBlock.DoesNotExist:
             raise Http404
-
-    def obtain_prices(self, file, items):
-        df = pd.read_csv(file, encoding='utf-8')
-        df = df[df['Item_ID'].isin(items)][['Item_ID', 'Price_']]
-        output = defaultdict(list)
-        for idx, row in df.iterrows():
-            item_id = int(row['Item_ID'])
-            price = row['Price_']
-            output[item_id].append(price)
-        final_output = sorted([(k, v) for k, v in output.items()], key=lambda x: x[0])
-        items, datasets = zip(*final_output)
-        final_output = {
-            'items': items,
-            'datasets': datasets
+        check_ready(data_block)
+        return data_block
+
+    def obtain_prices(self, data_block, items):
+        df = data_block.read_frame(columns=['Item_ID', 'Price_'], items=items)
+        return self.prices_by_item(df)
+
+    def obtain_quantities(self, data_block, items):
+        table = data_block.aggregates('Wk', items)
+        return self.weekly_quantities(table.rename(columns={'Qty_.sum': 'Qty_'}))
+
+    def obtain_breakdown(self, data_block, items, dimension):
+        """Returns the total quantity and average price of each item for every value of `dimension`"""
+        table = data_block.aggregates(dimension, items)
+        values = np.unique(table[dimension].values)
+        datasets = dict()
+        for item_id, rows in table.groupby('Item_ID'):
+            rows = rows.set_index(dimension).reindex(values)
+            prices = rows['Price_.sum'] / rows['Price_.count']
+            datasets[int(item_id)] = {
+                'qty': rows['Qty_.sum'].fillna(0).tolist(),
+                'price': [None if np.isnan(price) else price for price in prices.tolist()],
+            }
+        return {
+            dimension.lower(): values.astype(np.int64).tolist(),
+            'datasets': datasets,
         }
-        return final_output
-
-    def obtain_quantities(self, file, items):
-        df = pd.read_csv(file, encoding='utf-8')
-        df = df[df['Item_ID'].isin(items)]
 
-        output = defaultdict(list)
-        max_week = 0
-        for idx, row in df.iterrows():
-            item_id = int(row['Item_ID'])
-            week = int(row['Wk'])
-            qty = row['Qty_']
-
-            max_week = max(week, max_week)
-            while len(output[item_id]) < max_week:
-                output[item_id].append(0)
+    @staticmethod
+    def prices_by_item(df):
+        """Returns the prices of each item in the order they appear in `df`, items sorted by Item_ID"""
+        df = df.sort_values('Item_ID', kind='mergesort')
+        item_ids, starts = np.unique(df['Item_ID'].values, return_index=True)
+        datasets = np.split(df['Price_'].values, starts[1:]) if len(item_ids) > 0 else []
+        return {
+            'items': item_ids.astype(np.int64).tolist(),
+            'datasets': [prices.tolist() for prices in datasets],
+        }
 
-            output[item_id][week - 1] += qty
-        final_output = {
+    @staticmethod
+    def weekly_quantities(df):
+        """Returns the total quantity of each item for every week from 1 to the last week in `df`"""
+        df = df[df['Wk'] >= 1]
+        max_week = int(df['Wk'].max()) if len(df) > 0 else 0
+        item_ids, item_idx = np.unique(df['Item_ID'].values, return_inverse=True)
+        week_idx = df['Wk'].values.astype(np.int64) - 1
+        totals = np.bincount(
+            item_idx * max_week + week_idx,
+            weights=df['Qty_'].fillna(0).values,
+            minlength=len(item_ids) * max_week,
+        ).reshape(len(item_ids), max_week)
+        return {
             'weeks': list(range(1, max_week + 1)),
-            'datasets': output,
+            'datasets': dict(zip(item_ids.astype(np.int64).tolist(), totals.tolist())),
         }
-        return final_output
 
 class ProjectList(generics.ListCreateAPIView):
 
-    queryset = Project.objects.all()
+    queryset = Project.objects.prefetch_related('owners', 'data_blocks', 'constraint_blocks')
     serializer_class = ProjectSerializer
+    pagination_class = KeysetPagination
+    cursor_ordering = ('id', )
 
     def get_queryset(self):
         user = self.request.user
@@ -195,16 +236,21 @@ class ProjectList(generics.ListCreateAPIView):
 class ProjectDetail(generics.RetrieveUpdateDestroyAPIView):
 
     permission_classes = [IsOwnerOrAdmin]
-    queryset = Project.objects.all()
+    queryset = Project.objects.prefetch_related('owners', 'data_blocks', 'constraint_blocks')
     serializer_class = ProjectSerializer
 
 class ProjectItems(views.APIView):
     """
-    Upload or delete list of Items from a Project
+    Upload, update or delete list of Items from a Project
+
+    Usage example:
+        upload: curl -X POST -F "file=@costs.csv" localhost:8000/projects/<uuid>/items/
+        update: curl -X PUT -F "file=@costs.csv" -F "remove_missing=true" localhost:8000/projects/<uuid>/items/
     """
 
     permission_classes = [IsOwnerOrAdmin]
     parser_classes = [MultiPartParser]
+    batch_size = 1000
 
     def post(self, request, pk, *args, **kwargs):
         project = get_object_or_404(Project.objects.all(), id=pk)
@@ -218,22 +264,92 @@ class ProjectItems(views.APIView):
             raise ParseError(detail='file is required', code='required')
 
         items = CostSheetVerifier(file_obj).get_items()
-        errors = [f'item_id: {item_id}, floor: {floor}, cap: {cap}' for item_id, (name, cost, floor, cap) in items.items() if floor > cap]
-        if len(errors) > 0:
-            raise ParseError({'floor/ceil mismatch': errors})
+        self.check_items(items)
         self.perform_create(project, items)
         return Response(status=status.HTTP_201_CREATED)
 
-    def perform_create(self, project, items):
+    @staticmethod
+    def check_items(items):
+        mismatched = items[items['floor'].values > items['cap'].values]
+        if len(mismatched) > 0:
+            errors = [f'item_id: {item_id}, floor: {floor}, cap: {cap}' for item_id, floor, cap in zip(mismatched.index.tolist(), mismatched['floor'].tolist(), mismatched['cap'].tolist())]
+            raise ParseError({'floor/ceil mismatch': errors})
+
+    @classmethod
+    def perform_create(cls, project, items):
+        """Creates the Items of `project`, raises ParseError if it got a cost sheet since it was read"""
         item_objs = [Item(project=project, 
                           name=name, 
                           item_id=item_id, 
                           cost=cost, 
                           price_floor=floor, 
-                          price_cap=cap) for item_id, (name, cost, floor, cap) in items.items()]
-        Item.objects.bulk_create(item_objs)
-        project.cost_sheet = True
-        project.save()
+                          price_cap=cap) for item_id, name, cost, floor, cap in zip(items.index.tolist(), items['name'].tolist(), items['cost'].tolist(), items['floor'].tolist(), items['cap'].tolist())]
+        with transaction.atomic():
+            # Checked again under the row lock: of two cost sheets sent at once, the second waits and sees the first
+            if Project.objects.select_for_update().get(id=project.id).cost_sheet:
+                raise ParseError(detail='Cost sheet already uploaded', code='cost_sheet_exists')
+            Item.objects.bulk_create(item_objs, batch_size=cls.batch_size)
+            project.cost_sheet = True
+            project.save()
+
+    def put(self, request, pk, *args, **kwargs):
+        """
+        Update the Items of a Project from a new cost sheet, only writing the Items that changed.
+        Items missing from the new cost sheet are kept unless `remove_missing` is true.
+        """
+        project = get_object_or_404(Project.objects.all(), id=pk)
+        self.check_object_permissions(request, project)
+
+        try:
+            file_obj = request.data['file']
+        except KeyError:
+            raise ParseError(detail='file is required', code='required')
+        remove_missing = str(request.data.get('remove_missing', '')).lower() in ('1', 'true')
+
+        items = CostSheetVerifier(file_obj).get_items()
+        self.check_items(items)
+        return Response(self.perform_upsert(project, items, remove_missing), status=status.HTTP_200_OK)
+
+    @classmethod
+    def perform_upsert(cls, project, items, remove_missing=False):
+        """Diffs `items` against the Items of `project` by item_id and applies the changes in one transaction"""
+        fields = ['name', 'cost', 'price_floor', 'price_cap']
+        with transaction.atomic():
+            existing = pd.DataFrame.from_records(
+                project.items.select_for_update().values_list('id', 'item_id', *fields),
+                columns=['id', 'item_id'] + fields,
+            ).set_index('item_id')
+            new = items.rename(columns={'floor': 'price_floor', 'cap': 'price_cap'})
+
+            is_new = ~new.index.isin(existing.index)
+            kept = new[~is_new]
+            current = existing.loc[kept.index]
+            changed = np.zeros(len(kept), dtype=bool)
+            for field in fields:
+                changed |= kept[field].values != current[field].values
+            updated = kept[changed]
+            created = new[is_new]
+            missing = existing.index[~existing.index.isin(new.index)]
+
+            def to_items(df, ids=None):
+                return [Item(id=id_, project=project, item_id=item_id, name=name, cost=cost, price_floor=floor, price_cap=cap)
+                        for id_, item_id, name, cost, floor, cap in zip(
+                            ids if ids is not None else [None] * len(df), df.index.tolist(),
+                            *(df[field].tolist() for field in fields))]
+
+            Item.objects.bulk_update(to_items(updated, current['id'][changed].tolist()), fields, batch_size=cls.batch_size)
+            Item.objects.bulk_create(to_items(created), batch_size=cls.batch_size)
+            if remove_missing:
+                project.items.filter(item_id__in=missing.tolist()).delete()
+            project.cost_sheet = True
+            project.save()
+
+        return {
+            'created': created.index.tolist(),
+            'updated': updated.index.tolist(),
+            'removed': missing.tolist() if remove_missing else [],
+            'unchanged': int(len(kept) - changed.sum()),
+        }
 
     def delete(self, request, pk, *args, **kwargs):
         project = get_object_or_404(Project.objects.all(), id=pk)
@@ -247,6 +363,170 @@ class ProjectItems(views.APIView):
         instance.cost_sheet = False
         instance.save()
 
+class UploadSessionCreate(generics.CreateAPIView):
+    """
+    Start a chunked upload of a DataBlock or a cost sheet.
+
+    The file is then sent as numbered chunks to uploads/<uuid>/chunks/<index>, starting
+    from 0, and assembled with uploads/<uuid>/finalize/.
+
+    Usage example:
+        curl -X POST -H "Content-Type: application/json" -d '{"project": "<uuid>", "kind": "datablock", "name": "test_file", "filename": "test.csv"}' localhost:8000/uploads/
+    """
+
+    permission_classes = [IsOwnerOrAdmin]
+    serializer_class = UploadSessionSerializer
+
+    def perform_create(self, serializer):
+        self.check_object_permissions(self.request, serializer.validated_data['project'])
+        serializer.save()
+
+class UploadSessionDetail(generics.RetrieveDestroyAPIView):
+    """
+    Retrieve the progress of a chunked upload, or abort it.
+    A client resumes an interrupted upload from `next_chunk`, at byte offset `received`.
+    Uploads that receive no chunk for UPLOAD_SESSION_MAX_AGE seconds are aborted by the runjobs worker.
+    """
+
+    permission_classes = [IsOwnerOrAdmin]
+    queryset = UploadSession.objects.all()
+    serializer_class = UploadSessionSerializer
+
+    def perform_destroy(self, instance):
+        instance.abort()
+
+class UploadSessionChunk(views.APIView):
+    """
+    Append a chunk, sent as the raw request body, to a chunked upload.
+
+    Chunks are verified as they arrive. A chunk that was already received is acknowledged
+    without being appended again, so resending the last chunk after a dropped connection is safe.
+
+    Usage example:
+        curl -X PUT --data-binary @chunk0 -H "Content-Type: application/octet-stream" localhost:8000/uploads/<uuid>/chunks/0
+    """
+
+    permission_classes = [IsOwnerOrAdmin]
+    max_chunk_size = 64 * 2**20
+    read_size = 2**16
+
+    def put(self, request, pk, index, *args, **kwargs):
+        with transaction.atomic():
+            session = get_object_or_404(UploadSession.objects.select_for_update(), id=pk)
+            self.check_object_permissions(request, session)
+            if session.completed:
+                raise ParseError(detail='Upload already finalized', code='upload_completed')
+            if index < session.next_chunk:
+                return Response(UploadSessionSerializer(session).data)
+            if index > session.next_chunk:
+                return Response(status=status.HTTP_409_CONFLICT, data={
+                    'detail': f'Expected chunk {session.next_chunk}',
+                    'next_chunk': session.next_chunk,
+                    'received': session.received,
+                })
+
+            try:
+                length = int(request.META.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                length = 0
+            if length <= 0:
+                raise ParseError(detail='Empty chunk', code='invalid_data')
+            if length > self.max_chunk_size:
+                raise ParseError(detail=f'Chunk is too large, maximum of {self.max_chunk_size} bytes only', code='chunk_size_exceeded')
+
+            verifier = session.get_verifier()
+            parts = session.parts
+            with open(session.upload.path, 'r+b') as upload, tempfile.TemporaryFile() as part:
+                # Drop whatever a previously interrupted request left after the last complete chunk
+                upload.truncate(session.received)
+                upload.seek(session.received)
+                if session.kind == UploadSession.DATA_BLOCK:
+                    verifier.parquet = part
+                try:
+                    self.receive(request.stream, length, upload, verifier)
+                except:
+                    upload.truncate(session.received)
+                    raise
+                if session.kind == UploadSession.DATA_BLOCK:
+                    verifier.flush_parquet()
+                    if part.tell() > 0:
+                        part.seek(0)
+                        parts.append(default_storage.save(obfuscate_upload_link(session, f'part-{index:06d}.parquet'), File(part)))
+
+            session.received += length
+            session.next_chunk += 1
+            session.set_state(verifier, parts)
+            session.save()
+        return Response(UploadSessionSerializer(session).data)
+
+    def receive(self, stream, length, upload, verifier):
+        remaining = length
+        while remaining > 0:
+            data = stream.read(min(self.read_size, remaining)) if stream is not None else b''
+            if not data:
+                raise ParseError(detail=f'Incomplete chunk, received {length - remaining} of {length} bytes', code='incomplete_chunk')
+            upload.write(data)
+            verifier.feed(data)
+            remaining -= len(data)
+
+class UploadSessionFinalize(views.APIView):
+    """
+    Verify the end of a chunked upload and create the DataBlock or the cost sheet Items from it.
+    The DataBlock is returned in the 'ingesting' state with 202, the runjobs worker sorts the verified
+    rows into its Parquet copy, the progress is at datablocks/<uuid>/progress/
+    """
+
+    permission_classes = [IsOwnerOrAdmin]
+
+    def post(self, request, pk, *args, **kwargs):
+        with transaction.atomic():
+            session = get_object_or_404(UploadSession.objects.select_for_update(), id=pk)
+            self.check_object_permissions(request, session)
+            if session.completed:
+                raise ParseError(detail='Upload already finalized', code='upload_completed')
+
+            verifier = session.get_verifier()
+            if session.kind == UploadSession.DATA_BLOCK:
+                # The INGEST job deletes the parts once they are ingested
+                data = self.create_data_block(session, verifier)
+                response_status = status.HTTP_202_ACCEPTED
+            else:
+                verifier.close()
+                items = verifier.get_items()
+                ProjectItems.check_items(items)
+                ProjectItems.perform_create(session.project, items)
+                data = {'items': len(items)}
+                session.state = ''
+                response_status = status.HTTP_201_CREATED
+
+            session.completed = True
+            session.save()
+        return Response(data, status=response_status)
+
+    def create_data_block(self, session, verifier):
+        if DataBlock.objects.filter(project=session.project, name=session.name).exists():
+            raise ParseError(detail='DataBlock with this name already exists in project.', code='unique')
+        parts = session.parts
+        with tempfile.TemporaryFile() as last_part:
+            verifier.parquet = last_part
+            verifier.close()
+            if last_part.tell() > 0:
+                last_part.seek(0)
+                parts.append(default_storage.save(obfuscate_upload_link(session, 'part-last.parquet'), File(last_part)))
+        data_block = DataBlock(
+            project=session.project,
+            name=session.name,
+            state=DataBlock.INGESTING,
+            pct_complete=0,
+            errors=json.dumps(verifier.errors.summary()),
+        )
+        data_block.upload.name = session.upload.name
+        data_block.save()
+        Job.enqueue(Job.INGEST, session.project, data_block=data_block)
+        session.data_block = data_block
+        session.set_state(verifier, parts)
+        return DataBlockListSerializer(data_block).data
+
 class ConstraintBlockListCreate(generics.ListCreateAPIView):
     """
     Create new ConstraintBlock from a specified DataBlock schema
@@ -254,6 +534,7 @@ class ConstraintBlockListCreate(generics.ListCreateAPIView):
 
     queryset = ConstraintBlock.objects.all()
     permission_classes = [IsOwnerOrAdmin]
+    filter_backends = [IsOwnerOrAdminFilter]
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -276,10 +557,7 @@ class ConstraintBlockListCreate(generics.ListCreateAPIView):
 
     def get_queryset(self):
         project = self.request.query_params.get('project')
-        projects = self.queryset.filter(project=project)
-        for p in projects:
-            self.check_object_permissions(self.request, p)
-        return projects
+        return self.queryset.filter(project=project)
 
     def get_serializer_class(self):
         if self.request.method == 'GET':
@@ -297,21 +575,20 @@ class ConstraintBlockItems(generics.ListAPIView):
     Retrieve ConstraintParameters associated to a ConstraintBlock
     """
     permission_classes = [IsOwnerOrAdmin]
+    filter_backends = [IsOwnerOrAdminFilter]
     queryset = ConstraintParameter.objects.all()
     serializer_class = ConstraintParameterSerializer
 
     def get_queryset(self):
-        constraint_block = ConstraintBlock.objects.get(id=self.kwargs.get('pk'))
-        constraint_blocks = self.queryset.filter(constraint_block=constraint_block)
-        for cb in constraint_blocks:
-            self.check_object_permissions(self.request, cb)
-        return constraint_blocks
+        return self.queryset.filter(constraint_block=self.kwargs.get('pk'))
 
 class ConstraintListAndCreate(generics.ListCreateAPIView):
     
     queryset = Constraint.objects.all()
     parser_classes =  [JSONParser]
     permission_classes = [IsOwnerOrAdmin]
+    filter_backends = [IsOwnerOrAdminFilter]
+    pagination_class = KeysetPagination
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -320,15 +597,11 @@ class ConstraintListAndCreate(generics.ListCreateAPIView):
             constraint_block = ConstraintBlock.objects.get(id=serializer.data.get('constraint_block'))
             constraint_list = constraint_block.get_list()
             price_bounds = constraint_block.project.get_price_bounds()
-            payload = json.dumps({
+            payload = {
                 'constraints': [constraint_list, price_bounds]
-            })
-            headers = {
-                'content-type': 'application/json',
-                'Accept-Charset': 'UTF-8'
             }
             try:
-                r = requests.post(FILLET + '/detect_conflict/', data=payload, headers=headers)
+                r = fillet.post('/detect_conflict/', payload)
                 if r.status_code == 200:
                     if json.loads(r.content)['conflict'] == 'Conflict exists':
                         serializer.instance.delete()
@@ -336,10 +609,7 @@ class ConstraintListAndCreate(generics.ListCreateAPIView):
                 else:
                     serializer.instance.delete()
                     raise ParseError(detail='Could not reach constraint conflict checker')
-            except requests.exceptions.ReadTimeout as e:
-                serializer.instance.delete()
-                raise ParseError(detail='Could not reach constraint conflict checker')
-            except requests.exceptions.ConnectTimeout as e:
+            except FilletError as e:
                 serializer.instance.delete()
                 raise ParseError(detail='Could not reach constraint conflict checker')
 
@@ -348,10 +618,7 @@ class ConstraintListAndCreate(generics.ListCreateAPIView):
 
     def get_queryset(self):
         constraint_block = self.request.query_params.get('constraint_block')
-        constraint_blocks = self.queryset.filter(constraint_block=constraint_block)
-        for cb in constraint_blocks:
-            self.check_object_permissions(self.request, cb)
-        return constraint_blocks
+        return self.queryset.filter(constraint_block=constraint_block)
 
     def get_serializer_class(self):
         if self.request.method == 'GET':
@@ -367,13 +634,13 @@ class ConstraintDetail(generics.RetrieveDestroyAPIView):
 class PredictionModelList(generics.ListCreateAPIView):
 
     permission_classes = [AdminOrReadOnly]
-    queryset = PredictionModel.objects.all()
+    queryset = PredictionModel.objects.prefetch_related('model_tags')
     serializer_class = PredictionModelSerializer
 
 class PredictionModelDetail(generics.RetrieveUpdateDestroyAPIView):
 
     permission_classes = [AdminOrReadOnly]
-    queryset = PredictionModel.objects.all()
+    queryset = PredictionModel.objects.prefetch_related('model_tags')
     serializer_class = PredictionModelSerializer
 
 class ModelTagList(generics.ListCreateAPIView):
@@ -390,38 +657,20 @@ class ModelTagDetail(generics.RetrieveUpdateDestroyAPIView):
 
 class TrainModel(generics.ListCreateAPIView):
 
-    queryset = TrainedPredictionModel.objects.all()
+    queryset = TrainedPredictionModel.objects.select_related('prediction_model', 'data_block')
     serializer_class = TrainedPredictionModelSerializer
+    pagination_class = KeysetPagination
     permission_classes = [IsOwnerOrAdmin]
 
     def create(self, request):
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid():
-            self.perform_create(serializer)
-            data_block = DataBlock.objects.get(id=serializer.data['data_block'])
-            df = pd.read_csv(data_block.upload, encoding='utf-8', )
-            table = pa.Table.from_pandas(df)
-            buf = pa.BufferOutputStream()
-            pq.write_table(table, buf)
-            files = {'data': buf.getvalue()}
-            model_type = PredictionModel.objects.get(id=serializer.data['prediction_model']).name
-            payload = {'cv_acc': True, 'project_id': serializer.data['id'], 'modeltype': model_type}
-            def r(url, data=None, files=None, timeout=None):
-                try:
-                    resp = requests.post(url, data=data, files=files, timeout=timeout)
-                except requests.exceptions.ReadTimeout: 
-                    pass
-                except requests.exceptions.ConnectTimeout:
-                    pass
-            Thread(target=r,
-                args=(FILLET + '/train/', ),
-                kwargs={
-                    'data': payload,
-                    'files': files,
-                    'timeout': (3.05, 10),
-                }).start()
-
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+            data_block = serializer.validated_data['data_block']
+            check_ready(data_block)
+            with transaction.atomic():
+                self.perform_create(serializer)
+                job = Job.enqueue(Job.TRAIN, data_block.project, trained_model=serializer.instance)
+            return Response(dict(serializer.data, job=JobSerializer(job).data), status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     def get_queryset(self):
@@ -433,53 +682,95 @@ class TrainModel(generics.ListCreateAPIView):
         except Project.DoesNotExist:
             raise Http404
         
+        # Progress is pushed by Fillet to FilletProgress
         data_blocks = project.data_blocks.all()
-        trained_models = self.queryset.filter(data_block__in=data_blocks)
-        unavailable = dict()
-        for tm in trained_models:
-            if tm.pct_complete != 100 or tm.cv_progress != 100 or tm.fi_done == False or tm.ee_done == False:
-                unavailable[str(tm.id)] = tm
-
-        payload = json.dumps({
-            'project_id_ls': list(unavailable.keys())
-        })
-        headers = {
-            'content-type': 'application/json',
-            'Accept-Charset': 'UTF-8',
-        }
-        try:
-            r = requests.post(FILLET + '/batch_query_progress/', data=payload, headers=headers, timeout=3.05)
-            if r.status_code == 200:
-                for tm_id, data in json.loads(r.content).items():
-                    if not (data == 'project not found' or data == 'training not started'):
-                        unavailable[tm_id].pct_complete = data.get('pct_complete')
-                        unavailable[tm_id].cv_progress = data.get('cv_progress')
-                        unavailable[tm_id].fi_done = data.get('fi_done')
-                        unavailable[tm_id].ee_done = data.get('ee_done')
-                        unavailable[tm_id].save()
-                    else:
-                        print(data)
-        except requests.exceptions.ReadTimeout as e:
-            pass
-        except requests.exceptions.ConnectTimeout as e:
-            pass
-        
-        return trained_models 
+        return self.queryset.filter(data_block__in=data_blocks)
 
     def get_serializer_class(self):
         if self.request.method == 'GET':
             return TraindePredictionModelDisplaySerializer
         return TrainedPredictionModelSerializer
 
+class FilletProgress(views.APIView):
+    """
+    Webhook Fillet pushes training progress to, as a mapping of TrainedPredictionModel id to
+    its pct_complete, cv_progress, fi_done and ee_done. Requests are signed with FILLET_WEBHOOK_SECRET.
+    """
+
+    authentication_classes = []
+    permission_classes = [FilletSignature]
+    parser_classes = [JSONParser]
+
+    def post(self, request, *args, **kwargs):
+        if not isinstance(request.data, dict):
+            raise ParseError(detail='Expected a mapping of trained model id to progress')
+        try:
+            updated, unknown = TrainedPredictionModel.apply_progress(request.data)
+        except DjangoValidationError as e:
+            raise ParseError(detail={'progress': e.messages})
+        return Response({'updated': updated, 'unknown': unknown})
+
+class ProgressStream(views.APIView):
+    """
+    Poll of the training and optimization progress of a project.
+
+    Without `since`, answers with the progress of the unfinished models and the open jobs. With
+    `since`, answers with the fields that changed after that version. Every answer holds the
+    version to ask with next, and `poll_after`, the seconds the client should wait before asking.
+
+    By default the answer is immediate. A request waits up to `wait` seconds for changes only as
+    far as PROGRESS_LONG_POLL_TIMEOUT allows, as a waiting request holds a sync worker for that
+    long. Keep it at 0 unless the site is served by workers that can afford to wait.
+
+    Changes are found by event id, see ProgressEvent for the events that can be missed, clients
+    should ask without `since` now and then to catch up.
+    """
+
+    permission_classes = [IsOwnerOrAdmin]
+
+    def get(self, request, *args, **kwargs):
+        try:
+            project = Project.objects.get(id=request.query_params['project'])
+            self.check_object_permissions(request, project)
+        except KeyError:
+            raise ParseError(detail="Please specify project")
+        except (Project.DoesNotExist, DjangoValidationError):
+            raise Http404
+
+        since = request.query_params.get('since')
+        if since is None:
+            return self.snapshot(project)
+        try:
+            since = int(since)
+            wait = float(request.query_params.get('wait', 0))
+        except ValueError:
+            raise ParseError(detail="since and wait have to be numbers")
+        if not math.isfinite(wait):
+            raise ParseError(detail="wait has to be a finite number")
+        wait = min(max(wait, 0), settings.PROGRESS_LONG_POLL_TIMEOUT)
+
+        deadline = time.monotonic() + wait
+        while True:
+            version, changes = ProgressEvent.changes(project, since)
+            if changes is None:
+                return self.snapshot(project)
+            if changes or time.monotonic() >= deadline:
+                return Response({'version': version, 'reset': False, 'changes': changes, 'poll_after': settings.PROGRESS_CLIENT_POLL_INTERVAL})
+            time.sleep(settings.PROGRESS_POLL_INTERVAL)
+
+    def snapshot(self, project):
+        version, changes = ProgressEvent.snapshot(project)
+        return Response({'version': version, 'reset': True, 'changes': changes, 'poll_after': settings.PROGRESS_CLIENT_POLL_INTERVAL})
+
 class TrainedModelDetail(generics.RetrieveDestroyAPIView):
     
-    queryset = TrainedPredictionModel.objects.all()
+    queryset = TrainedPredictionModel.objects.select_related('prediction_model', 'data_block')
     serializer_class = TraindePredictionModelDisplaySerializer
     permission_classes = [IsOwnerOrAdmin]
 
 class TrainedModelInfo(viewsets.ViewSet):
     
-    queryset = TrainedPredictionModel.objects.all()
+    queryset = TrainedPredictionModel.objects.select_related('prediction_model', 'data_block')
     serializer_class = TraindePredictionModelDisplaySerializer
     permission_classes = [IsOwnerOrAdmin]
     
@@ -492,34 +783,7 @@ class TrainedModelInfo(viewsets.ViewSet):
             raise ParseError(detail='Model has not finished training yet.')
         if trainedmodel.fi_done == False:
             raise ParseError(detail='Feature Importance has not been calculated yet.')
-        if not trainedmodel.feature_importance:
-            try:
-                payload = json.dumps({
-                    'project_id': str(trainedmodel.id)
-                })
-                headers = {
-                    'content-type': 'application/json',
-                    'Accept-Charset': 'UTF-8'
-                }
-                r = requests.post(FILLET + '/get_feature_importances/', data=payload, headers=headers, timeout=3.05)
-                if r.status_code == 200:
-                    records = []
-                    for model_id, obj in r.json().items():
-                        feature_names = obj['feature_name']
-                        importances = obj['importance']
-                        for idx in feature_names:
-                            record = dict()
-                            record['model'] = model_id
-                            record['feature_name'] = feature_names[idx]
-                            record['importance'] = importances[idx]
-                            records.append(record)
-                    df = pd.read_json(json.dumps(records), orient='records')
-                    file_name = f'{trainedmodel.name}_feature_importance.csv'
-                    csv_file = ContentFile(df.to_csv(line_terminator='\n', index=False))
-                    trainedmodel.feature_importance.save(file_name, csv_file)
-            except Exception as e:
-                print(e)
-                raise ParseError(e)
+        check_results(trainedmodel, 'feature_importance')
         return HttpResponseRedirect(redirect_to=trainedmodel.feature_importance.url, content_type="application/csv")
 
     @action(methods=['get'], detail=True)
@@ -531,36 +795,7 @@ class TrainedModelInfo(viewsets.ViewSet):
             raise ParseError(detail='Model has not finished training yet.')
         if trainedmodel.ee_done == False:
             raise ParseError(detail='Elasticity estimates have not been calculated yet.')
-        if not trainedmodel.elasticity:
-            try:
-                payload = json.dumps({
-                    'project_id': str(trainedmodel.id)
-                })
-                headers = {
-                    'content-type': 'application/json',
-                    'Accept-Charset': 'UTF-8'
-                }
-                r = requests.post(FILLET + '/get_elasticity_estimates/', data=payload, headers=headers, timeout=3.05)
-                if r.status_code == 200:
-                    if 'error' in r.json():
-                        raise ParseError(detail=r.json()['error'])
-                    records = dict()
-                    for price_change_item, ds in r.json().items():
-                        for change_type, qty_dict in ds.items():
-                            for qty_change_item, qty_change in qty_dict.items():
-                                key = str((price_change_item, qty_change_item))
-                                if key not in records:
-                                    records[key] = dict()
-                                    records[key]['price_change_item'] = price_change_item
-                                    records[key]['qty_change_item'] = qty_change_item
-                                records[key][change_type] = qty_change
-                    df = pd.read_json(json.dumps(list(records.values())), orient='records')
-                    file_name = f'{trainedmodel.name}_elasticity.csv'
-                    csv_file = ContentFile(df.to_csv(line_terminator='\n', index=False))
-                    trainedmodel.elasticity.save(file_name, csv_file)
-            except Exception as e:
-                print(e)
-                raise ParseError(e)
+        check_results(trainedmodel, 'elasticity')
         return HttpResponseRedirect(redirect_to=trainedmodel.elasticity.url, content_type="application/csv")
 
     @action(methods=['get'], detail=True)
@@ -572,25 +807,7 @@ class TrainedModelInfo(viewsets.ViewSet):
             raise ParseError(detail='Model has not finished training yet.')
         if trainedmodel.cv_progress != 100:
             raise ParseError(detail='Cross-validation has not been completed.')
-        if not trainedmodel.cv_score:
-            try:
-                payload = json.dumps({
-                    'project_id': str(trainedmodel.id)
-                })
-                headers = {
-                    'content-type': 'application/json',
-                    'Accept-Charset': 'UTF-8'
-                }
-                r = requests.post(FILLET + '/get_cv_results/', data=payload, headers=headers, timeout=3.05)
-                if r.status_code == 200:
-                    json_file = json.dumps(json.loads(r.json()))
-                    df = pd.read_json(json_file, orient='columns')
-                    file_name = f'{trainedmodel.name}_cv_score.csv'
-                    csv_file = ContentFile(df.to_csv(line_terminator='\n', index=False))
-                    trainedmodel.cv_score.save(file_name, csv_file)
-            except Exception as e:
-                print(e)
-                raise ParseError(e)
+        check_results(trainedmodel, 'cv_score')
         return HttpResponseRedirect(redirect_to=trainedmodel.cv_score.url, content_type="application/csv")
 
     @action(methods=['post'], detail=True, parser_classes=[JSONParser])
@@ -614,15 +831,11 @@ class TrainedModelInfo(viewsets.ViewSet):
         if len(errors) > 0:
             raise ParseError(detail=errors)
         try:
-            payload = json.dumps({
+            payload = {
                 'prices': prices,
                 'project_id': str(trainedmodel.id)
-            })
-            headers = {
-                'content-type': 'application/json',
-                'Accept-Charset': 'UTF-8'
             }
-            r = requests.post(FILLET + '/predict/', data=payload, headers=headers, timeout=10.5)
+            r = fillet.post('/predict/', payload)
             output = {re.sub("[^0-9]", "", k): [prices[re.sub("[^0-9]", "", k)], v]  for k, v in r.json()['qty_estimates'].items()}
             df = pd.DataFrame.from_dict(output, orient='index', columns=['price', 'qty'])
             return FileResponse(df.to_csv(line_terminator='\n'), content_type='application/csv', as_attachment=True, filename=f'{trainedmodel.name}_whatif.csv')
@@ -644,8 +857,10 @@ class ConstraintCategoryDetail(generics.RetrieveUpdateDestroyAPIView):
 
 class OptimizerListCreate(generics.ListCreateAPIView):
 
-    queryset = Optimizer.objects.all()
+    queryset = Optimizer.objects.select_related('constraint_block', 'trained_model')
     permission_classes = [IsOwnerOrAdmin]
+    filter_backends = [IsOwnerOrAdminFilter]
+    pagination_class = KeysetPagination
 
     @action(methods=['post'], detail=False, )
     def create(self, request):
@@ -685,58 +900,43 @@ class OptimizerListCreate(generics.ListCreateAPIView):
                     instance.delete()
                     raise ParseError(detail={'missing_items': errors})
 
-            constraints = [
-                constraint_block.get_list(), 
-                constraint_block.project.get_price_bounds(), 
-                cost_list, 
-                not instance.cost,
-            ]
-            try:
-                payload = json.dumps({
-                    'project_id': str(trainedmodel.id),
-                    'optimisation_id': str(instance.id),
-                    'constraints': constraints,
-                    'population': serializer.data['population'],
-                    'max_epoch': serializer.data['max_epoch'],
-                })
-                headers = {
-                'content-type': 'application/json',
-                'Accept-Charset': 'UTF-8'
-                }
-                def r(url, data=None, headers=headers, timeout=None):
-                    try:
-                        resp = requests.post(url, data=data, headers=headers, timeout=timeout)
-                    except requests.exceptions.ReadTimeout: 
-                        pass
-                    except requests.exceptions.ConnectTimeout:
-                        pass
-                Thread(target=r,
-                    args=(FILLET + '/optimize/', ),
-                    kwargs={
-                        'data': payload,
-                        'headers': headers,
-                        'timeout': (3.05, 10),
-                    }).start()
-            except Exception as e:
-                raise ParseError(e)
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+            job = Job.enqueue(Job.OPTIMIZE, constraint_block.project, optimizer=instance)
+            return Response(dict(serializer.data, job=JobSerializer(job).data), status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     def get_queryset(self):
         project = self.request.query_params.get('project')
-        projects = self.queryset.filter(trained_model__data_block__project=project)
-        for p in projects:
-            self.check_object_permissions(self.request, p)
-        return projects
+        return self.queryset.filter(trained_model__data_block__project=project)
 
     def get_serializer_class(self):
         if self.request.method == 'GET':
             return OptimizerDisplaySerializer
         return OptimizerCreateSerializer
 
+class JobList(generics.ListAPIView):
+    """
+    Jobs of a project run by the runjobs worker, to follow training and optimization submissions
+    """
+
+    queryset = Job.objects.all()
+    serializer_class = JobSerializer
+    permission_classes = [IsOwnerOrAdmin]
+    filter_backends = [IsOwnerOrAdminFilter]
+    pagination_class = KeysetPagination
+
+    def get_queryset(self):
+        project = self.request.query_params.get('project')
+        return self.queryset.filter(project=project)
+
+class JobDetail(generics.RetrieveAPIView):
+
+    queryset = Job.objects.all()
+    serializer_class = JobSerializer
+    permission_classes = [IsOwnerOrAdmin]
+
 class OptimizerDetail(generics.RetrieveDestroyAPIView):
 
-    queryset = Optimizer.objects.all()
+    queryset = Optimizer.objects.select_related('constraint_block', 'trained_model')
     serializer_class = OptimizerDisplaySerializer
     permission_classes = [IsOwnerOrAdmin]
 
@@ -744,48 +944,8 @@ class OptimizerDetail(generics.RetrieveDestroyAPIView):
         instance = self.get_object()
         if not instance.results:
             try:
-                payload = json.dumps({
-                    'project_id': str(instance.trained_model.id),
-                    'optimisation_id': str(instance.id)
-                })
-                headers = {
-                    'content-type': 'application/json',
-                    'Accept-Charset': 'UTF-8'
-                }
-                r = requests.post(FILLET + '/get_opti_results/', data=payload, headers=headers, timeout=3.05)
-                if r.status_code == 200:
-                    r_json = r.json()
-                    if 'error' in r_json:
-                        raise ParseError(r_json['error'])
-                    if 'status' in r_json:
-                        raise ParseError(r_json['status'])
-
-                    if r_json['success'] == False and r_json['type'] == 2:
-                        raise ParseError(r_json['info'])
-                    
-                    instance.estimated_profit = r_json['report'][0]
-                    instance.estimated_revenue = r_json['report'][1]
-                    instance.hard_violations = r_json['report'][2]
-                    instance.soft_violations = r_json['report'][3]
-
-                    json_file = json.dumps({
-                        'item': {idx: val for idx, val in enumerate(r_json['price_cols'])},
-                        'price': {idx: val for idx, val in enumerate(r_json['result'])}
-                    })
-                    df = pd.read_json(json_file, orient='columns')
-                    csv_file = df.to_csv(line_terminator='\n', index=False)
-                    for i in range(4):
-                        csv_file += f"{r_json['report_info'][i]},{r_json['report'][i]}\n"
-
-                    if instance.cost:
-                        cost = 'with-cost'
-                    else:
-                        cost = 'without-cost'
-                    file_name = f'{instance.trained_model.name}_{instance.constraint_block.name}_{cost}_results.csv'
-                    csv_file = ContentFile(csv_file)
-                    instance.results.save(file_name, csv_file)
+                store_optimizer_results(instance)
             except Exception as e:
-                print(e)
                 raise ParseError(e)
         serializer = self.get_serializer(instance)
         return Response(serializer.data)
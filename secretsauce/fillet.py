@@ -0,0 +1,93 @@
+from django.conf import settings
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import gzip, json, os, threading
+import requests
+
+# Raised by FilletClient.post when Fillet cannot be reached or does not answer in time
+FilletError = requests.exceptions.RequestException
+
+# Keyword of the HTTP methods a Retry applies to, named method_whitelist before urllib3 1.26
+RETRY_METHODS = 'allowed_methods' if hasattr(Retry, 'DEFAULT_ALLOWED_METHODS') else 'method_whitelist'
+
+class FilletClient:
+    """
+    Client of the Fillet modelling service.
+
+    All calls of a process share one requests.Session, whose HTTPAdapter keeps a pool of
+    up to `pool_size` kept-alive connections, so calls after the first skip the TCP and TLS
+    handshakes. Responses are asked for gzip, JSON request bodies of at least
+    `compress_min_size` bytes are gzipped when `compress` is set.
+
+    Calls are retried `retries` times with exponential backoff when no connection could be
+    made or Fillet answers 503, neither of which means the request was processed. Timed out
+    reads are not retried, as a training or optimization might then be started twice.
+    """
+
+    def __init__(self, base_url=None, pool_size=None, timeout=None, retries=None, backoff=None, compress=None, compress_min_size=None):
+        self.base_url = (base_url or settings.FILLET_URL).rstrip('/')
+        self.pool_size = pool_size or settings.FILLET_POOL_SIZE
+        self.timeout = timeout or settings.FILLET_TIMEOUT
+        self.retries = settings.FILLET_RETRIES if retries is None else retries
+        self.backoff = settings.FILLET_RETRY_BACKOFF if backoff is None else backoff
+        self.compress = settings.FILLET_COMPRESS_REQUESTS if compress is None else compress
+        self.compress_min_size = settings.FILLET_COMPRESS_MIN_SIZE if compress_min_size is None else compress_min_size
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        # Connections are not shared with processes forked after the session was created
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    self._session = self.create_session()
+                    self._pid = os.getpid()
+        return self._session
+
+    def create_session(self):
+        retry = Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=0,
+            status=self.retries,
+            status_forcelist=[503],
+            backoff_factor=self.backoff,
+            raise_on_status=False,
+            # Any method, the calls to Fillet are all POSTs
+            **{RETRY_METHODS: False},
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount(self.base_url, adapter)
+        session.headers.update({
+            'Accept-Charset': 'UTF-8',
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive',
+        })
+        return session
+
+    def post(self, path, payload=None, data=None, files=None, timeout=None):
+        """
+        Posts to `path` of Fillet, with `payload` as a JSON body or `data` and `files` as a form.
+        Returns the requests.Response, raises FilletError if Fillet could not be reached.
+        """
+        headers = dict()
+        if payload is not None:
+            data = json.dumps(payload).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+            if self.compress and len(data) >= self.compress_min_size:
+                data = gzip.compress(data)
+                headers['Content-Encoding'] = 'gzip'
+        return self.session.post(self.base_url + path, data=data, files=files, headers=headers, timeout=timeout or self.timeout)
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+
+fillet = FilletClient()
@@ -0,0 +1,24 @@
+from rest_framework.pagination import CursorPagination
+
+class KeysetPagination(CursorPagination):
+    """
+    Cursor pagination for list views, ordered by the view's `cursor_ordering`, newest first by default.
+
+    Pages are read with a WHERE on the first ordering field instead of an OFFSET, so every page
+    costs the same however deep it is. Lists are only paginated when `cursor` or `page_size` is
+    in the query, other requests still get the whole list as a plain array.
+    """
+
+    ordering = ('-created', '-id')
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param not in request.query_params and self.page_size_query_param not in request.query_params:
+            return None
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_ordering(self, request, queryset, view):
+        ordering = getattr(view, 'cursor_ordering', self.ordering)
+        return (ordering, ) if isinstance(ordering, str) else tuple(ordering)
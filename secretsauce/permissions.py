@@ -1,39 +1,91 @@
-from rest_framework import permissions
+from django.conf import settings
+from rest_framework import filters, permissions
 from secretsauce.apps.account.models import User
 from secretsauce.apps.portal.models import *
+from secretsauce.apps.portal.cache import owned_project_ids
 from secretsauce.apps.portal.views import *
 
+import hashlib, hmac
+
 class IsOwnerOrAdmin(permissions.BasePermission):
     """
     Only give permissions to owners and admins
     """
 
     def has_object_permission(self, request, view, obj):
-        # Gives permission only to owners, instance must have attribute named owners.
+        # Gives permission only to owners of the project the instance belongs to.
         if request.user.is_superuser:
             return True
 
+        project_id = self.get_project_id(obj)
+        if project_id is None:
+            return False
+        return project_id in owned_project_ids(request)
+
+    @staticmethod
+    def get_project_id(obj):
         if isinstance(obj, Project):
-            return obj.owners.all().filter(pk=request.user.id).exists()
+            return obj.pk
 
-        if isinstance(obj, DataBlock) or isinstance(obj, ConstraintBlock):
-            return obj.project.owners.all().filter(pk=request.user.id).exists()
+        if isinstance(obj, DataBlock) or isinstance(obj, ConstraintBlock) or isinstance(obj, UploadSession) or isinstance(obj, Job):
+            return obj.project_id
 
         if isinstance(obj, Constraint) or isinstance(obj, ConstraintParameter):
-            return obj.constraint_block.project.owners.all().filter(pk=request.user.id).exists()
+            return obj.constraint_block.project_id
 
         if isinstance(obj, ConstraintParameterRelationship):
-            return obje.constraint.constraint_block.project.owners.all().filter(pk=request.user.id).exists()
+            return obj.constraint.constraint_block.project_id
 
         if isinstance(obj, TrainedPredictionModel):
-            return obj.data_block.project.owners.all().filter(pk=request.user.id).exists()
+            return obj.data_block.project_id
 
         if isinstance(obj, Optimizer):
-            return obj.constraint_block.project.owners.all().filter(pk=request.user.id).exists()
+            return obj.constraint_block.project_id
 
-        return False
+        return None
         
     
+class IsOwnerOrAdminFilter(filters.BaseFilterBackend):
+    """
+    Filter backend limiting list views to the objects IsOwnerOrAdmin would allow,
+    with a condition on the owners of their project instead of a check per object
+    """
+
+    owner_lookups = {
+        Project: 'owners',
+        DataBlock: 'project__owners',
+        ConstraintBlock: 'project__owners',
+        UploadSession: 'project__owners',
+        Constraint: 'constraint_block__project__owners',
+        ConstraintParameter: 'constraint_block__project__owners',
+        ConstraintParameterRelationship: 'constraint__constraint_block__project__owners',
+        TrainedPredictionModel: 'data_block__project__owners',
+        Optimizer: 'constraint_block__project__owners',
+        Job: 'project__owners',
+    }
+
+    def filter_queryset(self, request, queryset, view):
+        if request.user.is_superuser:
+            return queryset
+        lookup = self.owner_lookups.get(queryset.model)
+        if lookup is None:
+            return queryset.none()
+        return queryset.filter(**{lookup: request.user.id})
+
+class FilletSignature(permissions.BasePermission):
+    """
+    Only allow requests of Fillet, whose X-Fillet-Signature header is 'sha256=' followed by
+    the hex HMAC-SHA256 of the body with FILLET_WEBHOOK_SECRET as key
+    """
+
+    def has_permission(self, request, view):
+        secret = settings.FILLET_WEBHOOK_SECRET
+        signature = request.META.get('HTTP_X_FILLET_SIGNATURE', '')
+        if not secret or not signature.startswith('sha256='):
+            return False
+        expected = hmac.new(secret.encode('utf-8'), request.body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(signature[len('sha256='):], expected)
+
 class AdminOrReadOnly(permissions.BasePermission):
 
     def has_permission(self, request, view):
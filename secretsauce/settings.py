@@ -121,6 +121,26 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'default',
+    },
+    # DataBlock analytics responses, least recently used entries are evicted first
+    'analytics': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'analytics',
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 2000,
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -170,4 +190,71 @@ EMAIL_HOST_PASSWORD = SENDGRID_API_KEY
 EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 
-CORS_ORIGIN_ALLOW_ALL = True 
+CORS_ORIGIN_ALLOW_ALL = True
+
+# Seconds the ids of the projects owned by a user are cached for permission checks, 0 to only cache them per request
+OWNED_PROJECTS_CACHE_TIMEOUT = 30
+
+# Stop verifying an uploaded DataBlock once more than this fraction of its rows have cell errors
+UPLOAD_MAX_ERROR_RATE = 0.5
+
+# Seconds after its last chunk that an unfinished chunked upload is deleted with its stored parts
+UPLOAD_SESSION_MAX_AGE = 24 * 60 * 60
+
+# Number of threads running secretsauce.utils.run_in_background tasks, e.g. building DataBlock cubes
+BACKGROUND_WORKERS = int(os.environ.get('BACKGROUND_WORKERS', 4))
+
+# Run secretsauce.utils.run_in_background tasks in the request thread, e.g. in tests
+BACKGROUND_TASKS_INLINE = False
+
+# Fillet modelling service, see secretsauce.fillet
+FILLET_URL = os.environ.get('FILLET_URL', 'https://fillet.azurewebsites.net')
+
+# Number of kept-alive connections to Fillet per process
+FILLET_POOL_SIZE = int(os.environ.get('FILLET_POOL_SIZE', 10))
+
+# (connect, read) timeout in seconds of calls to Fillet
+FILLET_TIMEOUT = (3.05, 10.5)
+
+# Times a call is retried when Fillet cannot be reached or answers 503, and the backoff factor in seconds
+FILLET_RETRIES = 2
+FILLET_RETRY_BACKOFF = 0.5
+
+# Gzip JSON request bodies of at least FILLET_COMPRESS_MIN_SIZE bytes, Fillet has to accept Content-Encoding: gzip
+FILLET_COMPRESS_REQUESTS = os.environ.get('FILLET_COMPRESS_REQUESTS') == '1'
+FILLET_COMPRESS_MIN_SIZE = 1024
+
+# Worker threads of the runjobs command, and seconds it waits for new jobs when the queue is empty
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+JOB_POLL_INTERVAL = 2
+
+# Trainings and optimizations of one company running at the same time, to cap the load a tenant puts on Fillet
+JOBS_PER_TENANT = 2
+
+# Attempts of a job before it is marked failed, retried after JOB_RETRY_BACKOFF * 2 ** (attempt - 1) seconds
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_BACKOFF = 30
+
+# Seconds after its last heartbeat that a running job is considered lost and retried, and
+# seconds between the heartbeats of the worker running it
+JOB_TIMEOUT = 600
+JOB_HEARTBEAT_INTERVAL = 60
+
+# Key of the HMAC signature of progress pushed by Fillet to trainedmodels/progress/, the webhook is disabled when empty
+FILLET_WEBHOOK_SECRET = os.environ.get('FILLET_WEBHOOK_SECRET', '')
+
+# Seconds progress stream clients wait between requests
+PROGRESS_CLIENT_POLL_INTERVAL = 2
+
+# Longest a progress stream request waits for changes, and seconds between its checks for them.
+# A waiting request holds its worker, so only raise it with workers that can afford to wait.
+PROGRESS_LONG_POLL_TIMEOUT = float(os.environ.get('PROGRESS_LONG_POLL_TIMEOUT', 0))
+PROGRESS_POLL_INTERVAL = 1
+
+# Seconds progress events are kept, clients asking for changes since an older version get a snapshot
+PROGRESS_EVENT_MAX_AGE = 3600
+
+# Seconds between the runjobs checks for finished optimizations, and after which a job Fillet
+# accepted but never reported finished stops counting towards JOBS_PER_TENANT
+JOB_CHECK_INTERVAL = 30
+JOB_SUBMITTED_TIMEOUT = 12 * 60 * 60
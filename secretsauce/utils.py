@@ -4,9 +4,18 @@ from rest_framework.views import exception_handler
 from rest_framework.exceptions import APIException
 from django.template import loader
 from django.core.mail import send_mail
+from django.conf import settings
+from django.db import connection, transaction
 
-import random, string, csv, io
+import random, string, csv, io, base64, codecs, hashlib, logging, tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from secrets import token_urlsafe
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
 
 def reverse_args(name):
     """
@@ -41,10 +50,109 @@ class WrongCellTypeCSVFile(APIException):
     default_detail = "CSV file has the wrong cell type"
     default_code = "wrong_cell_type_csv_file"
 
+class DataBlockNotReady(APIException):
+    status_code = 409
+    default_detail = "DataBlock is still being ingested"
+    default_code = "data_block_not_ready"
+
+class ResultsNotReady(APIException):
+    status_code = 409
+    default_detail = "Results are being fetched from Fillet, try again shortly"
+    default_code = "results_not_ready"
+
+class TooManyErrorsCSVFile(APIException):
+    status_code = 400
+    default_detail = "CSV file has too many cells with errors"
+    default_code = "too_many_errors_csv_file"
+
+class ErrorCollector(dict):
+    """
+    Cell errors of an upload, a dict of the first `max_examples` errors in file order,
+    as {"Col: <header>, Row: <line>": <message>}.
+
+    Every error is counted in `columns`, the number of bad cells per column, and `rows`,
+    the number of rows with at least one bad cell, so a badly broken file is summarized
+    in constant memory.
+    """
+
+    def __init__(self, max_examples=None):
+        super().__init__()
+        self.max_examples = max_examples
+        self.columns = dict()
+        self.rows = 0
+
+    @property
+    def total(self):
+        return sum(self.columns.values())
+
+    def add(self, fieldnames, bad_cells, first_line):
+        """
+        Records the bad cells of a block starting at line `first_line`.
+        `bad_cells` maps a column index to the row indexes of its bad cells in the block, and their values.
+        """
+        if not bad_cells:
+            return
+        for col_idx, (row_idxs, values) in bad_cells.items():
+            self.columns[fieldnames[col_idx]] = self.columns.get(fieldnames[col_idx], 0) + len(row_idxs)
+        self.rows += len(np.unique(np.concatenate([row_idxs for row_idxs, values in bad_cells.values()])))
+
+        remaining = None if self.max_examples is None else self.max_examples - len(self)
+        if remaining is not None and remaining <= 0:
+            return
+        # The first `remaining` cells of each column hold the first `remaining` cells of the block
+        cells = sorted(
+            (row_idx, col_idx, value)
+            for col_idx, (row_idxs, values) in bad_cells.items()
+            for row_idx, value in zip(row_idxs[:remaining], values[:remaining])
+        )
+        for row_idx, col_idx, value in cells[:remaining]:
+            error_key = "Col: " + fieldnames[col_idx] + ", Row: " + str(first_line + row_idx)
+            if value.isspace() or value == "":
+                self[error_key] = "Cell is empty"
+            else:
+                self[error_key] = "Cell value not allowed: " + value
+
+    def summary(self):
+        """Returns the counts and examples as JSON serializable data"""
+        return {
+            'total': self.total,
+            'rows': self.rows,
+            'columns': self.columns,
+            'examples': dict(self),
+        }
+
+    def get_state(self):
+        return {'examples': dict(self), 'columns': self.columns, 'rows': self.rows}
+
+    def set_state(self, state):
+        self.clear()
+        self.update(state['examples'])
+        self.columns = dict(state['columns'])
+        self.rows = state['rows']
+
 class UploadVerifier:
     """
     Helper class to verify validity of the uploaded datablock file
 
+    The upload is streamed chunk by chunk and parsed in a single pass: the header
+    row is checked once, then every block of complete records is parsed into a
+    DataFrame and goes through the `check_*` methods and `collect`. Only the
+    current chunk and any incomplete trailing record are held in memory, so peak
+    memory does not depend on the size of the file.
+
+    Cell errors are collected in `errors`, an ErrorCollector keeping the first `max_errors`
+    of them as {"Col: <header>, Row: <line>": <message>} and counting all of them.
+    With `max_error_rate`, verification stops with TooManyErrorsCSVFile as soon as more
+    than that fraction of the rows has errors, once `abort_min_rows` rows have been read.
+
+    If a writable binary file is given as `parquet`, the rows are also written to it
+    as a typed Parquet file following `parquet_schema`, cells that are not numbers,
+    or not whole numbers in `integer_columns`, are stored as nulls.
+
+    The progress can be saved with `get_state` and resumed in another process with
+    `set_state`, to verify a file uploaded over several requests. `checksum` is the SHA-256
+    of the bytes fed, hashlib can not save its progress, so it is '' once resumed.
+
     Raises
     ------
     UnreadableCSVFile : APIException
@@ -53,61 +161,358 @@ class UploadVerifier:
         Exception raised when there are issues related to the structure of the csv file.
     WrongCellTypeCSVFile : APIException
         Exception raised when there are issues related to the cell types of the csv file.
+    TooManyErrorsCSVFile : APIException
+        Exception raised when the rate of rows with errors exceeds `max_error_rate`.
     """
 
     headers = ['Wk', 'Tier', 'Groups', 'Store', 'Item_ID', 'Qty_', 'Price_']
+    chunk_size = 2 ** 20
+    max_record_size = 2 ** 20
+    max_errors = 1000
+    max_error_rate = None
+    abort_min_rows = 10000
+    # Plain decimal numbers, anything else goes through float()
+    number_pattern = r'\s*[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?\s*$'
+
+    parquet_schema = pa.schema([
+        ('Wk', pa.int64()),
+        ('Tier', pa.int64()),
+        ('Groups', pa.int64()),
+        ('Store', pa.int64()),
+        ('Item_ID', pa.int64()),
+        ('Qty_', pa.float64()),
+        ('Price_', pa.float64()),
+    ])
+    integer_columns = [field.name for field in parquet_schema if pa.types.is_integer(field.type)]
 
-    def __init__(self, upload, encoding='utf-8'):
+    def __init__(self, upload=None, encoding='utf-8', max_errors=None, parquet=None, max_error_rate=None):
         """Raises UnreadableCSVFile if there are issues with reading the file"""
-        self.errors = dict()
-        upload.seek(0)
+        if max_errors is not None:
+            self.max_errors = max_errors
+        if max_error_rate is not None:
+            self.max_error_rate = max_error_rate
+        self.parquet = parquet
+        self.parquet_writer = None
+        self.errors = ErrorCollector(self.max_errors)
+        self.item_ids = set()
+        self.fieldnames = None
+        self.row_count = 0
+        self.pending = ''
+        self.sha256 = hashlib.sha256()
+        try:
+            self.decoder = codecs.getincrementaldecoder(encoding)()
+        except LookupError:
+            raise UnreadableCSVFile()
+
+        self.checks = [getattr(self, m) for m in dir(self) if m.startswith('check_') and m != 'check_headers']
+        if upload is not None:
+            self.perform_checks(upload)
+
+    def perform_checks(self, upload):
+        for chunk in upload.chunks(self.chunk_size):
+            self.feed(chunk)
+        self.close()
+
+    def feed(self, chunk):
+        """Parses every complete record in `chunk`, keeping any incomplete trailing record for the next call"""
+        if self.sha256 is not None:
+            self.sha256.update(chunk)
+        try:
+            text = self.pending + self.decoder.decode(chunk)
+        except UnicodeDecodeError:
+            raise UnreadableCSVFile()
+
+        # Only cut at a newline that is not inside a quoted field
+        end = text.rfind('\n') + 1
+        if end == 0 or text.count('"', 0, end) % 2:
+            if len(text) > self.max_record_size:
+                raise UnreadableCSVFile(detail='CSV record is too large, check for unterminated quotes')
+            self.pending = text
+            return
+        self.pending = text[end:]
+        self.parse(text[:end])
+
+    def close(self):
+        """Parses the remaining buffered data. Raises WrongHeaderCSVFile if the file is empty"""
         try:
-            self.io_obj = io.StringIO(upload.read().decode(encoding))
-            self.csv_file = csv.DictReader(self.io_obj)
-        except:
+            text = self.pending + self.decoder.decode(b'', final=True)
+        except UnicodeDecodeError:
             raise UnreadableCSVFile()
+        self.pending = ''
+        if text:
+            self.parse(text)
+        if self.fieldnames is None:
+            raise WrongHeaderCSVFile()
+        if self.parquet is not None:
+            self.flush_parquet()
+
+    def get_state(self):
+        """Returns the progress of the verification as JSON serializable data"""
+        buffered, flag = self.decoder.getstate()
+        return {
+            'errors': self.errors.get_state(),
+            'item_ids': sorted(self.item_ids),
+            'fieldnames': self.fieldnames,
+            'row_count': self.row_count,
+            'pending': self.pending,
+            'decoder': [base64.b64encode(buffered).decode('ascii'), flag],
+        }
+
+    def set_state(self, state):
+        """Resumes the verification from data returned by `get_state`"""
+        self.errors.set_state(state['errors'])
+        self.item_ids = set(state['item_ids'])
+        self.fieldnames = state['fieldnames']
+        self.row_count = state['row_count']
+        self.pending = state['pending']
+        buffered, flag = state['decoder']
+        self.decoder.setstate((base64.b64decode(buffered), flag))
+        self.sha256 = None
 
-        self.checks = [getattr(self, m) for m in dir(self) if m.startswith('check_')]
-        self.perform_checks()
-    
-    def perform_checks(self):
-        for m in self.checks:
-            m()
-            self.reset_seeker()
+    @property
+    def checksum(self):
+        """SHA-256 hex digest of the bytes fed, '' if resumed from a state"""
+        return self.sha256.hexdigest() if self.sha256 is not None else ''
 
-    def check_headers(self):
+    def parse(self, text):
+        if self.fieldnames is None:
+            header_line, _, text = text.partition('\n')
+            try:
+                header = next(csv.reader([header_line]), [])
+            except csv.Error:
+                raise UnreadableCSVFile()
+            self.check_headers(header)
+            self.fieldnames = header
+
+        block = self.read_block(text)
+        if len(block) == 0:
+            return
+        first_line = self.row_count + 2
+        self.row_count += len(block)
+        for check in self.checks:
+            check(block, first_line)
+        self.enforce_error_rate()
+        self.collect(block)
+        if self.parquet is not None:
+            self.write_parquet(block)
+
+    def read_block(self, text):
+        """
+        Parses a block of complete records into a DataFrame, one column per header.
+        Columns made up only of numbers come out numeric; any other column is left as strings.
+        Fields after the last header, e.g. left by trailing commas, go to string columns after
+        them, see `extra_fields`.
+        """
+        width = len(self.fieldnames)
+        try:
+            first = next(csv.reader(io.StringIO(text)), [])
+        except csv.Error:
+            raise UnreadableCSVFile()
+        # Named up to the length of the first row, or pandas makes the fields it has no name for the index
+        names = self.extra_names(len(first))
+        try:
+            return pd.read_csv(io.StringIO(text), header=None, names=names, index_col=False, na_filter=False, dtype={name: str for name in names[width:]})
+        except pd.errors.EmptyDataError:
+            return pd.DataFrame(columns=self.fieldnames)
+        except pd.errors.ParserError:
+            # Ragged rows, pad them to the longest one
+            pass
+        try:
+            rows = [row for row in csv.reader(text.splitlines(keepends=True)) if row]
+        except csv.Error:
+            raise UnreadableCSVFile()
+        names = self.extra_names(max(map(len, rows), default=width))
+        return pd.DataFrame([row + [''] * (len(names) - len(row)) for row in rows], columns=names)
+
+    def extra_names(self, length):
+        """The headers followed by names for the fields of rows of `length` fields beyond them"""
+        return self.fieldnames + [f'Extra {idx}' for idx in range(length - len(self.fieldnames))]
+
+    def extra_fields(self, block):
+        """
+        Returns the fields of every row of `block` after the last header joined by commas, and the
+        mask of the rows that have any that is not empty, or None if there are none
+        """
+        columns = [block[name].astype(str) for name in block.columns[len(self.fieldnames):]]
+        if not columns:
+            return None
+        joined = columns[0].str.cat(columns[1:], sep=',') if len(columns) > 1 else columns[0]
+        return joined.values, (joined.str.replace(',', '').str.strip() != '').values
+
+    def check_headers(self, header):
         """Raises WrongHeaderCSVFile if there are issues related to the structure of the csv file"""
-        first_row = next(self.csv_file)
-        for idx, header in enumerate(first_row):
-            if header != self.headers[idx]:
-                raise WrongHeaderCSVFile()
-        
-    def check_type(self):
-        """Raises WrongCellTypeCSVFile if there are issues related to the structure of the csv file"""
-        for idx, row in enumerate(self.csv_file):
-            # row is an OrderedDict of (header, value)
-            for header in row:
-                value = row[header]
-                value.strip()
-                try:
-                    float(value)
-                except Exception as e:
-                    error_key = "Col: " + header + ", Row: " + str(idx+2)
-                    if value.isspace() or value == "":
-                        self.errors[error_key] = "Cell is empty"
-                    else:
-                        self.errors[error_key] = "Cell value not allowed: " + value
-
-    def reset_seeker(self):
-        self.io_obj.seek(0)
-        self.csv_file = csv.DictReader(self.io_obj)
+        if header != self.headers:
+            raise WrongHeaderCSVFile()
+
+    def check_type(self, block, first_line):
+        """
+        Records an error for every cell in `block` that is not a number, or not a whole number in
+        `integer_columns`. Rows with more fields than headers get an error in their last column.
+        """
+        bad_cells = dict()
+        extra = self.extra_fields(block)
+        for col_idx, header in enumerate(self.fieldnames):
+            column = block[header]
+            whole = header in self.integer_columns
+            long_rows = extra is not None and col_idx == len(self.fieldnames) - 1 and extra[1].any()
+            if not long_rows and (pd.api.types.is_integer_dtype(column) or (pd.api.types.is_float_dtype(column) and not whole)):
+                continue
+            values = column.astype(str).values
+            bad = np.zeros(len(values), dtype=bool)
+            # Columns parsed as bool from true/false are not numbers either
+            if not pd.api.types.is_float_dtype(column):
+                mask = ~pd.Series(values).str.match(self.number_pattern).values
+                for row_idx in np.flatnonzero(mask):
+                    # Rare path, keep the exact semantics of float() e.g. 'nan' and 'inf' are allowed
+                    try:
+                        float(values[row_idx])
+                    except ValueError:
+                        bad[row_idx] = True
+            if whole:
+                # Would be truncated when written as integers
+                numbers = pd.to_numeric(pd.Series(values), errors='coerce').values.astype(np.float64)
+                with np.errstate(invalid='ignore'):
+                    bad |= ~np.isnan(numbers) & ((numbers % 1 != 0) | (np.abs(numbers) >= 2 ** 63))
+            if long_rows:
+                joined, mask = extra
+                values = np.where(mask, pd.Series(values).str.cat(pd.Series(joined), sep=',').values, values)
+                bad |= mask
+            row_idxs = np.flatnonzero(bad)
+            if len(row_idxs):
+                bad_cells[col_idx] = (row_idxs, values[row_idxs])
+        self.errors.add(self.fieldnames, bad_cells, first_line)
+
+    def enforce_error_rate(self):
+        """Raises TooManyErrorsCSVFile if more than `max_error_rate` of the rows read so far have errors"""
+        if self.max_error_rate is None or self.row_count < self.abort_min_rows:
+            return
+        error_rate = self.errors.rows / self.row_count
+        if error_rate > self.max_error_rate:
+            raise TooManyErrorsCSVFile(detail=f'{self.errors.rows} of the first {self.row_count} rows have errors, stopped reading the file')
+
+    def collect(self, block):
+        """Adds the Item_IDs of `block` to the schema"""
+        item_ids = pd.to_numeric(block['Item_ID'], errors='coerce').values.astype(np.float64)
+        # Only the whole numbers, the others are cell errors
+        item_ids = item_ids[np.isfinite(item_ids) & (item_ids % 1 == 0) & (np.abs(item_ids) < 2 ** 63)]
+        self.item_ids.update(np.unique(item_ids.astype(np.int64)).tolist())
+
+    def flush_parquet(self):
+        """Completes the Parquet file written so far, later rows go to the file set as `parquet` next"""
+        if self.parquet_writer is None:
+            self.write_parquet(pd.DataFrame(columns=self.parquet_schema.names))
+        self.parquet_writer.close()
+        self.parquet_writer = None
+
+    def write_parquet(self, block):
+        """Appends `block` to the Parquet file as a row group"""
+        if self.parquet_writer is None:
+            self.parquet_writer = pq.ParquetWriter(self.parquet, self.parquet_schema, compression='snappy')
+        arrays = []
+        for field in self.parquet_schema:
+            values = block[field.name]
+            # Bools are cell errors, stored as nulls like the other cells that are not numbers
+            if pd.api.types.is_bool_dtype(values):
+                values = values.astype(str)
+            numbers = pd.to_numeric(values, errors='coerce')
+            if pa.types.is_integer(field.type) and pd.api.types.is_float_dtype(numbers):
+                # Cells that are not whole numbers are errors too, stored as nulls rather than truncated
+                numbers = numbers.where((numbers % 1 == 0) & (numbers.abs() < 2 ** 63))
+            arrays.append(pa.array(numbers, from_pandas=True).cast(field.type))
+        self.parquet_writer.write_table(pa.Table.from_arrays(arrays, schema=self.parquet_schema))
 
     def get_schema(self):
-        """Returns list of unique Item_IDs from uploaded file"""
-        required_header = self.headers[4]
-        item_ids = map(lambda row: int(row[required_header]), self.csv_file)
-        self.reset_seeker()
-        return set(item_ids)
+        """Returns set of unique Item_IDs from uploaded file"""
+        return self.item_ids
+
+def file_checksum(f, chunk_size=2 ** 20):
+    """Returns the SHA-256 hex digest of the Django File `f`"""
+    sha256 = hashlib.sha256()
+    for chunk in f.chunks(chunk_size):
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+def sort_parquet(source, sink, column, bucket_rows=2 ** 21, row_group_size=2 ** 16):
+    """
+    Rewrites the Parquet file `source`, or the concatenation of a list of Parquet files
+    with the same schema, into `sink` ordered by the integer `column`,
+    keeping the original order of rows with the same value. Rows are first spread over
+    temporary files holding consecutive ranges of `column` values, about `bucket_rows`
+    rows each, and every range is then sorted in memory, so the whole file is never loaded.
+
+    Every row group of `sink` covers a narrow range of `column` values, which lets
+    readers skip row groups using their statistics.
+    """
+    parquet_files = [pq.ParquetFile(f) for f in (source if isinstance(source, (list, tuple)) else [source])]
+    schema = parquet_files[0].schema_arrow
+    row_groups = [(parquet_file, idx) for parquet_file in parquet_files for idx in range(parquet_file.num_row_groups)]
+
+    counts = pd.Series(dtype=np.int64)
+    for parquet_file, idx in row_groups:
+        values = parquet_file.read_row_group(idx, columns=[column]).column(0).to_pandas()
+        counts = counts.add(values.value_counts(), fill_value=0)
+    counts = counts.sort_index()
+
+    # Upper bounds of each bucket, a value with more than bucket_rows rows gets a bucket of its own
+    bounds = []
+    bucket_size = 0
+    for value, count in counts.items():
+        if bucket_size > 0 and bucket_size + count > bucket_rows:
+            bounds.append(previous)
+            bucket_size = 0
+        bucket_size += count
+        previous = value
+    bounds = np.array(bounds, dtype=np.int64)
+
+    buckets = [tempfile.TemporaryFile() for _ in range(len(bounds) + 1)]
+    try:
+        writers = [pq.ParquetWriter(bucket, schema) for bucket in buckets]
+        for parquet_file, idx in row_groups:
+            df = parquet_file.read_row_group(idx).to_pandas()
+            bucket_ids = np.searchsorted(bounds, df[column].values, side='left')
+            for bucket_id, part in df.groupby(bucket_ids, sort=False):
+                table = pa.Table.from_pandas(part, schema=schema, preserve_index=False)
+                writers[bucket_id].write_table(table)
+        for writer in writers:
+            writer.close()
+
+        writer = pq.ParquetWriter(sink, schema, compression='snappy')
+        for bucket in buckets:
+            bucket.seek(0)
+            df = pq.read_table(bucket).to_pandas().sort_values(column, kind='mergesort')
+            table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+            writer.write_table(table, row_group_size=row_group_size)
+        writer.close()
+    finally:
+        for bucket in buckets:
+            bucket.close()
+
+_background_pool = None
+
+def run_in_background(target, *args, **kwargs):
+    """
+    Runs `target` on the background worker pool and closes the worker's database connection when it ends.
+    At most settings.BACKGROUND_WORKERS tasks run at once, later ones wait for a free worker.
+    Inside a transaction the task is submitted once it commits, so it sees the rows written by it.
+    Exceptions are logged, `target` records its failure where it should be seen.
+    With settings.BACKGROUND_TASKS_INLINE, `target` runs in the calling thread instead.
+    """
+    global _background_pool
+    if settings.BACKGROUND_TASKS_INLINE:
+        target(*args, **kwargs)
+        return
+
+    def run():
+        try:
+            target(*args, **kwargs)
+        except Exception:
+            logger.exception('Background task %s failed', getattr(target, '__qualname__', target))
+        finally:
+            connection.close()
+
+    if _background_pool is None:
+        _background_pool = ThreadPoolExecutor(max_workers=settings.BACKGROUND_WORKERS, thread_name_prefix='background')
+    transaction.on_commit(lambda: _background_pool.submit(run))
 
 def send_email(subject, from_email, to_email, message, html_message_path, mappings={}):
     html_message = loader.render_to_string(
@@ -121,28 +526,64 @@ def generatePassword(stringLength=10):
     return ''.join((random.choice(lettersAndDigits) for i in range(stringLength)))    
 
 class CostSheetVerifier(UploadVerifier):
+    """
+    Helper class to verify the uploaded cost sheet and collect its Items.
+
+    The rows of every parsed block are merged into `items` with a groupby over Item, keeping
+    the last name and cost, the lowest Price_Floor and the highest Price_Cap seen for each Item.
+    """
 
     headers = ['Store', 'Center', 'iMenuCatNo', 'Item', 'iName', 'Qty', 'Cost', 'Price', 'Price_Floor', 'Price_Cap']
+    item_columns = ['name', 'cost', 'floor', 'cap']
 
-    def check_type(self):
+    def __init__(self, upload=None, encoding='utf-8'):
+        self.items = pd.DataFrame({
+            'name': pd.Series(dtype=object),
+            'cost': pd.Series(dtype=np.float64),
+            'floor': pd.Series(dtype=np.float64),
+            'cap': pd.Series(dtype=np.float64),
+        }, index=pd.Index([], dtype=np.int64, name='item_id'))
+        super().__init__(upload, encoding)
+
+    def check_type(self, block, first_line):
         pass
 
+    def collect(self, block):
+        """Merges the Items of `block` into `items`"""
+        df = pd.DataFrame({
+            'name': block['iName'].astype(str).values,
+            'cost': block['Cost'].astype(np.float64).values,
+            'floor': block['Price_Floor'].astype(np.float64).values,
+            'cap': block['Price_Cap'].astype(np.float64).values,
+        }, index=pd.Index(block['Item'].astype(np.int64).values, name='item_id'))
+        self.items = self.merge_items(pd.concat([self.items, df]))
+
+    @staticmethod
+    def merge_items(df):
+        return df.groupby(level='item_id', sort=True).agg(
+            name=('name', 'last'),
+            cost=('cost', 'last'),
+            floor=('floor', 'min'),
+            cap=('cap', 'max'),
+        )
+
     def get_items(self):
-        items = dict()
-        for row in self.csv_file:
-            item_id = row['Item']
-            item_name = row['iName']
-            item_cost = float(row['Cost'])
-            price_floor = float(row['Price_Floor'])
-            price_cap = float(row['Price_Cap'])
-            if item_id in items: 
-                current_floor = items[item_id][2]
-                current_cap = items[item_id][3]
-                items[item_id] = (item_name, item_cost, min(price_floor, current_floor), max(price_cap, current_cap))
-            else:
-                items[item_id] = (item_name, item_cost, price_floor, price_cap)
-        self.reset_seeker()
-        return items
+        """Returns a DataFrame indexed by item_id with the name, cost, floor and cap of every Item"""
+        return self.items
+
+    def get_state(self):
+        state = super().get_state()
+        state['items'] = [
+            [item_id, name, cost, floor, cap]
+            for item_id, name, cost, floor, cap in zip(self.items.index.tolist(), *(self.items[column].tolist() for column in self.item_columns))
+        ]
+        return state
+
+    def set_state(self, state):
+        super().set_state(state)
+        if state['items']:
+            df = pd.DataFrame(state['items'], columns=['item_id'] + self.item_columns)
+            self.items = df.astype({'item_id': np.int64}).set_index('item_id')
 
 def obfuscate_upload_link(instance, filename):
     secret = token_urlsafe(16)